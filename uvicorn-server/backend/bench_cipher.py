@@ -0,0 +1,67 @@
+"""
+Микробенчмарк шифрования: сравнивает старые функции (AES.new на каждый вызов)
+с сервисом AESCipher из server_cipher.
+
+Запуск из папки backend: python bench_cipher.py [кол-во_итераций]
+"""
+
+import base64
+import json
+import sys
+import time
+import uuid
+
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import unpad, pad
+
+from config import AES_KEY
+from server_cipher import AESCipher
+
+
+def legacy_decrypt(encrypted_b64: str):
+    # Копия исходной decrypt_payload: ключ кодируется и шифр создается на каждый вызов
+    combined = base64.b64decode(encrypted_b64)
+    cipher = AES.new(AES_KEY.encode('utf-8'), AES.MODE_CBC, combined[:16])
+    return unpad(cipher.decrypt(combined[16:]), AES.block_size).decode('utf-8')
+
+
+def legacy_encrypt(data_str: str):
+    # Копия исходной encrypt_payload
+    cipher = AES.new(AES_KEY.encode('utf-8'), AES.MODE_CBC)
+    ct_bytes = cipher.encrypt(pad(data_str.encode('utf-8'), AES.block_size))
+    return base64.b64encode(cipher.iv + ct_bytes).decode('utf-8')
+
+
+def measure(func, arg, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func(arg)
+    elapsed = time.perf_counter() - started
+    return {"us_per_call": round(elapsed / iterations * 1e6, 2), "calls_per_sec": round(iterations / elapsed)}
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    service = AESCipher(AES_KEY)
+
+    # Типичный запрос ТСД и типичный ответ сервера
+    request_json = json.dumps({"id": str(uuid.uuid4()), "time": int(time.time()), "barcode": "4004764390564", "action": "add"})
+    response_text = "Имя: Картридж HP 12A\nШтрих-код:4004764390564\nОстаток: 12"
+    encrypted_request = legacy_encrypt(request_json)
+
+    # Сервис должен быть совместим со старым форматом в обе стороны
+    assert service.decrypt(encrypted_request) == request_json
+    assert legacy_decrypt(service.encrypt(response_text)) == response_text
+
+    result = {
+        "iterations": iterations,
+        "decrypt": {
+            "legacy": measure(legacy_decrypt, encrypted_request, iterations),
+            "service": measure(service.decrypt, encrypted_request, iterations),
+        },
+        "encrypt": {
+            "legacy": measure(legacy_encrypt, response_text, iterations),
+            "service": measure(service.encrypt, response_text, iterations),
+        },
+    }
+    print(json.dumps(result, indent=2, ensure_ascii=False))
@@ -0,0 +1,247 @@
+"""
+Проверка рассылки на локальном SMTP сервере-заглушке: старая отправка (новое соединение
+и login на каждого получателя) против пула сессий server_post (deliver_email, как у рассыльщика
+очереди писем), поштучно и одним письмом на всех.
+
+Заглушка отвечает на SMTP команды, ничего не доставляет и считает соединения, входы и письма.
+Задержка --handshake имитирует TLS рукопожатие и login настоящего сервера.
+Время старой отправки растет с числом соединений, у пула - только с числом писем.
+
+После замеров проверяется поведение пула (assert): одновременно открыто не больше SMTP_POOL_SIZE
+соединений, повторная рассылка идет по открытым сессиям, после обрыва сессии сервером письмо
+повторяется на другой сессии и доставляется ровно один раз, отказ сервера по адресу возвращается вызывающему,
+простоявшая дольше idle_seconds сессия открывается заново.
+
+Запуск из папки backend (нужен config с настройками почты, сами адреса не используются):
+    python bench_mail.py --recipients 20 --handshake 0.2
+"""
+
+import argparse
+import asyncio
+import json
+import smtplib
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import server_post
+from config import EMAIL_BATCH_MAX_RECIPIENTS
+
+
+class StubSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, handshake: float):
+        super().__init__(("127.0.0.1", 0), StubSMTPHandler)
+        self.handshake = handshake
+        self.lock = threading.Lock()
+        self.counters = {"connections": 0, "logins": 0, "messages": 0, "recipients": 0}
+        # Открытые сейчас соединения и их максимум с последнего сброса
+        self.active = 0
+        self.max_active = 0
+        # Адреса, на которые RCPT получает отказ 550
+        self.refused = set()
+        # Следующая команда MAIL оборвет соединение без ответа (сервер закрыл простаивавшую сессию)
+        self.drop_next = False
+
+    def count(self, name: str, value: int = 1):
+        with self.lock:
+            self.counters[name] += value
+
+    def opened(self):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+
+    def closed(self):
+        with self.lock:
+            self.active -= 1
+
+    def take_drop(self) -> bool:
+        with self.lock:
+            drop, self.drop_next = self.drop_next, False
+            return drop
+
+
+class StubSMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line: str):
+        self.wfile.write((line + "\r\n").encode("ascii"))
+
+    def handle(self):
+        server = self.server
+        server.count("connections")
+        server.opened()
+        try:
+            self.converse(server)
+        finally:
+            server.closed()
+
+    def converse(self, server: StubSMTPServer):
+        time.sleep(server.handshake / 2)
+        self.reply("220 stub ESMTP")
+        recipients = 0
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("ascii", "replace").strip()
+            verb = command.split(" ", 1)[0].upper()
+            if verb in ("EHLO", "HELO"):
+                self.reply("250-stub")
+                self.reply("250 AUTH PLAIN LOGIN")
+            elif verb == "AUTH":
+                time.sleep(server.handshake / 2)
+                server.count("logins")
+                self.reply("235 2.7.0 Authentication successful")
+            elif verb == "MAIL":
+                if server.take_drop():
+                    return
+                recipients = 0
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                address = command.split(":", 1)[-1].strip().strip("<>")
+                if address in server.refused:
+                    self.reply("550 5.1.1 User unknown")
+                    continue
+                recipients += 1
+                self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b".\n", b""):
+                    pass
+                server.count("messages")
+                server.count("recipients", recipients)
+                self.reply("250 OK")
+            elif verb in ("RSET", "NOOP"):
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+def legacy_send(host: str, port: int, recipient: str, message: str) -> bool:
+    # Копия исходной отправки: соединение и login на каждое письмо
+    server = smtplib.SMTP(host, port)
+    server.login("bench@localhost", "x")
+    server.sendmail("bench@localhost", recipient, message)
+    server.quit()
+    return True
+
+
+async def run_legacy(host: str, port: int, recipients: list) -> int:
+    # Как раньше: новый ThreadPoolExecutor(max_workers=5) на каждую рассылку
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=5)
+    results = await asyncio.gather(*[
+        loop.run_in_executor(executor, legacy_send, host, port, recipient, "Subject: bench\r\n\r\nbench")
+        for recipient in recipients
+    ])
+    executor.shutdown()
+    return sum(1 for result in results if result)
+
+
+async def run_pool(recipients: list, batch_size: int) -> int:
+    # Как рассыльщик outbox: письма по batch_size адресов параллельно через deliver_email
+    async def deliver(envelope: list) -> int:
+        try:
+            refused = await server_post.deliver_email(envelope, "bench", "<p>bench</p>")
+        except Exception:
+            return 0
+        return len(envelope) - len(refused)
+
+    results = await asyncio.gather(*[
+        deliver(recipients[i:i + batch_size]) for i in range(0, len(recipients), batch_size)
+    ])
+    return sum(results)
+
+
+async def measure(stub: StubSMTPServer, coroutine_factory) -> dict:
+    before = dict(stub.counters)
+    started = time.perf_counter()
+    delivered = await coroutine_factory()
+    elapsed = time.perf_counter() - started
+    result = {"seconds": round(elapsed, 3), "delivered": delivered}
+    result.update({name: stub.counters[name] - before[name] for name in before})
+    return result
+
+
+async def check_pool(stub: StubSMTPServer, result: dict):
+    """Проверки поведения пула на заглушке, ошибка - AssertionError"""
+    pool = server_post.get_smtp_pool()
+
+    # Соединений не больше размера пула, повторная рассылка не открывает новых
+    assert stub.max_active <= pool.size, f"открыто {stub.max_active} соединений при пуле {pool.size}"
+    assert result["pool_first_run"]["connections"] <= pool.size, result["pool_first_run"]
+    assert result["pool_second_run"]["connections"] == 0, result["pool_second_run"]
+    for run in ("pool_first_run", "pool_second_run"):
+        assert result[run]["delivered"] == result["recipients"] == result[run]["messages"], result[run]
+
+    # Сервер оборвал сессию: пул выбрасывает ее, повторяет письмо на другой сессии, и оно уходит ровно один раз
+    before = dict(stub.counters)
+    reconnects = pool.reconnects_total
+    stub.drop_next = True
+    refused = await server_post.deliver_email(["dropped@example.local"], "bench", "<p>bench</p>")
+    assert not stub.drop_next, "заглушка не оборвала сессию"
+    assert refused == {}, refused
+    assert pool.reconnects_total == reconnects + 1, pool.stats()
+    assert stub.counters["messages"] - before["messages"] == 1, stub.counters
+
+    # Отказ по одному адресу возвращается вызывающему, остальным письмо уходит
+    stub.refused.add("unknown@example.local")
+    before = dict(stub.counters)
+    refused = await server_post.deliver_email(["known@example.local", "unknown@example.local"], "bench", "<p>bench</p>")
+    assert set(refused) == {"unknown@example.local"} and refused["unknown@example.local"][0] == 550, refused
+    assert stub.counters["messages"] - before["messages"] == 1, stub.counters
+    assert stub.counters["recipients"] - before["recipients"] == 1, stub.counters
+    try:
+        await server_post.deliver_email(["unknown@example.local"], "bench", "<p>bench</p>")
+        raise AssertionError("отказ по единственному адресу не выбросил SMTPRecipientsRefused")
+    except smtplib.SMTPRecipientsRefused as e:
+        assert set(e.recipients) == {"unknown@example.local"}, e.recipients
+
+    # Простоявшая дольше idle_seconds сессия не используется повторно
+    idle_seconds, pool.idle_seconds = pool.idle_seconds, 0
+    before = dict(stub.counters)
+    time.sleep(0.01)
+    await server_post.deliver_email(["idle@example.local"], "bench", "<p>bench</p>")
+    pool.idle_seconds = idle_seconds
+    assert stub.counters["connections"] - before["connections"] == 1, stub.counters
+
+
+async def main(recipients_count: int, handshake: float):
+    stub = StubSMTPServer(handshake)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    host, port = stub.server_address
+
+    # Пул server_post направляем на заглушку без SSL
+    server_post.smtp_server = host
+    server_post.smtp_port = port
+    server_post.email_address = "bench@localhost"
+    server_post.SMTP_USE_SSL = False
+    recipients = [f"user{i}@example.local" for i in range(recipients_count)]
+
+    result = {"recipients": recipients_count, "handshake_seconds": handshake}
+    result["legacy"] = await measure(stub, lambda: run_legacy(host, port, recipients))
+    stub.max_active = stub.active
+    result["pool_first_run"] = await measure(stub, lambda: run_pool(recipients, 1))
+    result["pool_second_run"] = await measure(stub, lambda: run_pool(recipients, 1))
+    result["pool_batched"] = await measure(stub, lambda: run_pool(recipients, EMAIL_BATCH_MAX_RECIPIENTS))
+    await check_pool(stub, result)
+    result["pool_stats"] = server_post.get_smtp_pool().stats()
+
+    server_post.shutdown_mailer()
+    stub.shutdown()
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    print("Проверки пула пройдены")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Рассылка через пул SMTP сессий на сервере-заглушке")
+    parser.add_argument("--recipients", type=int, default=20, help="Количество получателей")
+    parser.add_argument("--handshake", type=float, default=0.2, help="Задержка соединения и login заглушки, секунды")
+    args = parser.parse_args()
+    asyncio.run(main(args.recipients, args.handshake))
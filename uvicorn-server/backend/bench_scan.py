@@ -0,0 +1,214 @@
+"""
+Нагрузочный тест эндпоинта /scan без сети.
+
+Поднимает ASGI-приложение app прямо в процессе на временной SQLite базе и запускает
+N виртуальных ТСД. Каждый ТСД шлет зашифрованные запросы в том же формате, что и настоящий:
+{"payload": base64(IV + AES-CBC(json))}, json = {"id", "time", "barcode", "action"}.
+Результат - JSON с перцентилями задержки, сканами в секунду и разбивкой по кодам ответа,
+чтобы сравнивать замеры до и после изменений.
+
+Запуск из папки uvicorn-server (там лежит frontend, который монтирует приложение):
+    python backend/bench_scan.py --scanners 20 --scans 200 --output before.json
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import pad, unpad
+
+
+def tsd_encrypt(key: bytes, data: dict) -> str:
+    # Так шифрует ТСД: случайный IV в начале сообщения, AES-CBC, PKCS7, base64
+    cipher = AES.new(key, AES.MODE_CBC)
+    ct_bytes = cipher.encrypt(pad(json.dumps(data).encode('utf-8'), AES.block_size))
+    return base64.b64encode(cipher.iv + ct_bytes).decode('utf-8')
+
+
+def tsd_decrypt(key: bytes, response_b64: str) -> str:
+    # Так ответ расшифровывает decryptor.py / ТСД
+    raw_data = base64.b64decode(response_b64)
+    cipher = AES.new(key, AES.MODE_CBC, raw_data[:16])
+    return unpad(cipher.decrypt(raw_data[16:]), AES.block_size).decode('utf-8')
+
+
+async def asgi_post(app, path: str, body: bytes, client: tuple, user_agent: str):
+    """
+    Минимальный ASGI-клиент: один POST запрос прямо в приложение
+
+    Returns:
+        Кортеж (status_code, тело ответа строкой)
+    """
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [
+            (b"host", b"bench"),
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"user-agent", user_agent.encode()),
+        ],
+        "client": client,
+        "server": ("127.0.0.1", 8080),
+    }
+    request_sent = False
+    response = {"status": None, "body": []}
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        # Приложению больше нечего читать, ждем пока оно само закончит
+        await asyncio.sleep(3600)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+        elif message["type"] == "http.response.body":
+            response["body"].append(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return response["status"], b"".join(response["body"]).decode('utf-8', errors='replace')
+
+
+async def seed_database(db_path: str, cartridges: int, initial_quantity: int):
+    """Создает таблицы и заполняет временную базу картриджами со штрихкодами"""
+    import aiosqlite
+    from server_db import init_database
+
+    barcodes = []
+    async with aiosqlite.connect(db_path) as db:
+        await init_database(db)
+        for index in range(cartridges):
+            cursor = await db.execute(
+                "INSERT INTO cartridges (cartridge_name, quantity, min_qty) VALUES (?, ?, ?)",
+                (f"Bench cartridge {index}", initial_quantity, 1)
+            )
+            barcode = f"{4600000000000 + index}"
+            await db.execute("INSERT INTO barcodes (barcode, cartridge_id) VALUES (?, ?)", (barcode, cursor.lastrowid))
+            barcodes.append(barcode)
+        await db.commit()
+    return barcodes
+
+
+async def run_scanner(app, key: bytes, scanner_index: int, args, barcodes: list, latencies: list, codes: dict, errors: dict):
+    rng = random.Random(args.seed + scanner_index)
+    client = (f"10.0.{scanner_index // 250}.{scanner_index % 250 + 1}", 40000 + scanner_index)
+    for _ in range(args.scans):
+        if rng.random() < args.unknown_ratio:
+            barcode = f"{9900000000000 + rng.randrange(10 ** 6)}"
+        else:
+            barcode = rng.choice(barcodes)
+        action = 'red' if rng.random() < args.red_ratio else 'add'
+        payload = tsd_encrypt(key, {"id": str(uuid.uuid4()), "time": int(time.time()), "barcode": barcode, "action": action})
+        body = json.dumps({"payload": payload}).encode('utf-8')
+
+        started = time.perf_counter()
+        try:
+            status_code, text = await asgi_post(app, "/scan", body, client, "okhttp/4.9.0 (Android 9)")
+        except Exception as e:
+            errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+            continue
+        latencies.append(time.perf_counter() - started)
+        codes[str(status_code)] = codes.get(str(status_code), 0) + 1
+
+        if args.verify:
+            try:
+                tsd_decrypt(key, text)
+            except Exception:
+                errors["bad_response_cipher"] = errors.get("bad_response_cipher", 0) + 1
+
+        if args.think_ms:
+            await asyncio.sleep(args.think_ms / 1000)
+
+
+def percentile(sorted_values: list, fraction: float):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def main(args):
+    workdir = tempfile.mkdtemp(prefix="cartridge_bench_")
+    db_path = os.path.join(workdir, "bench.db")
+    # База подменяется до импорта приложения, config читает путь из окружения
+    os.environ["CARTRIDGE_DB_NAME"] = db_path
+
+    barcodes = await seed_database(db_path, args.cartridges, args.initial_quantity)
+
+    from config import AES_KEY
+    from server_api import app
+
+    key = AES_KEY.encode('utf-8')
+    latencies, codes, errors = [], {}, {}
+
+    async with app.router.lifespan_context(app):
+        started = time.perf_counter()
+        await asyncio.gather(*[
+            run_scanner(app, key, index, args, barcodes, latencies, codes, errors)
+            for index in range(args.scanners)
+        ])
+        duration = time.perf_counter() - started
+
+    latencies_ms = sorted(value * 1000 for value in latencies)
+    return {
+        "scanners": args.scanners,
+        "scans_per_scanner": args.scans,
+        "cartridges": args.cartridges,
+        "red_ratio": args.red_ratio,
+        "unknown_ratio": args.unknown_ratio,
+        "total_requests": len(latencies),
+        "duration_s": round(duration, 3),
+        "scans_per_sec": round(len(latencies) / duration, 1) if duration else None,
+        "latency_ms": {
+            "mean": round(statistics.fmean(latencies_ms), 3) if latencies_ms else None,
+            "p50": round(percentile(latencies_ms, 0.50), 3) if latencies_ms else None,
+            "p95": round(percentile(latencies_ms, 0.95), 3) if latencies_ms else None,
+            "p99": round(percentile(latencies_ms, 0.99), 3) if latencies_ms else None,
+            "max": round(latencies_ms[-1], 3) if latencies_ms else None,
+        },
+        "status_codes": dict(sorted(codes.items())),
+        "errors": errors,
+        "db_path": db_path,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный тест /scan на временной базе")
+    parser.add_argument("--scanners", type=int, default=10, help="Количество одновременных ТСД")
+    parser.add_argument("--scans", type=int, default=100, help="Сканов на один ТСД")
+    parser.add_argument("--cartridges", type=int, default=50, help="Картриджей во временной базе")
+    parser.add_argument("--initial-quantity", type=int, default=100000, help="Начальный остаток каждого картриджа")
+    parser.add_argument("--red-ratio", type=float, default=0.5, help="Доля списаний (action=red)")
+    parser.add_argument("--unknown-ratio", type=float, default=0.05, help="Доля сканов непривязанных штрихкодов")
+    parser.add_argument("--think-ms", type=float, default=0, help="Пауза между сканами одного ТСД, мс")
+    parser.add_argument("--seed", type=int, default=1, help="Seed генератора для воспроизводимости")
+    parser.add_argument("--verify", action="store_true", help="Расшифровывать ответы, как это делает ТСД")
+    parser.add_argument("--output", help="Файл для JSON результата (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    result = asyncio.run(main(args))
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text, file=sys.stdout)
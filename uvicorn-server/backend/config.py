@@ -2,5 +2,108 @@
 CartridgeMaster - конфигурация и константы приложения.
 """
 
+import os
+
 AES_KEY = "My_Secret_Key_16"
-DB_NAME = "inventory.db"
+# Путь к базе можно переопределить переменной окружения (например, для бенчмарков на временной базе)
+DB_NAME = os.environ.get("CARTRIDGE_DB_NAME", "inventory.db")
+
+# Максимальное количество сканов в одном пакете /scan/batch
+SCAN_BATCH_MAX_ITEMS = 500
+
+# Сколько секунд помнить результаты сканов /scan/batch по их ID (не меньше срока, в течение которого
+# ТСД повторяет отправку накопленной очереди) и как часто удалять устаревшие, в секундах
+SCAN_RESULTS_RETENTION_SECONDS = 7 * 86400
+SCAN_RESULTS_PURGE_SECONDS = 3600
+
+# Групповой коммит: максимум операций в одной транзакции и окно ожидания в миллисекундах
+WRITE_BATCH_MAX_SIZE = 64
+WRITE_BATCH_MAX_WAIT_MS = 5
+
+# Окно свежести запросов от ТСД в секундах (защита от повтора)
+REPLAY_WINDOW_SECONDS = 10
+
+# Как часто сверять индекс штрихкодов в памяти с таблицей barcodes, в секундах
+BARCODE_INDEX_VERIFY_SECONDS = 600
+
+# Пул соединений с БД: количество соединений только для чтения и таймаут ожидания свободного, в секундах
+DB_READERS = 4
+DB_ACQUIRE_TIMEOUT = 5.0
+
+# Сколько секунд сессия из кэша считается актуальной без перечитывания из БД
+SESSION_CACHE_TTL_SECONDS = 300
+
+# Поток изменений для дашборда (SSE): размер очереди одного клиента (переполнение - клиент отключается)
+# и интервал пустых сообщений, которые держат соединение живым через прокси, в секундах
+EVENTS_QUEUE_SIZE = 256
+EVENTS_HEARTBEAT_SECONDS = 15
+
+# Журнал изменений каталога (GET /api/v1/cartridges?since=N): сколько дней хранить записи
+# и как часто запускать компактирование, в секундах
+CATALOG_CHANGES_RETENTION_DAYS = 30
+CATALOG_CHANGES_COMPACT_SECONDS = 3600
+
+# Постраничный каталог (GET /api/v1/cartridges/page): размер страницы по умолчанию и максимальный
+CATALOG_PAGE_SIZE = 50
+CATALOG_PAGE_MAX_SIZE = 200
+
+# Журнал операций (GET /api/v1/history): размер страницы по умолчанию и максимальный,
+# и сколько строк читать за одно обращение к БД при выгрузке (/api/v1/history/export)
+HISTORY_PAGE_SIZE = 100
+HISTORY_PAGE_MAX_SIZE = 1000
+HISTORY_EXPORT_CHUNK_SIZE = 500
+
+# Архив журнала операций: каталог с файлами history-YYYY.db (только для чтения), сколько лет держать
+# в основной базе (текущий и предыдущий), как часто искать закрытые годы, в секундах,
+# и сколько строк удалять из основной базы за одну запись
+HISTORY_ARCHIVE_DIR = os.environ.get("CARTRIDGE_ARCHIVE_DIR", "archive")
+HISTORY_LIVE_YEARS = 2
+HISTORY_ARCHIVE_CHECK_SECONDS = 86400
+HISTORY_ARCHIVE_DELETE_CHUNK = 2000
+
+# Сжатие старого журнала (по умолчанию выключено): записи старше HISTORY_COMPACT_AGE_DAYS дней одного картриджа,
+# устройства и пользователя с одним знаком delta и перерывами не больше HISTORY_COMPACT_GAP_SECONDS
+# сливаются в одну строку с суммой delta и количеством операций. Проверка - раз в HISTORY_COMPACT_CHECK_SECONDS
+HISTORY_COMPACT_ENABLED = os.environ.get("CARTRIDGE_HISTORY_COMPACT", "0") == "1"
+HISTORY_COMPACT_AGE_DAYS = 180
+HISTORY_COMPACT_GAP_SECONDS = 600
+HISTORY_COMPACT_CHECK_SECONDS = 86400
+
+# Справочник устройств: как часто сбрасывать накопленные в памяти счетчики активности в таблицу devices, в секундах
+DEVICE_STATS_FLUSH_SECONDS = 60
+
+# Почта: сколько авторизованных SMTP сессий (и потоков отправки) держать открытыми, через сколько секунд простоя
+# сессию не переиспользовать, а открыть заново, и SMTP поверх SSL (порт 465) или без него
+SMTP_POOL_SIZE = 2
+SMTP_SESSION_IDLE_SECONDS = 60
+SMTP_USE_SSL = True
+# Одно письмо сразу на несколько адресов (получатели в скрытой копии, в "Кому" - undisclosed-recipients)
+# и максимум адресов в одном письме. Выключено: каждый получатель видит в "Кому" свой адрес
+EMAIL_BATCH_RECIPIENTS = False
+EMAIL_BATCH_MAX_RECIPIENTS = 50
+
+# Очередь исходящих писем (таблица outbox): сколько писем отправлять одновременно, сколько попыток делать,
+# пауза после первой неудачи (дальше удваивается) и максимальная пауза, в секундах
+OUTBOX_CONCURRENCY = 2
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_BACKOFF_BASE_SECONDS = 30
+OUTBOX_BACKOFF_MAX_SECONDS = 3600
+# Такое же письмо тому же адресу за это окно повторно в очередь не ставится, в секундах
+OUTBOX_DEDUPE_SECONDS = 3600
+# Как часто перечитывать очередь без новых писем, в секундах, и сколько дней хранить отправленные письма
+OUTBOX_POLL_SECONDS = 30
+OUTBOX_RETENTION_DAYS = 30
+
+# Планировщик фоновых задач: как часто очищать истекшие сессии, в секундах, максимальный сон планировщика
+# без сверки с системными часами, в секундах, и насколько давний пропущенный запуск рассылки по расписанию
+# догонять после перезапуска сервера, в секундах
+SESSION_CLEANUP_SECONDS = 3600
+SCHEDULER_MAX_SLEEP_SECONDS = 300
+NOTIFICATION_CATCH_UP_SECONDS = 43200
+
+# Оповещения о переходе картриджа ниже минимума (сканы и PATCH): переходы копятся LOW_STOCK_ALERT_WINDOW_SECONDS
+# и уходят одним письмом, по одному картриджу - не чаще раза в LOW_STOCK_ALERT_COOLDOWN_SECONDS.
+# Адреса и глобальный выключатель - те же, что у рассылки по расписанию
+LOW_STOCK_ALERTS_ENABLED = os.environ.get("CARTRIDGE_LOW_STOCK_ALERTS", "1") == "1"
+LOW_STOCK_ALERT_WINDOW_SECONDS = 300
+LOW_STOCK_ALERT_COOLDOWN_SECONDS = 86400
@@ -5,9 +5,9 @@ CartridgeMaster - API эндпоинты сервера.
 """
 
 from fastapi import FastAPI, status, Request, HTTPException
-from fastapi.responses import HTMLResponse, PlainTextResponse, RedirectResponse, FileResponse
+from fastapi.responses import HTMLResponse, PlainTextResponse, RedirectResponse, FileResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import logging
 
@@ -18,22 +18,49 @@ from contextlib import asynccontextmanager
 import time
 import asyncio
 
-import aiosqlite
 import json
-from config import DB_NAME
+import base64
+import csv
+import io
+from config import (
+    DB_NAME, SCAN_BATCH_MAX_ITEMS, SCAN_RESULTS_RETENTION_SECONDS, SCAN_RESULTS_PURGE_SECONDS,
+    WRITE_BATCH_MAX_SIZE, WRITE_BATCH_MAX_WAIT_MS, REPLAY_WINDOW_SECONDS,
+    BARCODE_INDEX_VERIFY_SECONDS, DB_READERS, DB_ACQUIRE_TIMEOUT,
+    SESSION_CACHE_TTL_SECONDS, EVENTS_QUEUE_SIZE, EVENTS_HEARTBEAT_SECONDS,
+    CATALOG_CHANGES_RETENTION_DAYS, CATALOG_CHANGES_COMPACT_SECONDS,
+    CATALOG_PAGE_SIZE, CATALOG_PAGE_MAX_SIZE,
+    HISTORY_PAGE_SIZE, HISTORY_PAGE_MAX_SIZE, HISTORY_EXPORT_CHUNK_SIZE,
+    HISTORY_ARCHIVE_DIR, HISTORY_LIVE_YEARS, HISTORY_ARCHIVE_CHECK_SECONDS, HISTORY_ARCHIVE_DELETE_CHUNK,
+    HISTORY_COMPACT_ENABLED, HISTORY_COMPACT_AGE_DAYS, HISTORY_COMPACT_GAP_SECONDS, HISTORY_COMPACT_CHECK_SECONDS,
+    DEVICE_STATS_FLUSH_SECONDS, SESSION_CLEANUP_SECONDS, SCHEDULER_MAX_SLEEP_SECONDS, NOTIFICATION_CATCH_UP_SECONDS,
+    EMAIL_BATCH_RECIPIENTS, EMAIL_BATCH_MAX_RECIPIENTS,
+    OUTBOX_CONCURRENCY, OUTBOX_MAX_ATTEMPTS, OUTBOX_BACKOFF_BASE_SECONDS, OUTBOX_BACKOFF_MAX_SECONDS,
+    OUTBOX_DEDUPE_SECONDS, OUTBOX_POLL_SECONDS, OUTBOX_RETENTION_DAYS,
+    LOW_STOCK_ALERTS_ENABLED, LOW_STOCK_ALERT_WINDOW_SECONDS, LOW_STOCK_ALERT_COOLDOWN_SECONDS
+)
 
 from server_cipher import decrypt_payload, encrypt_payload
 
 from server_db import (
+    DatabasePool,
+    PoolTimeoutError,
     init_database,
     get_cartridge_by_barcode,
-    get_cartridge_name_and_quantity,
+    get_all_barcodes,
     get_cartridge_name,
-    update_cartridge_quantity_add,
-    update_cartridge_quantity_subtract,
+    apply_scan_delta,
+    apply_scan,
     get_all_cartridges,
-    get_cartridge_quantity,
-    update_cartridge_quantity,
+    get_cartridge_item,
+    record_catalog_change,
+    get_catalog_version,
+    get_catalog_floor,
+    get_catalog_changes,
+    get_cartridges_by_ids,
+    get_cartridges_page,
+    CATALOG_SORT_COLUMNS,
+    compact_catalog_changes,
+    backfill_consumption_rollups,
     get_cartridge_by_id,
     get_cartridge_stock_and_min,
     update_cartridge_details,
@@ -41,7 +68,11 @@ from server_db import (
     add_barcode,
     remove_barcode,
     add_history_record,
+    add_history_records,
     get_yearly_expense_heatmap,
+    get_history_page,
+    get_history_max_increment,
+    attach_history_archives,
     commit_changes,
     create_session,
     get_session,
@@ -55,15 +86,46 @@ from server_db import (
     delete_email,
     get_emails_for_notifications,
     get_low_stock_cartridges,
+    get_low_stock_items,
     get_setting,
     set_setting,
     get_notification_schedule,
     set_notification_schedule,
     get_notifications_enabled,
-    set_notifications_enabled
+    set_notifications_enabled,
+    migrate_history_devices,
+    get_all_devices,
+    create_device,
+    add_device_stats,
+    get_devices,
+    get_outbox_recent,
+    get_scan_results,
+    save_scan_results,
+    purge_scan_results,
+    NOTIFICATION_LAST_RUN_KEY,
+    NOTIFICATION_SCHEDULE_KEYS
+)
+
+from server_post import (
+    build_low_stock_email, deliver_email, get_smtp_pool, shutdown_mailer,
+    LOW_STOCK_ALERT_SUBJECT, LOW_STOCK_ALERT_HEADING
 )
 
-from server_post import send_low_stock_notifications
+from server_writer import WriteCoalescer
+
+from server_metrics import metrics, StageTimer, STAGE_SECONDS
+
+from server_cache import (
+    ReplayCache, BarcodeIndex, SessionCache, CatalogCache, DeviceRegistry, LowStockAlerts, crossed_below_min
+)
+
+from server_events import EventBroker, stream_events
+
+from server_outbox import OutboxWorker
+
+from server_scheduler import Scheduler, IntervalTrigger, WeeklyTrigger
+
+from server_archive import archive_closed_years, compact_old_history, list_history_archives, archives_for_period
 
 from server_auth import authenticate_user
 
@@ -75,107 +137,282 @@ class LoginRequest(BaseModel):
 
 logger = logging.getLogger("my_custom_logger")
 
-################################ Сет для временного хранения обработанных транзакций ##################################
+################################ Кэш для временного хранения обработанных транзакций #################################
+
+# Хранилище уникальных ID для каждого запроса от ТСД, разложенных по секундам поля time.
+# Старые секунды выкидываются сами по мере поступления запросов, периодическая очистка не нужна.
+processed_requests = ReplayCache(window_seconds=REPLAY_WINDOW_SECONDS)
+
+# Индекс штрихкод -> картридж, чтобы скан не ходил в базу за поиском привязки
+barcode_index = BarcodeIndex()
+
+# Кэш сессий, чтобы session_middleware не ходил в базу на каждый запрос к /api/
+session_cache = SessionCache(ttl_seconds=SESSION_CACHE_TTL_SECONDS)
+
+# Версия каталога картриджей и готовый JSON для GET /api/v1/cartridges
+catalog_cache = CatalogCache()
+
+# Рассылка изменений каталога открытым дашбордам
+event_broker = EventBroker(queue_size=EVENTS_QUEUE_SIZE)
+
+# Справочник устройств для history.device_id и их счетчики активности до сброса в БД
+device_registry = DeviceRegistry()
+
+# Картриджи, только что ушедшие ниже минимума, до отправки оповещения (см. send_low_stock_alerts_job)
+low_stock_alerts = LowStockAlerts(cooldown_seconds=LOW_STOCK_ALERT_COOLDOWN_SECONDS)
 
-# Хранилище уникальных ID для каждого запроса от ТСД
-processed_requests = set()
-# Фоновая задача для очистки старых ID (поставить потом раз в 6 часов и посмотреть сколько будет жрать ресурсов)
-async def clean_ids_task():
+metrics.register_stats("cartridge_replay_cache", "Кэш ID запросов ТСД", processed_requests.stats)
+metrics.register_stats("cartridge_barcode_index", "Индекс штрихкодов", barcode_index.stats)
+metrics.register_stats("cartridge_session_cache", "Кэш сессий", session_cache.stats)
+metrics.register_stats("cartridge_catalog_cache", "Кэш каталога картриджей", catalog_cache.stats)
+metrics.register_stats("cartridge_events", "Поток изменений для дашборда", event_broker.stats)
+metrics.register_stats("cartridge_devices", "Справочник устройств", device_registry.stats)
+metrics.register_stats("cartridge_smtp", "Пул SMTP сессий", get_smtp_pool().stats)
+metrics.register_stats("cartridge_low_stock_alerts", "Оповещения о низком запасе", low_stock_alerts.stats)
+
+
+# Уведомления об изменении каталога. Вызываются только после коммита с версией,
+# которую выдал record_catalog_change в той же транзакции: поднимают версию каталога
+# (сброс кэша и ETag) и отправляют событие открытым дашбордам.
+# ID события - версия каталога, по ней браузер отбрасывает запоздавшие события
+# и запрашивает пропущенные через GET /api/v1/cartridges?since=N.
+def publish_stock_change(version: int, cartridge_id: int, name: str, quantity: int):
+    """Изменился только остаток картриджа (сканы с ТСД)"""
+    catalog_cache.bump(version)
+    event_broker.publish("stock", {"id": cartridge_id, "name": name, "quantity": quantity}, version)
+
+
+async def publish_cartridge_change(pool, version: int, cartridge_id: int):
+    """Картридж создан или изменен (имя, минимум, штрихкоды) - отправляется карточка целиком"""
+    catalog_cache.bump(version)
+    if not event_broker.has_subscribers:
+        return
+    try:
+        async with pool.reader() as db:
+            item = await get_cartridge_item(db, cartridge_id)
+    except Exception as e:
+        # Изменение уже закоммичено, дашборды догонят при следующем полном обновлении
+        logger.error(f"Не удалось прочитать картридж {cartridge_id} для потока изменений: {e}")
+        return
+    if item:
+        event_broker.publish("upsert", item, version)
+    else:
+        event_broker.publish("delete", {"id": cartridge_id}, version)
+
+
+def publish_cartridge_deleted(version: int, cartridge_id: int):
+    """Картридж удален"""
+    catalog_cache.bump(version)
+    event_broker.publish("delete", {"id": cartridge_id}, version)
+
+# Фоновая задача для сверки индекса штрихкодов с таблицей barcodes
+async def verify_barcode_index_job(app):
     """
-    Очищает сет processed_requests раз в несколько часов
+    Перечитывает привязки штрихкодов из БД и исправляет дрейф индекса в памяти
     """
-    while True:
-        try:
-            await asyncio.sleep(3600)
-        except Exception:
-            logger.error(f"Функция для очистки сета ID-транзакций не запустилась!")
-        total_cleared = len(processed_requests)
-        processed_requests.clear()
-        logger.info(f"Набор недавних ID-транзакций от ТСД очищен. Удалено: {total_cleared}")
+    generation = barcode_index.generation
+    async with app.state.pool.reader() as db:
+        rows = await get_all_barcodes(db)
+    # Если за время чтения эндпоинт поменял привязки, снимок мог их не увидеть - сверка до следующего раза
+    drift = barcode_index.load(rows, generation)
+    if drift is None:
+        logger.info("Сверка индекса штрихкодов пропущена: привязки менялись во время чтения")
+    elif drift:
+        logger.warning(f"Индекс штрихкодов расходился с БД, исправлено записей: {drift}")
+
+# Фоновая задача для компактирования журнала изменений каталога
+async def compact_catalog_changes_job(app):
+    """
+    Убирает из журнала изменений каталога устаревшие записи
+    """
+    older_than = (datetime.now() - timedelta(days=CATALOG_CHANGES_RETENTION_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+    async with app.state.pool.write() as db:
+        removed, floor = await compact_catalog_changes(db, older_than)
+        await commit_changes(db)
+    if removed:
+        logger.info(f"Журнал изменений каталога компактирован. Удалено записей: {removed}, нижняя граница: {floor}")
+
+# Фоновая задача для удаления устаревших результатов пакетных сканов
+async def purge_scan_results_job(app):
+    """
+    Удаляет результаты сканов /scan/batch старше SCAN_RESULTS_RETENTION_SECONDS
+    """
+    older_than = int(time.time()) - SCAN_RESULTS_RETENTION_SECONDS
+
+    async def purge_op(db):
+        return await purge_scan_results(db, older_than)
+
+    removed = await app.state.writer.submit(purge_op)
+    if removed:
+        logger.info(f"Удалены устаревшие результаты пакетных сканов: {removed}")
+
+# Фоновая задача для переноса закрытых лет журнала в архив
+async def archive_history_job(app):
+    """
+    Переносит годы старше HISTORY_LIVE_YEARS в файлы архива
+    """
+    archived = await archive_closed_years(
+        app.state.pool, app.state.writer, HISTORY_ARCHIVE_DIR, HISTORY_LIVE_YEARS, HISTORY_ARCHIVE_DELETE_CHUNK
+    )
+    if archived:
+        logger.info(f"Журнал операций перенесен в архив за годы: {archived}")
+
+# Фоновая задача для сжатия старого журнала (включается HISTORY_COMPACT_ENABLED)
+async def compact_history_job(app):
+    """
+    Сжимает серии сканов старше HISTORY_COMPACT_AGE_DAYS дней
+    """
+    days, removed = await compact_old_history(
+        app.state.pool, app.state.writer, HISTORY_COMPACT_AGE_DAYS, HISTORY_COMPACT_GAP_SECONDS
+    )
+    if days:
+        logger.info(f"Журнал операций сжат. Обработано суток: {days}, удалено строк: {removed}")
+
+async def flush_device_stats(writer: WriteCoalescer):
+    """
+    Прибавляет накопленные в памяти счетчики устройств к таблице devices одной операцией писателя
+    """
+    rows = device_registry.take_pending()
+    if not rows:
+        return
+
+    async def flush_op(db):
+        await add_device_stats(db, rows)
+
+    try:
+        await writer.submit(flush_op)
+        device_registry.flushes += 1
+    except Exception:
+        # Счетчики не теряются, а уходят со следующим сбросом
+        device_registry.restore_pending(rows)
+        raise
+
+async def enqueue_low_stock_email(app, emails: list, low_stock: list) -> int:
+    """
+    Ставит письмо о низком запасе в очередь рассылки
+
+    Returns:
+        Количество адресов, поставленных в очередь (без повторов за OUTBOX_DEDUPE_SECONDS)
+    """
+    subject, html_body = build_low_stock_email(low_stock)
+    return await app.state.outbox.enqueue("low_stock", emails, subject, html_body, OUTBOX_DEDUPE_SECONDS)
+
+# Фоновая задача оповещений о переходе картриджей ниже минимума
+async def send_low_stock_alerts_job(app):
+    """
+    Отправляет одно письмо по всем картриджам, ушедшим ниже минимума за окно агрегации
+    """
+    pending = low_stock_alerts.take_pending()
+    if not pending:
+        return
+    async with app.state.pool.reader() as db:
+        if not await get_notifications_enabled(db):
+            return
+        emails = await get_emails_for_notifications(db)
+        current = await get_cartridges_by_ids(db, [item["id"] for item in pending]) if emails else []
+
+    # Картриджи, которые успели пополнить за окно, в письмо не попадают
+    low_stock = sorted(
+        ({"id": c["id"], "name": c["name"], "quantity": c["quantity"], "min_qty": c["min_qty"]}
+         for c in current if c["quantity"] < c["min_qty"]),
+        key=lambda item: item["name"]
+    )
+    if not low_stock:
+        return
+
+    subject, html_body = build_low_stock_email(low_stock, LOW_STOCK_ALERT_SUBJECT, LOW_STOCK_ALERT_HEADING)
+    try:
+        queued = await app.state.outbox.enqueue("low_stock_alert", emails, subject, html_body, OUTBOX_DEDUPE_SECONDS)
+    except Exception:
+        low_stock_alerts.restore_pending(low_stock)
+        raise
+    low_stock_alerts.mark_alerted([item["id"] for item in low_stock])
+    logger.info(f"Оповещение о низком запасе ({len(low_stock)} картриджей) поставлено в очередь для {queued} адресов")
 
 # Фоновая задача для очистки истекших сессий
-async def clean_expired_sessions_task(db):
+async def clean_expired_sessions_job(app):
     """
-    Очищает истекшие сессии каждый час
+    Очищает истекшие сессии в БД и в кэше
     """
-    while True:
-        try:
-            await asyncio.sleep(3600)  # Каждый час
-            await cleanup_expired_sessions(db)
-            logger.info("Истекшие сессии очищены")
-        except Exception as e:
-            logger.error(f"Ошибка при очистке сессий: {e}")
+    async with app.state.pool.write() as db:
+        await cleanup_expired_sessions(db)
+    session_cache.purge_expired()
+    logger.info("Истекшие сессии очищены")
+
+# Фоновая задача рассылки по расписанию
+async def send_scheduled_notifications_job(app):
+    """
+    Ставит в очередь письмо о низком запасе всем адресам с включенными уведомлениями
+    """
+    async with app.state.pool.reader() as db:
+        emails = await get_emails_for_notifications(db)
+        low_stock = await get_low_stock_cartridges(db) if emails else []
+
+    # Ставим в очередь уже после возврата соединения в пул
+    if emails and low_stock:
+        queued = await enqueue_low_stock_email(app, emails, low_stock)
+        logger.info(f"Автоматическое уведомление поставлено в очередь для {queued} адресов")
 
+    # Время запуска нужно, чтобы после перезапуска сервера догнать пропущенную рассылку
+    run_ts = str(int(time.time()))
 
-async def check_notification_schedule_task():
+    async def mark_op(db):
+        await set_setting(db, NOTIFICATION_LAST_RUN_KEY, run_ts)
+
+    await app.state.writer.submit(mark_op)
+
+
+def notification_trigger(enabled: bool, schedule: dict):
     """
-    Проверяет расписание отправки уведомлений каждую минуту
+    Расписание рассылки для планировщика
+
+    Args:
+        enabled: Глобальная настройка уведомлений
+        schedule: Результат get_notification_schedule (дни 0 - воскресенье ... 6 - суббота, время ЧЧ:ММ)
+
+    Returns:
+        WeeklyTrigger или None, если рассылка выключена или расписание не задано
     """
-    from datetime import datetime
-    
-    last_sent_date = None  # Отслеживаем дату последней отправки для предотвращения дублей
-    
-    while True:
-        try:
-            await asyncio.sleep(60)  # Проверяем каждую минуту
-            
-            async with aiosqlite.connect(DB_NAME) as db:
-                # Проверяем, включены ли уведомления глобально
-                enabled = await get_notifications_enabled(db)
-                if not enabled:
-                    continue  # Уведомления выключены
-                
-                schedule = await get_notification_schedule(db)
-                
-                if not schedule:
-                    continue  # Расписание не установлено
-                
-                current_time = datetime.now()
-                current_day = current_time.weekday()  # 0=Monday, 6=Sunday
-                current_time_hm = current_time.strftime("%H:%M")
-                
-                # Получаем список дней из строки
-                days_str = schedule["days_of_week"]
-                if not days_str:
-                    continue
-                
-                schedule_days = [int(d.strip()) for d in days_str.split(',')]
-                
-                # Преобразуем дни в weekday формат (0=Monday, 6=Sunday)
-                converted_days = []
-                for day in schedule_days:
-                    if day == 0:  # Воскресенье (0 в нашей системе)
-                        converted_days.append(6)
-                    else:
-                        converted_days.append(day - 1)
-                
-                schedule_time = schedule["time_hm"]
-                
-                # Проверяем совпадение дня недели и времени
-                if current_day in converted_days and current_time_hm == schedule_time:
-                    # Проверяем, что уведомление не отправлялось сегодня
-                    today_str = current_time.date().isoformat()
-                    if last_sent_date != today_str:
-                        # Отправляем уведомления
-                        emails = await get_emails_for_notifications(db)
-                        if emails:
-                            low_stock = await get_low_stock_cartridges(db)
-                            if low_stock:
-                                await send_low_stock_notifications(emails, low_stock)
-                                logger.info(f"Автоматическое уведомление отправлено {len(emails)} адресам")
-                        
-                        last_sent_date = today_str
-                
-        except Exception as e:
-            logger.error(f"Ошибка при проверке расписания уведомлений: {e}")
+    if not enabled or not schedule or not schedule["days_of_week"]:
+        return None
+    # Дни приложения (0 - воскресенье) в формат weekday (0 - понедельник)
+    weekdays = [(int(day.strip()) - 1) % 7 for day in schedule["days_of_week"].split(',')]
+    hour, minute = (int(part) for part in schedule["time_hm"].split(':'))
+    return WeeklyTrigger(weekdays, hour, minute)
+
+
+async def reload_notification_schedule(app, catch_up: bool = False):
+    """
+    Перечитывает расписание рассылки из БД и передает его планировщику
+
+    Вызывается при старте и после изменения расписания или глобальной настройки уведомлений.
+
+    Args:
+        catch_up: Догнать рассылку, пропущенную пока сервер не работал (только при старте:
+                  новое расписание с уже прошедшим сегодня временем не должно срабатывать сразу)
+    """
+    async with app.state.pool.reader() as db:
+        enabled = await get_notifications_enabled(db)
+        schedule = await get_notification_schedule(db)
+        last_run = await get_setting(db, NOTIFICATION_LAST_RUN_KEY) if catch_up else None
+    try:
+        trigger = notification_trigger(enabled, schedule)
+    except ValueError as e:
+        logger.error(f"Неверное расписание уведомлений {schedule}: {e}")
+        trigger = None
+    app.state.scheduler.reschedule("notifications", trigger, int(last_run) if last_run else None)
+    job = app.state.scheduler.jobs["notifications"]
+    if job.next_run_ts:
+        logger.info(f"Следующая рассылка уведомлений: {datetime.fromtimestamp(job.next_run_ts):%Y-%m-%d %H:%M}")
 
 
 ###################################### LIFESPAN, код выполняемый до и после запуска uvicorn в main ###################
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Установка соединения с базой
+    # Установка соединения с базой: писатель сразу, читатели после инициализации таблиц
     try:
-        app.state.db = await aiosqlite.connect(DB_NAME)
+        app.state.pool = DatabasePool(DB_NAME, DB_READERS, DB_ACQUIRE_TIMEOUT)
+        app.state.db = await app.state.pool.open_writer()
         logger.info("Соединение с БД установлено.")
         # Закидываем состояние в короткую переменную
         db = app.state.db
@@ -187,25 +424,91 @@ async def lifespan(app: FastAPI):
 
     # Запускаем инициализацию бд
     await init_database(db)
-
-    # Запуск функции периодической очистки сета айдишников запросов от ТСД
-    asyncio.create_task(clean_ids_task())
-    
-    # Запуск функции периодической очистки истекших сессий
-    asyncio.create_task(clean_expired_sessions_task(db))
-    
-    # Запуск функции проверки расписания отправки уведомлений
-    asyncio.create_task(check_notification_schedule_task())
+    # Однократное заполнение сводных таблиц расхода для аналитики (до запуска писателя)
+    if await backfill_consumption_rollups(db, list_history_archives(HISTORY_ARCHIVE_DIR)):
+        logger.info("Сводные таблицы расхода заполнены из истории.")
+    # Однократный перенос текстовых editor из истории в справочник устройств
+    if await migrate_history_devices(db):
+        logger.info("Справочник устройств заполнен из истории.")
+    await app.state.pool.open_readers()
+    metrics.register_stats("cartridge_db_pool", "Пул соединений с БД", app.state.pool.stats)
+
+    # Загружаем индекс штрихкодов в память
+    barcode_index.load(await get_all_barcodes(db))
+    logger.info(f"Индекс штрихкодов загружен. Записей: {len(barcode_index)}")
+    device_registry.load(await get_all_devices(db))
+
+    # Текущая версия каталога из журнала изменений
+    catalog_cache.version = await get_catalog_version(db)
+
+    # Писатель с групповым коммитом для /scan и PATCH остатков
+    app.state.writer = WriteCoalescer(db, WRITE_BATCH_MAX_SIZE, WRITE_BATCH_MAX_WAIT_MS,
+                                      lock=app.state.pool.write_lock)
+    await app.state.writer.start()
+    metrics.register_stats("cartridge_writer", "Групповой коммит", app.state.writer.stats)
+
+    # Рассыльщик очереди писем: эндпоинты и расписание только ставят письма в outbox
+    app.state.outbox = OutboxWorker(
+        app.state.pool, app.state.writer, deliver_email,
+        concurrency=OUTBOX_CONCURRENCY, batch_recipients=EMAIL_BATCH_RECIPIENTS,
+        max_recipients=EMAIL_BATCH_MAX_RECIPIENTS, max_attempts=OUTBOX_MAX_ATTEMPTS,
+        backoff_base=OUTBOX_BACKOFF_BASE_SECONDS, backoff_max=OUTBOX_BACKOFF_MAX_SECONDS,
+        poll_seconds=OUTBOX_POLL_SECONDS, retention_days=OUTBOX_RETENTION_DAYS
+    )
+    await app.state.outbox.start()
+    metrics.register_stats("cartridge_outbox", "Очередь писем", app.state.outbox.stats)
+
+    # Фоновые задачи: один планировщик вместо отдельных циклов со sleep
+    scheduler = app.state.scheduler = Scheduler(SCHEDULER_MAX_SLEEP_SECONDS)
+    scheduler.add("barcode_index_verify", "сверка индекса штрихкодов",
+                  lambda: verify_barcode_index_job(app), IntervalTrigger(BARCODE_INDEX_VERIFY_SECONDS))
+    scheduler.add("device_stats_flush", "сохранение счетчиков устройств",
+                  lambda: flush_device_stats(app.state.writer), IntervalTrigger(DEVICE_STATS_FLUSH_SECONDS))
+    scheduler.add("catalog_changes_compact", "компактирование журнала изменений каталога",
+                  lambda: compact_catalog_changes_job(app), IntervalTrigger(CATALOG_CHANGES_COMPACT_SECONDS))
+    scheduler.add("scan_results_purge", "очистка результатов пакетных сканов",
+                  lambda: purge_scan_results_job(app), IntervalTrigger(SCAN_RESULTS_PURGE_SECONDS))
+    scheduler.add("history_archive", "архивирование журнала операций",
+                  lambda: archive_history_job(app), IntervalTrigger(HISTORY_ARCHIVE_CHECK_SECONDS))
+    # Сжатие старого журнала только если включено
+    if HISTORY_COMPACT_ENABLED:
+        scheduler.add("history_compact", "сжатие журнала операций",
+                      lambda: compact_history_job(app), IntervalTrigger(HISTORY_COMPACT_CHECK_SECONDS))
+    # Оповещения о переходе ниже минимума: накопленные за окно переходы уходят одним письмом
+    if LOW_STOCK_ALERTS_ENABLED:
+        scheduler.add("low_stock_alerts", "оповещение о низком запасе",
+                      lambda: send_low_stock_alerts_job(app), IntervalTrigger(LOW_STOCK_ALERT_WINDOW_SECONDS))
+    scheduler.add("sessions_cleanup", "очистка истекших сессий",
+                  lambda: clean_expired_sessions_job(app), IntervalTrigger(SESSION_CLEANUP_SECONDS))
+    # Рассылка по расписанию из настроек: время задается при загрузке и при изменении расписания
+    scheduler.add("notifications", "рассылка уведомлений по расписанию",
+                  lambda: send_scheduled_notifications_job(app), catch_up_seconds=NOTIFICATION_CATCH_UP_SECONDS)
+    await reload_notification_schedule(app, catch_up=True)
+    await scheduler.start()
 
     yield
     # Логика при остановке
 
-    await db.close()
+    event_broker.close()
+    await flush_device_stats(app.state.writer)
+    # Планировщик и рассыльщик останавливаются до писателя: их записи идут через него
+    await app.state.scheduler.stop()
+    await app.state.outbox.stop()
+    await app.state.writer.stop()
+    # Дожидаемся идущей рассылки и закрываем SMTP сессии в отдельном потоке, чтобы не блокировать цикл событий
+    await asyncio.to_thread(shutdown_mailer)
+    await app.state.pool.close()
     logger.info(f"Соединение с БД закрыто.")
 
 ############################################# FastAPI, объект app #######################################################
 app = FastAPI(lifespan=lifespan)
 
+# Все читатели заняты дольше таймаута - отвечаем 503, клиент может повторить запрос
+@app.exception_handler(PoolTimeoutError)
+async def pool_timeout_handler(request: Request, exc: PoolTimeoutError):
+    logger.warning(f"{request.url.path} - 'Нет свободных соединений с БД'")
+    return PlainTextResponse("Service Unavailable", status_code=503)
+
 # Middleware для проверки сессий
 @app.middleware("http")
 async def session_middleware(request: Request, call_next):
@@ -220,10 +523,20 @@ async def session_middleware(request: Request, call_next):
         if not session_id:
             return PlainTextResponse("Unauthorized", status_code=401)
         
-        db = request.app.state.db
-        session = await get_session(db, session_id)
-        if not session:
-            return PlainTextResponse("Unauthorized", status_code=401)
+        # Сначала кэш сессий, в базу идем только при промахе
+        session = session_cache.get(session_id)
+        if session is None:
+            try:
+                async with request.app.state.pool.reader() as db:
+                    session = await get_session(db, session_id)
+            except PoolTimeoutError:
+                return PlainTextResponse("Service Unavailable", status_code=503)
+            if not session:
+                return PlainTextResponse("Unauthorized", status_code=401)
+            session_cache.put(session_id, *session)
+
+        # Обработчики берут пользователя отсюда и не запрашивают сессию повторно
+        request.state.user_dn = session[0]
     
     response = await call_next(request)
     return response
@@ -262,19 +575,68 @@ class SettingUpdateRequest(BaseModel):
     value: str
 
 
+def get_client_info(request: Request):
+    """
+    Информация о клиенте для журнала операций
+
+    Returns:
+        Кортеж (client_host, platform, editor), editor - строка вида "Platform: Windows       10.0.0.5"
+    """
+    client_host = request.client.host
+    user_agent = request.headers.get("User-Agent") or ""
+    platform = "Windows" if "Windows" in user_agent else "Mobile/Other"
+    return client_host, platform, f"Platform: {platform:<14}{client_host}"
+
+
+async def resolve_device(request: Request, client_host: str, platform: str, editor: str) -> int:
+    """
+    Находит устройство в справочнике, новое заводит в БД отдельной операцией писателя
+
+    Returns:
+        ID устройства для history.device_id
+    """
+    device_id = device_registry.get(editor)
+    if device_id is None:
+        first_seen = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+        async def device_op(db):
+            return await create_device(db, editor, platform, client_host, first_seen)
+
+        device_id = await request.app.state.writer.submit(device_op)
+        device_registry.add(editor, device_id)
+    return device_id
+
+
 ############################################# API для аутентификации ##################################################
+def get_request_username(request: Request):
+    """
+    Имя пользователя текущего запроса из сессии, которую разобрал session_middleware
+
+    Returns:
+        Имя пользователя (из "cn=username,..." берется username) или None
+    """
+    user_dn = getattr(request.state, "user_dn", None)
+    if not user_dn:
+        return None
+    # Извлекаем имя пользователя из DN (например, "cn=username" -> "username")
+    if "cn=" in user_dn:
+        return user_dn.split("cn=")[1].split(",")[0]
+    return user_dn
+
+
 @app.post("/api/v1/login")
 async def login(data: LoginRequest, request: Request):
-    from fastapi.responses import Response
-    db = request.app.state.db
-    
     # Проверяем пользователя через выбранный метод аутентификации
     success, user_dn = authenticate_user(data.username, data.password, data.auth_type)
     if not success:
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
-    # Создаем сессию
-    session_id = await create_session(db, user_dn)
+    # Создаем сессию через писателя, как и любую другую запись
+    async def session_op(db):
+        return await create_session(db, user_dn)
+
+    session_id, expires_at = await request.app.state.writer.submit(session_op)
+    session_cache.put(session_id, user_dn, expires_at)
     
     # Устанавливаем куку с session_id
     response = Response("Login successful")
@@ -286,8 +648,12 @@ async def login(data: LoginRequest, request: Request):
 async def logout(request: Request):
     session_id = request.cookies.get("session_id")
     if session_id:
-        db = request.app.state.db
-        await delete_session(db, session_id)
+        session_cache.invalidate(session_id)
+
+        async def logout_op(db):
+            await delete_session(db, session_id)
+
+        await request.app.state.writer.submit(logout_op)
     
     response = PlainTextResponse("Logged out")
     response.delete_cookie("session_id")
@@ -296,45 +662,78 @@ async def logout(request: Request):
 
 @app.get("/api/v1/me")
 async def get_me(request: Request):
-    session_id = request.cookies.get("session_id")
-    if not session_id:
+    # Сессию уже проверил и положил в request.state session_middleware
+    user_dn = getattr(request.state, "user_dn", None)
+    if not user_dn:
         raise HTTPException(status_code=401, detail="Unauthorized")
-    
-    db = request.app.state.db
-    session = await get_session(db, session_id)
-    if not session:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-    
-    user_dn, _ = session
     return {"user_dn": user_dn}
 
 
 ############################################# API для ТСД ##############################################################
+EXPIRED_REQUEST_MSG = "Ошибка: Запрос просрочен!"
+REPEATED_REQUEST_MSG = "Ошибка: Повторный запрос!"
+
+# Исходы обработки сканов для мониторинга
+SCAN_OUTCOMES = metrics.counter(
+    "cartridge_scan_requests_total",
+    "Обработанные запросы /scan по исходу",
+    ("outcome",)
+)
+
+def check_replay(req_id, req_time):
+    """
+    Проверяет запрос от ТСД на "протухание" и повтор, и запоминает его ID
+
+    Args:
+        req_id: уникальный ID запроса, сформированный ТСД
+        req_time: время формирования запроса на ТСД (unix time)
+
+    Returns:
+        Текст ошибки для ответа ТСД или None, если запрос можно обрабатывать
+    """
+    now = int(time.time())
+    # Меньше 10 секунд лучше не ставить, иначе если на тсдшнике быстро спамить запросами на серв,
+    # тсд будет получать ответ о том, что он запросы шлет просроченные.
+    # Скорее всего это проблема в сетевой задержке и дрейфе времени на разных устройствах.
+    if abs(now - req_time) > REPLAY_WINDOW_SECONDS:
+        return EXPIRED_REQUEST_MSG
+
+    # Если не дропнули такой запрос, то этот пакет 100% от ТСД, айдишник запоминается в кэше
+    if not processed_requests.check_and_add(req_id, req_time, now):
+        return REPEATED_REQUEST_MSG
+    return None
+
+
 @app.post("/scan")
 # Объект data класса ScanRequest будет заполняться данными из тела запроса
 # C помощью Request получим состояние БД 
 async def apiprocess_scan(data: ScanRequest, request: Request):
+    # Засекаем стадии обработки для /metrics
+    timer = StageTimer("scan")
+
+    def respond(msg: str, status_code: int, outcome: str):
+        # Шифрует ответ, записывает время шифрования, общее время и исход запроса
+        body = encrypt_payload(msg)
+        timer.mark("encrypt")
+        timer.finish()
+        SCAN_OUTCOMES.inc(outcome)
+        return PlainTextResponse(body, status_code=status_code)
+
     # Собираем инфу о клиенте из request
-    client_host = request.client.host
-    user_agent = request.headers.get("User-Agent")
-    os_info = "Platform: Windows       " if "Windows" in user_agent else "Platform: Mobile/Other  "
-    client_info = os_info + client_host
-    # Получаем объект базы
-    db = request.app.state.db
+    client_host, platform, client_info = get_client_info(request)
 
     # Отправляем в дешифратор абракадабру, которая должна быть расшифрована в JSON-строки
     decrypted_json_str = decrypt_payload(data.payload)
+    timer.mark("decrypt")
 
     # Если функция дешифратор ничего не вернула..
     if not decrypted_json_str:
-        return PlainTextResponse(
-            encrypt_payload("Ошибка: AES-Ключ не совпадал на сервере или пакет поврежден!"),
-            status_code=status.HTTP_400_BAD_REQUEST
-        )
+        return respond("Ошибка: AES-Ключ не совпадал на сервере или пакет поврежден!", status.HTTP_400_BAD_REQUEST, "400_bad_payload")
 
     # Если расшифровалась, парсим полученный json
     try:
         inner_data = json.loads(decrypted_json_str)
+        timer.mark("parse")
         # ТСДшник формирует уникальный ID у каждого запроса
         req_id = inner_data.get('id')
         # ТСДшник передает время, когда было сформировано тело запроса
@@ -343,25 +742,18 @@ async def apiprocess_scan(data: ScanRequest, request: Request):
         # Защита от Reply-атаки:
         # Изначальная проблема: содержимое пакета (в виде {payload: base64} ) можно стащить снифером и отправить серверу опять.
         # Гениальное и удивительно простое решение!
-        # Полученный пакет действителен 10 секунд с момента генерации и только если его НЕТ в сете processed_requests.
+        # Полученный пакет действителен 10 секунд с момента генерации и только если его НЕТ в кэше processed_requests.
         # Кул-хацкер может успеть за 10 секунд скопировать содержимое пакета и отправить серверу еще раз, 
         # но сервер этот пакет уже обработал и занёс айдишник из тела json в processed_requests.
-        # processed_requests чистится, поэтому дополнительно нужна еще и проверка на время (10 секунд), 
-        # чтобы нельзя было отправить "протухшие" запросы через время, когда в processed_requests этого айдишника не будет.
+        # processed_requests помнит айдишники только в пределах окна свежести, поэтому проверка на время (10 секунд)
+        # обязательна: "протухшие" запросы отсекаются по времени, а свежие повторы - по кэшу.
         
-        now = int(time.time())
-        # Меньше 10 секунд лучше не ставить, иначе если на тсдшнике быстро спамить запросами на серв,
-        # тсд будет получать ответ о том, что он запросы шлет просроченные.
-        # Скорее всего это проблема в сетевой задержке и дрейфе времени на разных устройствах.
-        if abs(now - req_time) > 10:
+        replay_error = check_replay(req_id, req_time)
+        timer.mark("replay_check")
+        if replay_error:
             # Шифро-ответ можно вообще не отправлять на такие "приколы", но пусть будет для наглядности
-            return PlainTextResponse(encrypt_payload("Ошибка: Запрос просрочен!"), status_code=403)
-        
-        if req_id in processed_requests:
-            return PlainTextResponse(encrypt_payload("Ошибка: Повторный запрос!"), status_code=403)
-
-        # Если не дропнули такой запрос, то этот пакет 100% от ТСД, заносим айдишник в сет 
-        processed_requests.add(req_id)
+            outcome = "403_expired" if replay_error == EXPIRED_REQUEST_MSG else "403_replay"
+            return respond(replay_error, 403, outcome)
 
         # Продолжаем обработку нормального запроса
         # ТСД присылает 'barcode': '1234567891111'
@@ -369,48 +761,196 @@ async def apiprocess_scan(data: ScanRequest, request: Request):
         # ТСД присылает 'action': 'add' или 'red'
         req_action = inner_data.get('action') 
         
-        # Ищем штрихкод
-        row = await get_cartridge_by_barcode(db, req_barcode)
-        if not row:
-            # Устанавливаем код 404 (Not Found)
-            msg = f"Штрихкод {req_barcode} не привязан!"
-            return PlainTextResponse(encrypt_payload(msg), status_code=status.HTTP_404_NOT_FOUND)
-
-        # Берем id по этому штрихкоду
-        cartridge_id = row[0]
+        # Ищем штрихкод в индексе, промах перепроверяем читателем: привязка могла появиться после сверки индекса
+        cartridge_id = barcode_index.get(req_barcode)
+        if cartridge_id is None:
+            async with request.app.state.pool.reader() as db:
+                row = await get_cartridge_by_barcode(db, req_barcode)
+            if row is None:
+                timer.mark("lookup")
+                # Устанавливаем код 404 (Not Found)
+                return respond(f"Штрихкод {req_barcode} не привязан!", status.HTTP_404_NOT_FOUND, "404_unbound")
+            cartridge_id = row[0]
+            barcode_index.add(req_barcode, cartridge_id)
+        timer.mark("lookup")
 
         # Текущее время
         current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        # Устройство из справочника в памяти, в базу только при первом скане с нового ТСД
+        device_id = await resolve_device(request, client_host, platform, client_info)
+
+        delta = 1 if req_action == 'add' else -1
+
+        # Вся работа с базой уходит писателю одной операцией, коммит общий с соседними запросами
+        async def scan_op(db):
+            # Поиск по штрихкоду, изменение остатка и чтение нового остатка - один UPDATE ... RETURNING
+            update_started = time.perf_counter()
+            row = await apply_scan(db, req_barcode, delta, client_info, current_time, device_id)
+            STAGE_SECONDS.observe(time.perf_counter() - update_started, "scan", "update")
+            if row:
+                version = await record_catalog_change(db, row[0], 'upsert', current_time)
+                return status.HTTP_200_OK, row[0], row[1], row[2], row[3], version
+
+            # Холодный путь: выясняем, почему скан не применился
+            if not await get_cartridge_by_barcode(db, req_barcode):
+                return status.HTTP_404_NOT_FOUND, cartridge_id, None, None, None, None
+            return status.HTTP_409_CONFLICT, cartridge_id, None, None, None, None
+
+        status_code, cartridge_id, name, new_stock, min_qty, version = await request.app.state.writer.submit(scan_op)
+        # Ожидание в очереди писателя + UPDATE + групповой коммит
+        timer.mark("write")
+
+        if status_code == status.HTTP_404_NOT_FOUND:
+            barcode_index.remove(req_barcode, cartridge_id)
+            # Устанавливаем код 404 (Not Found)
+            return respond(f"Штрихкод {req_barcode} не привязан!", status.HTTP_404_NOT_FOUND, "404_unbound")
+
+        if status_code == status.HTTP_409_CONFLICT:
+            return respond("Ошибка: Остаток не может быть меньше нуля!", status.HTTP_409_CONFLICT, "409_below_zero")
+
+        publish_stock_change(version, cartridge_id, name, new_stock)
+        device_registry.touch(device_id, current_time, int(time.time()), scans=1)
+        # Переход через минимум видно по старому и новому остатку из того же UPDATE
+        if crossed_below_min(new_stock - delta, new_stock, min_qty, min_qty):
+            low_stock_alerts.note(cartridge_id, name, new_stock, min_qty)
 
-        # Обновляем количество +1 в таблице cartridges
-        if req_action == 'add':
-            await update_cartridge_quantity_add(db, cartridge_id)
-        # Обновляем количество -1 в таблице cartridges
-        else:
-            cursor = await update_cartridge_quantity_subtract(db, cartridge_id)
-            if cursor.rowcount == 0:
-                msg = "Ошибка: Остаток не может быть меньше нуля!"
-                return PlainTextResponse(encrypt_payload(msg), status_code=status.HTTP_409_CONFLICT)
-                  
-        # Получаем новый остаток и имя для ответа
-        result = await get_cartridge_name_and_quantity(db, cartridge_id)
-        name, new_stock = result
-
-        # Обновление таблицы с историей
         if req_action == 'add':
-            await add_history_record(db,cartridge_id,name,1,client_info,current_time)
             logger.info(f"{client_host}   - 'TSD  ID: {cartridge_id} | Имя: {name} | Дельта:  1 | Кол-во: {new_stock}'")
         else:
-            await add_history_record(db,cartridge_id,name,-1,client_info,current_time)
             logger.info(f"{client_host}   - 'TSD  ID: {cartridge_id} | Имя: {name} | Дельта: -1 | Кол-во: {new_stock}'")
 
-        await commit_changes(db)
-
         # Шифро-ответ ТСД: запрос обработан
-        return PlainTextResponse(encrypt_payload(f"Имя: {name}\nШтрих-код:{req_barcode}\nОстаток: {new_stock}"), status_code=status.HTTP_200_OK)
+        return respond(f"Имя: {name}\nШтрих-код:{req_barcode}\nОстаток: {new_stock}", status.HTTP_200_OK, "200")
 
     except Exception as e:
         # Шифро-ответ ТСД: непонятный косяк на сервере
+        return respond("Непредвиденная критическая ошибка сервера!", status.HTTP_500_INTERNAL_SERVER_ERROR, "500_error")
+
+@app.post("/scan/batch")
+# Пакетная загрузка накопленных сканов: ТСД после потери Wi-Fi отправляет всю очередь одним запросом.
+# Расшифрованный payload: {"id": ..., "time": ..., "scans": [{"id": ..., "barcode": ..., "action": ..., "time": ...}, ...]}
+# Защита от повтора работает по id/time всего пакета, сканы внутри пакета применяются одной транзакцией.
+# Результат каждого примененного скана с id запоминается в scan_results: при повторной отправке очереди
+# в новом пакете он не применяется второй раз, а возвращает свой прежний результат.
+# Отказы (404, 409) не запоминаются: после привязки штрихкода или прихода скан применится.
+async def apiprocess_scan_batch(data: ScanRequest, request: Request):
+    client_host, platform, client_info = get_client_info(request)
+
+    decrypted_json_str = decrypt_payload(data.payload)
+    if not decrypted_json_str:
+        return PlainTextResponse(
+            encrypt_payload("Ошибка: AES-Ключ не совпадал на сервере или пакет поврежден!"),
+            status_code=status.HTTP_400_BAD_REQUEST
+        )
+
+    try:
+        inner_data = json.loads(decrypted_json_str)
+        scans = inner_data.get('scans')
+        if not isinstance(scans, list) or not scans:
+            return PlainTextResponse(encrypt_payload("Ошибка: Пакет не содержит сканов!"), status_code=status.HTTP_400_BAD_REQUEST)
+        if len(scans) > SCAN_BATCH_MAX_ITEMS:
+            msg = f"Ошибка: В пакете больше {SCAN_BATCH_MAX_ITEMS} сканов!"
+            return PlainTextResponse(encrypt_payload(msg), status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        replay_error = check_replay(inner_data.get('id'), inner_data.get('time', 0))
+        if replay_error:
+            return PlainTextResponse(encrypt_payload(replay_error), status_code=403)
+
+        now = int(time.time())
+        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        device_id = await resolve_device(request, client_host, platform, client_info)
+        results = []
+        history_rows = []
+        seen_ids = set()
+        # По каждому картриджу в поток изменений уходит одно событие с итоговым остатком
+        final_stock = {}
+        # Картриджи, ушедшие ниже минимума внутри пакета
+        crossings = []
+        # Привязанные штрихкоды, которых не было в индексе
+        learned = []
+
+        # Весь пакет - одна операция писателя: применяется целиком в одной транзакции
+        async def batch_op(db):
+            # Сканы, примененные раньше другим пакетом (ТСД не получил ответ и отправил очередь повторно)
+            known = await get_scan_results(db, list({
+                str(item['id']) for item in scans if isinstance(item, dict) and item.get('id') is not None
+            }))
+            for item in scans:
+                # Валидация отдельного скана, ошибка в одном скане не отменяет остальные
+                if not isinstance(item, dict):
+                    results.append({"id": None, "status": 400, "message": "Неверный формат скана"})
+                    continue
+
+                item_id = item.get('id')
+                item_barcode = item.get('barcode')
+                item_action = item.get('action')
+                item_time = item.get('time')
+
+                # ID сравниваются строками, как они хранятся в scan_results: 1 и "1" - один и тот же скан
+                item_key = str(item_id) if item_id is not None else None
+                if item_key is not None and item_key in seen_ids:
+                    results.append({"id": item_id, "status": 409, "message": "Скан повторяется в пакете"})
+                    continue
+                seen_ids.add(item_key)
+
+                if item_key in known:
+                    results.append(known[item_key])
+                    continue
+
+                if not isinstance(item_barcode, str) or not item_barcode or item_action not in ('add', 'red'):
+                    results.append({"id": item_id, "status": 400, "message": "Неверный штрихкод или действие"})
+                    continue
+
+                # Время скана на ТСД попадает в историю, если оно адекватное (не из будущего)
+                scan_time = current_time
+                if isinstance(item_time, int) and 0 < item_time <= now + 10:
+                    scan_time = datetime.fromtimestamp(item_time).strftime('%Y-%m-%d %H:%M:%S')
+
+                # Индекс здесь только подсказка: UPDATE на писателе сам проверяет привязку по БД
+                indexed = barcode_index.get(item_barcode) is not None
+
+                delta = 1 if item_action == 'add' else -1
+                row = await apply_scan_delta(db, item_barcode, delta)
+                if row and not indexed:
+                    learned.append((item_barcode, row[0]))
+                if not row:
+                    if not await get_cartridge_by_barcode(db, item_barcode):
+                        results.append({"id": item_id, "status": 404, "message": f"Штрихкод {item_barcode} не привязан!"})
+                    else:
+                        results.append({"id": item_id, "status": 409, "message": "Ошибка: Остаток не может быть меньше нуля!"})
+                    continue
+                cartridge_id, name, new_stock, min_qty = row
+                if crossed_below_min(new_stock - delta, new_stock, min_qty, min_qty):
+                    crossings.append((cartridge_id, name, new_stock, min_qty))
+                history_rows.append((cartridge_id, name, delta, client_info, None, scan_time, device_id))
+                final_stock[cartridge_id] = (name, new_stock)
+                results.append({"id": item_id, "status": 200, "name": name, "barcode": item_barcode, "quantity": new_stock})
+
+            # Вся история пакета пишется одним executemany
+            await add_history_records(db, history_rows)
+            # В той же транзакции запоминаем примененные сканы: повтор не применит их, даже если ответ потерялся
+            await save_scan_results(db, [result for result in results if result["status"] == 200], now)
+            # В журнал каталога - одна запись на каждый измененный картридж
+            for cartridge_id, (name, quantity) in final_stock.items():
+                version = await record_catalog_change(db, cartridge_id, 'upsert', current_time)
+                final_stock[cartridge_id] = (name, quantity, version)
+
+        await request.app.state.writer.submit(batch_op)
+        for barcode, cartridge_id in learned:
+            barcode_index.add(barcode, cartridge_id)
+        for cartridge_id, (name, quantity, version) in final_stock.items():
+            publish_stock_change(version, cartridge_id, name, quantity)
+        if history_rows:
+            device_registry.touch(device_id, current_time, now, scans=len(history_rows))
+        for cartridge_id, name, quantity, min_qty in crossings:
+            low_stock_alerts.note(cartridge_id, name, quantity, min_qty)
+
+        logger.info(f"{client_host}   - 'TSD  Пакет: {len(scans)} сканов | Применено: {len(history_rows)}'")
+
+        return PlainTextResponse(encrypt_payload(json.dumps(results, ensure_ascii=False)), status_code=status.HTTP_200_OK)
+
+    except Exception as e:
+        logger.error(f"Ошибка при обработке пакета сканов: {e}")
         return PlainTextResponse(encrypt_payload("Непредвиденная критическая ошибка сервера!"), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 ############################################# API для браузеров #########################################################
@@ -421,82 +961,244 @@ async def api_get_trap_page():
 
 # Клиент при отправке get на сервак получает index.html вместе со скриптом app.js.
 # app.js выполняется клиентом и отпр get запрос к api-сервера /api/v1/cartridges 
+# Ответ кэшируется по версии каталога: повторные обновления дашборда получают 304 или готовый JSON.
+# С параметром since=N отдаются только картриджи, изменившиеся после версии N (см. api_get_catalog_delta)
 @app.get("/api/v1/cartridges")
-async def api_get_all_cartridges(request: Request):
-    # Дергаем "сохраненное" состояние подключения к базе
-    db = request.app.state.db
+async def api_get_all_cartridges(request: Request, since: Optional[int] = None):
+    if since is not None:
+        return await api_get_catalog_delta(request, since)
+
+    timer = StageTimer("cartridges")
+    headers = {"ETag": catalog_cache.etag(), "Cache-Control": "no-cache"}
+    if catalog_cache.matches(request.headers.get("if-none-match")):
+        timer.finish()
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    # Версию запоминаем до запроса: изменения во время чтения не попадут в кэш под старой версией
+    version = catalog_cache.version
+    body = catalog_cache.get(version)
+    if body is None:
+        # Каталог читаем на соединении-читателе, чтобы не тормозить сканы
+        async with request.app.state.pool.reader() as db:
+            cartridges = await get_all_cartridges(db)
+        timer.mark("query")
+        body = json.dumps(cartridges, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        catalog_cache.put(version, body)
+        timer.mark("serialize")
+    timer.finish()
+    headers["ETag"] = catalog_cache.etag(version)
+    # Версия, с которой клиент потом может запрашивать изменения через since
+    headers["X-Catalog-Version"] = str(version)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+async def api_get_catalog_delta(request: Request, since: int):
+    """
+    Изменения каталога после версии since по журналу catalog_changes
+
+    Returns:
+        {"version": новая версия, "full": False, "upserted": [картриджи], "deleted": [ID]}.
+        Если журнал уже компактирован дальше since (или since из будущего), каталог отдается
+        целиком с "full": True - клиент должен заменить свою копию, а не дополнить ее.
+    """
+    timer = StageTimer("cartridges_delta")
+    # Ничего не изменилось - отвечаем без обращения к БД
+    if since == catalog_cache.version:
+        timer.finish()
+        return {"version": since, "full": False, "upserted": [], "deleted": []}
+
+    async with request.app.state.pool.reader() as db:
+        version = await get_catalog_version(db)
+        if since < await get_catalog_floor(db) or since > version:
+            cartridges = await get_all_cartridges(db)
+            timer.mark("query")
+            timer.finish()
+            return {"version": version, "full": True, "upserted": cartridges, "deleted": []}
+
+        changes = await get_catalog_changes(db, since)
+        changed_ids = [cartridge_id for cartridge_id, _ in changes]
+        upserted = await get_cartridges_by_ids(db, changed_ids)
+    timer.mark("query")
+
+    # Изменения, закоммиченные между чтениями, тоже попали в ответ - версия берется по ним
+    if changes:
+        version = max(version, changes[-1][1])
+    existing_ids = {item["id"] for item in upserted}
+    deleted = [cartridge_id for cartridge_id in changed_ids if cartridge_id not in existing_ids]
+    timer.finish()
+    return {"version": version, "full": False, "upserted": upserted, "deleted": deleted}
+
+
+def encode_catalog_cursor(sort: str, order: str, key: tuple) -> str:
+    """Курсор следующей страницы: сортировка и ключ (значение сортировки, id) последней строки"""
+    value, last_id = key
+    raw = json.dumps([sort, order, value, last_id], ensure_ascii=False, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_catalog_cursor(cursor: str, sort: str, order: str):
+    """
+    Разбирает курсор страницы каталога
 
-    cartridges = await get_all_cartridges(db)
-    return cartridges
+    Returns:
+        Ключ (значение сортировки, id)
+
+    Raises:
+        HTTPException 400: курсор поврежден или выдан для другой сортировки
+    """
+    try:
+        cursor_sort, cursor_order, value, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        if not isinstance(last_id, int):
+            raise ValueError("id")
+    except Exception:
+        raise HTTPException(status_code=400, detail="Неверный курсор страницы")
+    if cursor_sort != sort or cursor_order != order:
+        raise HTTPException(status_code=400, detail="Курсор выдан для другой сортировки")
+    return value, last_id
+
+
+# Постраничный каталог для больших баз: фильтры и сортировка на сервере, keyset-пагинация по курсору
+@app.get("/api/v1/cartridges/page")
+async def api_get_cartridges_page(
+    request: Request,
+    limit: int = CATALOG_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    q: Optional[str] = None,
+    low_stock: bool = False,
+    has_barcode: bool = False,
+    sort: str = "name",
+    order: str = "asc"
+):
+    """
+    Возвращает страницу каталога
+
+    Returns:
+        {"items": [картриджи], "next_cursor": курсор следующей страницы или None, "version": версия каталога}
+    """
+    if sort not in CATALOG_SORT_COLUMNS:
+        raise HTTPException(status_code=400, detail="Неверное поле сортировки")
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="Неверный порядок сортировки")
+    limit = max(1, min(limit, CATALOG_PAGE_MAX_SIZE))
+    after = decode_catalog_cursor(cursor, sort, order) if cursor else None
+
+    timer = StageTimer("cartridges_page")
+    # Версию запоминаем до запроса, как и для полного каталога
+    version = catalog_cache.version
+    async with request.app.state.pool.reader() as db:
+        items, next_key = await get_cartridges_page(
+            db, limit, sort, order == "desc", after, (q or "").strip(), low_stock, has_barcode
+        )
+    timer.mark("query")
+    timer.finish()
+
+    next_cursor = encode_catalog_cursor(sort, order, next_key) if next_key else None
+    return {"items": items, "next_cursor": next_cursor, "version": version}
+
+@app.get("/api/v1/cartridges/low-stock")
+async def api_get_low_stock(request: Request):
+    """
+    Возвращает картриджи с остатком меньше минимума (по частичному индексу, без чтения всего каталога)
+
+    Returns:
+        {"items": [картриджи], "count": сколько картриджей, "out_of_stock": сколько закончились совсем,
+         "shortage": сколько штук не хватает до минимума всего, "version": версия каталога}
+    """
+    timer = StageTimer("cartridges_low_stock")
+    version = catalog_cache.version
+    async with request.app.state.pool.reader() as db:
+        items = await get_low_stock_items(db)
+    timer.mark("query")
+    timer.finish()
+    return {
+        "items": items,
+        "count": len(items),
+        "out_of_stock": sum(1 for item in items if item["quantity"] == 0),
+        "shortage": sum(item["min_qty"] - item["quantity"] for item in items),
+        "version": version
+    }
+
+# Поток изменений каталога для открытых дашбордов (Server-Sent Events).
+# Путь под /api/, поэтому доступ только с сессией, как и у самого каталога.
+@app.get("/api/v1/events")
+async def api_stream_events(request: Request):
+    subscriber = event_broker.subscribe()
+    return StreamingResponse(
+        stream_events(subscriber, event_broker, request.is_disconnected, EVENTS_HEARTBEAT_SECONDS),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @app.patch("/api/v1/cartridges/{cartridge_id}/stock")
 async def api_patch_cartridge_quantity(cartridge_id: int, payload: StockChange, request: Request):
     # Собираем инфу о клиенте из request
-    client_host = request.client.host
-    user_agent = request.headers.get("User-Agent")
-    os_info = "Platform: Windows       " if "Windows" in user_agent else "Platform: Mobile/Other  "
-    client_info = os_info + client_host
-    # Дергаем "сохраненное" состояние подключения к базе
-    db = request.app.state.db
-
+    client_host, platform, client_info = get_client_info(request)
     # Получаем имя пользователя из сессии
-    session_id = request.cookies.get("session_id")
-    username = None
-    if session_id:
-        session_data = await get_session(db, session_id)
-        if session_data:
-            user_dn = session_data[0]
-            # Извлекаем имя пользователя из DN
-            if "cn=" in user_dn:
-                username = user_dn.split("cn=")[1].split(",")[0]
-            else:
-                username = user_dn
+    username = get_request_username(request)
 
-    # Получаем текущее количество и минимальное количество
-    row = await get_cartridge_stock_and_min(db, cartridge_id)
-    if not row:
-        raise HTTPException(status_code=404, detail="Картридж не найден!")
+    if payload.new_name is not None and not payload.new_name.strip():
+        raise HTTPException(status_code=400, detail="Название не может быть пустым")
 
-    current_stock, current_min = row
-    new_name = await get_cartridge_name(db, cartridge_id) or ""
+    current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    device_id = await resolve_device(request, client_host, platform, client_info)
 
-    new_stock = current_stock
-    new_min = current_min
+    # Чтение текущих значений и запись идут одной операцией писателя,
+    # чтобы между ними не вклинился скан с ТСД
+    async def patch_op(db):
+        # Получаем текущее количество и минимальное количество
+        row = await get_cartridge_stock_and_min(db, cartridge_id)
+        if not row:
+            return None
 
-    # Обновляем поля на основе payload
-    if payload.new_quantity is not None:
-        new_stock = payload.new_quantity
+        current_stock, current_min = row
+        new_name = await get_cartridge_name(db, cartridge_id) or ""
 
-    if payload.new_min_qty is not None:
-        new_min = payload.new_min_qty
+        new_stock = current_stock
+        new_min = current_min
 
-    if payload.new_name is not None:
-        new_name = payload.new_name.strip()
-        if not new_name:
-            raise HTTPException(status_code=400, detail="Название не может быть пустым")
+        # Обновляем поля на основе payload
+        if payload.new_quantity is not None:
+            new_stock = payload.new_quantity
 
-    # Приводим минимальное значение к ненулевому диапазону
-    if new_min < 0:
-        new_min = 0
+        if payload.new_min_qty is not None:
+            new_min = payload.new_min_qty
 
-    # Не даём остатку уйти в минус
-    if new_stock < 0:
-        new_stock = 0
-        logger.warning(f"{client_host}   - 'База не изменена, количество меньше нуля!'")
-        return {"new_stock": new_stock, "min_qty": new_min}
+        if payload.new_name is not None:
+            new_name = payload.new_name.strip()
 
-    current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        # Приводим минимальное значение к ненулевому диапазону
+        if new_min < 0:
+            new_min = 0
 
-    # Обновляем таблицу cartridges
-    await update_cartridge_details(db, cartridge_id, new_stock, new_min, new_name, current_time)
+        # Не даём остатку уйти в минус
+        if new_stock < 0:
+            return 0, new_min, new_name, None, None, False
 
-    # Записываем действие в историю, если изменилось количество
-    delta = new_stock - current_stock
-    if delta != 0:
-        await add_history_record(db, cartridge_id, new_name, delta, client_info, current_time, username)
+        # Обновляем таблицу cartridges
+        await update_cartridge_details(db, cartridge_id, new_stock, new_min, new_name, current_time)
 
-    # Подтверждаем транзакцию
-    await commit_changes(db)
+        # Записываем действие в историю, если изменилось количество
+        delta = new_stock - current_stock
+        if delta != 0:
+            await add_history_record(db, cartridge_id, new_name, delta, client_info, current_time, username, device_id)
+        version = await record_catalog_change(db, cartridge_id, 'upsert', current_time)
+        crossed = crossed_below_min(current_stock, new_stock, current_min, new_min)
+        return new_stock, new_min, new_name, delta, version, crossed
+
+    result = await request.app.state.writer.submit(patch_op)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Картридж не найден!")
+
+    new_stock, new_min, new_name, delta, version, crossed = result
+    if delta is None:
+        logger.warning(f"{client_host}   - 'База не изменена, количество меньше нуля!'")
+        return {"new_stock": new_stock, "min_qty": new_min}
+
+    await publish_cartridge_change(request.app.state.pool, version, cartridge_id)
+    if delta:
+        device_registry.touch(device_id, current_time, int(time.time()), edits=1)
+    if crossed:
+        low_stock_alerts.note(cartridge_id, new_name, new_stock, new_min)
 
     logger.info(f"{client_host}   - 'ID: {cartridge_id} | Имя: {new_name} | Дельта: {delta} | Кол-во: {new_stock} | Минимум: {new_min}'")
 
@@ -509,32 +1211,46 @@ async def api_patch_cartridge_quantity(cartridge_id: int, payload: StockChange,
 
 @app.post("/api/v1/cartridges/{cartridge_id}/barcodes")
 async def api_add_barcode(cartridge_id: int, payload: dict, request: Request):
-    db = request.app.state.db
     barcode = payload.get("barcode")
     if not barcode:
         raise HTTPException(status_code=400, detail="Штрих-код обязателен")
-    
-    # Проверить, существует ли картридж
-    if not await get_cartridge_by_id(db, cartridge_id):
-        raise HTTPException(status_code=404, detail="Картридж не найден")
 
-    # Проверить, не существует ли уже такой штрих-код
-    if await barcode_exists(db, barcode):
+    # Проверки и вставка - одна операция писателя, между ними не вклинится другая запись
+    async def add_barcode_op(db):
+        # Проверить, существует ли картридж
+        if not await get_cartridge_by_id(db, cartridge_id):
+            return status.HTTP_404_NOT_FOUND, None
+        # Проверить, не существует ли уже такой штрих-код
+        if await barcode_exists(db, barcode):
+            return status.HTTP_409_CONFLICT, None
+        await add_barcode(db, barcode, cartridge_id)
+        version = await record_catalog_change(db, cartridge_id, 'upsert', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        return status.HTTP_200_OK, version
+
+    status_code, version = await request.app.state.writer.submit(add_barcode_op)
+    if status_code == status.HTTP_404_NOT_FOUND:
+        raise HTTPException(status_code=404, detail="Картридж не найден")
+    if status_code == status.HTTP_409_CONFLICT:
         raise HTTPException(status_code=409, detail="Штрих-код уже существует")
-
-    # Добавить
-    await add_barcode(db, barcode, cartridge_id)
-    await commit_changes(db)
+    barcode_index.add(barcode, cartridge_id)
+    await publish_cartridge_change(request.app.state.pool, version, cartridge_id)
     return {"message": "Штрих-код добавлен"}
 
 @app.delete("/api/v1/cartridges/{cartridge_id}/barcodes/{barcode}")
 async def api_remove_barcode(cartridge_id: int, barcode: str, request: Request):
-    db = request.app.state.db
-    # Удалить, если существует
-    deleted = await remove_barcode(db, barcode, cartridge_id)
-    if deleted == 0:
+    async def remove_barcode_op(db):
+        # Удалить, если существует
+        if await remove_barcode(db, barcode, cartridge_id) == 0:
+            return None
+        return await record_catalog_change(db, cartridge_id, 'upsert', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+
+    version = await request.app.state.writer.submit(remove_barcode_op)
+    if version is None:
         raise HTTPException(status_code=404, detail="Штрих-код не найден")
-    await commit_changes(db)
+    # Из индекса убираем только после коммита. Скан в промежутке не спишет по отвязанному штрихкоду:
+    # UPDATE скана ищет привязку в таблице barcodes, а не в индексе
+    barcode_index.remove(barcode, cartridge_id)
+    await publish_cartridge_change(request.app.state.pool, version, cartridge_id)
     return {"message": "Штрих-код удалён"}
 
 
@@ -544,10 +1260,12 @@ async def api_get_expenses_heatmap(request: Request, year: Optional[int] = None)
     Возвращает данные для тепловой карты расходов по картриджам.
     В расчет попадают только отрицательные значения delta из history.
     """
+    timer = StageTimer("heatmap")
     selected_year = year or datetime.now().year
-    db = request.app.state.db
 
-    result = await get_yearly_expense_heatmap(db, selected_year)
+    async with request.app.state.pool.reader() as db:
+        result = await get_yearly_expense_heatmap(db, selected_year)
+    timer.mark("query")
     total_spent = 0
     for series_item in result["series"]:
         for point in series_item["data"]:
@@ -558,6 +1276,8 @@ async def api_get_expenses_heatmap(request: Request, year: Optional[int] = None)
         available_years.insert(0, selected_year)
         available_years = sorted(set(available_years), reverse=True)
 
+    timer.mark("aggregate")
+    timer.finish()
     return {
         "selected_year": selected_year,
         "available_years": available_years,
@@ -566,6 +1286,175 @@ async def api_get_expenses_heatmap(request: Request, year: Optional[int] = None)
     }
 
 
+def parse_history_period(date_from: Optional[str], date_to: Optional[str]):
+    """
+    Переводит границы периода из запроса в unix time
+
+    Args:
+        date_from: 'YYYY-MM-DD' или 'YYYY-MM-DD HH:MM[:SS]' (локальное время), включительно
+        date_to: То же; дата без времени означает конец этого дня
+
+    Returns:
+        Кортеж (ts_from включительно, ts_to не включительно), None для незаданной границы
+
+    Raises:
+        HTTPException 400: дата в неверном формате
+    """
+    def parse(value: str, end_of_day: bool):
+        try:
+            moment = datetime.fromisoformat(value)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Неверный формат даты: {value}")
+        if end_of_day and len(value) == 10:
+            moment += timedelta(days=1)
+        return int(moment.timestamp())
+
+    ts_from = parse(date_from, False) if date_from else None
+    ts_to = parse(date_to, True) if date_to else None
+    return ts_from, ts_to
+
+
+def history_filters(cartridge_id: Optional[int], date_from: Optional[str], date_to: Optional[str],
+                    editor: Optional[str], username: Optional[str], sign: Optional[str],
+                    device_id: Optional[int] = None) -> dict:
+    """Проверяет фильтры журнала из запроса и собирает их в аргументы get_history_page"""
+    if sign not in (None, "negative", "positive"):
+        raise HTTPException(status_code=400, detail="Неверный фильтр знака: negative или positive")
+    ts_from, ts_to = parse_history_period(date_from, date_to)
+    return {
+        "cartridge_id": cartridge_id,
+        "ts_from": ts_from,
+        "ts_to": ts_to,
+        "editor": editor,
+        "username": username,
+        "sign": sign,
+        "device_id": device_id,
+    }
+
+
+# Журнал операций с фильтрами, keyset-пагинация по increment (курсор - increment последней строки)
+@app.get("/api/v1/history")
+async def api_get_history(
+    request: Request,
+    limit: int = HISTORY_PAGE_SIZE,
+    cursor: Optional[int] = None,
+    order: str = "desc",
+    cartridge_id: Optional[int] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    editor: Optional[str] = None,
+    username: Optional[str] = None,
+    sign: Optional[str] = None,
+    device_id: Optional[int] = None
+):
+    """
+    Возвращает страницу журнала history
+
+    Returns:
+        {"items": [записи], "next_cursor": курсор следующей страницы или None}
+    """
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="Неверный порядок сортировки")
+    filters = history_filters(cartridge_id, date_from, date_to, editor, username, sign, device_id)
+    limit = max(1, min(limit, HISTORY_PAGE_MAX_SIZE))
+
+    timer = StageTimer("history_page")
+    archives = archives_for_period(list_history_archives(HISTORY_ARCHIVE_DIR), filters["ts_from"], filters["ts_to"])
+    async with request.app.state.pool.reader() as db:
+        sources = await attach_history_archives(db, archives)
+        items, next_cursor = await get_history_page(db, limit, cursor, order == "desc", sources=sources, **filters)
+    timer.mark("query")
+    timer.finish()
+    return {"items": items, "next_cursor": next_cursor}
+
+
+HISTORY_EXPORT_FIELDS = ("increment", "cartridge_id", "cartridge_name", "delta", "editor", "username", "created_at",
+                         "op_count", "ended_at", "device_id")
+
+
+async def stream_history_export(pool: DatabasePool, export_format: str, filters: dict):
+    """
+    Асинхронный генератор тела выгрузки журнала
+
+    Журнал читается кусками по HISTORY_EXPORT_CHUNK_SIZE строк по keyset на increment.
+    Соединение-читатель берется из пула только на время одного куска, поэтому долгая выгрузка
+    не держит соединение и не мешает сканам, а в памяти одновременно только один кусок.
+    Верхняя граница increment фиксируется в начале: записи, добавленные во время выгрузки, в нее не попадают.
+    Закрытые годы из периода читаются из подключенных файлов архива (attach_history_archives).
+    """
+    archives = archives_for_period(list_history_archives(HISTORY_ARCHIVE_DIR), filters["ts_from"], filters["ts_to"])
+    async with pool.reader() as db:
+        sources = await attach_history_archives(db, archives)
+        until = await get_history_max_increment(db, sources)
+
+    if export_format == "csv":
+        # BOM, чтобы Excel открыл кириллицу в UTF-8 без мастера импорта
+        yield "\ufeff" + ",".join(HISTORY_EXPORT_FIELDS) + "\r\n"
+
+    after = None
+    exported = 0
+    while True:
+        async with pool.reader() as db:
+            sources = await attach_history_archives(db, archives)
+            rows, after = await get_history_page(db, HISTORY_EXPORT_CHUNK_SIZE, after, False, until, sources=sources, **filters)
+        if rows:
+            exported += len(rows)
+            if export_format == "csv":
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                writer.writerows([row[field] for field in HISTORY_EXPORT_FIELDS] for row in rows)
+                yield buffer.getvalue()
+            else:
+                yield "".join(json.dumps(row, ensure_ascii=False, separators=(",", ":")) + "\n" for row in rows)
+        if after is None:
+            break
+    logger.info(f"Выгрузка журнала ({export_format}): {exported} записей")
+
+
+# Выгрузка журнала целиком (с теми же фильтрами) потоком CSV или NDJSON
+@app.get("/api/v1/history/export")
+async def api_export_history(
+    request: Request,
+    format: str = "csv",
+    cartridge_id: Optional[int] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    editor: Optional[str] = None,
+    username: Optional[str] = None,
+    sign: Optional[str] = None,
+    device_id: Optional[int] = None
+):
+    if format not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="Неверный формат выгрузки: csv или ndjson")
+    filters = history_filters(cartridge_id, date_from, date_to, editor, username, sign, device_id)
+    media_type = "text/csv; charset=utf-8" if format == "csv" else "application/x-ndjson"
+    filename = f"history-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{format}"
+    return StreamingResponse(
+        stream_history_export(request.app.state.pool, format, filters),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+# Справочник устройств со счетчиками активности (журнал устройства - GET /api/v1/history?device_id=N)
+@app.get("/api/v1/devices")
+async def api_get_devices(request: Request):
+    async with request.app.state.pool.reader() as db:
+        devices = await get_devices(db)
+    # Добавляем счетчики, которые еще не сброшены в БД
+    for device in devices:
+        pending = device_registry.pending_for(device["id"])
+        if pending:
+            scans, edits, last_seen, last_seen_ts = pending
+            device["scans_total"] += scans
+            device["edits_total"] += edits
+            if device["last_seen_ts"] is None or last_seen_ts >= device["last_seen_ts"]:
+                device["last_seen"] = last_seen
+                device["last_seen_ts"] = last_seen_ts
+    devices.sort(key=lambda device: device["last_seen_ts"] or 0, reverse=True)
+    return {"devices": devices}
+
+
 ################################ API для email уведомлений ###################################################
 
 @app.get("/api/v1/emails")
@@ -574,7 +1463,7 @@ async def get_emails(request: Request):
     Получить все email адреса для уведомлений
     """
     try:
-        async with aiosqlite.connect(DB_NAME) as db:
+        async with request.app.state.pool.reader() as db:
             emails = await get_all_emails(db)
             return {"emails": emails}
     except Exception as e:
@@ -593,7 +1482,7 @@ async def add_new_email(email_data: EmailAddRequest, request: Request):
         if not re.match(r"[^@]+@[^@]+\.[^@]+", email_data.email_address):
             raise HTTPException(status_code=400, detail="Неверный формат email адреса")
 
-        async with aiosqlite.connect(DB_NAME) as db:
+        async with request.app.state.pool.write() as db:
             email_id = await add_email(db, email_data.email_address)
             if email_id is None:
                 raise HTTPException(status_code=409, detail="Email адрес уже существует")
@@ -612,7 +1501,7 @@ async def update_email(email_id: int, email_data: EmailUpdateRequest, request: R
     Обновить настройки уведомлений для email
     """
     try:
-        async with aiosqlite.connect(DB_NAME) as db:
+        async with request.app.state.pool.write() as db:
             await update_email_notifications(db, email_id, email_data.notifications_on)
             await commit_changes(db)
             return {"message": "Настройки уведомлений обновлены"}
@@ -627,7 +1516,7 @@ async def remove_email(email_id: int, request: Request):
     Удалить email адрес
     """
     try:
-        async with aiosqlite.connect(DB_NAME) as db:
+        async with request.app.state.pool.write() as db:
             deleted_count = await delete_email(db, email_id)
             if deleted_count == 0:
                 raise HTTPException(status_code=404, detail="Email адрес не найден")
@@ -646,7 +1535,7 @@ async def send_notifications(request: Request):
     Отправить уведомления о низком запасе картриджей
     """
     try:
-        async with aiosqlite.connect(DB_NAME) as db:
+        async with request.app.state.pool.reader() as db:
             # Получить email адреса для уведомлений
             emails = await get_emails_for_notifications(db)
             if not emails:
@@ -657,14 +1546,35 @@ async def send_notifications(request: Request):
             if not low_stock:
                 return {"message": "Нет картриджей с низким запасом"}
 
-            # Отправить уведомления
-            sent_count = await send_low_stock_notifications(emails, low_stock)
-            return {"message": f"Уведомления отправлены на {sent_count} адресов"}
+        # Письма уходят фоновым рассыльщиком, запрос SMTP не ждет
+        queued = await enqueue_low_stock_email(request.app, emails, low_stock)
+        if not queued:
+            return {"message": "Такое уведомление уже отправлялось недавно", "queued": 0, "deduplicated": len(emails)}
+        return {
+            "message": f"Уведомления поставлены в очередь для {queued} адресов",
+            "queued": queued,
+            "deduplicated": len(emails) - queued
+        }
     except Exception as e:
         logger.error(f"Ошибка при отправке уведомлений: {e}")
         raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
 
 
+@app.get("/api/v1/emails/outbox")
+async def get_outbox(request: Request, limit: int = 50):
+    """
+    Состояние очереди писем и последние письма с результатом отправки
+    """
+    limit = min(max(limit, 1), 500)
+    try:
+        async with request.app.state.pool.reader() as db:
+            items = await get_outbox_recent(db, limit)
+        return {"stats": request.app.state.outbox.stats(), "items": items}
+    except Exception as e:
+        logger.error(f"Ошибка при получении очереди писем: {e}")
+        raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
+
+
 ################################ API для настроек ###################################################
 
 @app.get("/api/v1/settings/{key}")
@@ -673,7 +1583,7 @@ async def get_setting_value(key: str, request: Request):
     Получить значение настройки
     """
     try:
-        async with aiosqlite.connect(DB_NAME) as db:
+        async with request.app.state.pool.reader() as db:
             value = await get_setting(db, key)
             return {"key": key, "value": value}
     except Exception as e:
@@ -687,10 +1597,12 @@ async def update_setting(key: str, setting_data: SettingUpdateRequest, request:
     Обновить значение настройки
     """
     try:
-        async with aiosqlite.connect(DB_NAME) as db:
+        async with request.app.state.pool.write() as db:
             await set_setting(db, key, setting_data.value)
             await commit_changes(db)
-            return {"message": "Настройка обновлена"}
+        if key in NOTIFICATION_SCHEDULE_KEYS:
+            await reload_notification_schedule(request.app)
+        return {"message": "Настройка обновлена"}
     except Exception as e:
         logger.error(f"Ошибка при обновлении настройки {key}: {e}")
         raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
@@ -709,7 +1621,7 @@ async def get_notification_schedule_endpoint(request: Request):
     Получить расписание отправки уведомлений
     """
     try:
-        async with aiosqlite.connect(DB_NAME) as db:
+        async with request.app.state.pool.reader() as db:
             schedule = await get_notification_schedule(db)
             if schedule:
                 return schedule
@@ -726,10 +1638,11 @@ async def set_notification_schedule_endpoint(schedule_data: NotificationSchedule
     Установить расписание отправки уведомлений
     """
     try:
-        async with aiosqlite.connect(DB_NAME) as db:
+        async with request.app.state.pool.write() as db:
             await set_notification_schedule(db, schedule_data.days_of_week, schedule_data.time_hm)
             await commit_changes(db)
-            return {"message": "Расписание уведомлений установлено"}
+        await reload_notification_schedule(request.app)
+        return {"message": "Расписание уведомлений установлено"}
     except ValueError as e:
         logger.error(f"Ошибка валидации расписания: {e}")
         raise HTTPException(status_code=400, detail=str(e))
@@ -744,7 +1657,7 @@ async def get_notifications_enabled_endpoint(request: Request):
     Получить статус глобальной настройки уведомлений
     """
     try:
-        async with aiosqlite.connect(DB_NAME) as db:
+        async with request.app.state.pool.reader() as db:
             enabled = await get_notifications_enabled(db)
             return {"enabled": enabled}
     except Exception as e:
@@ -759,10 +1672,11 @@ async def set_notifications_enabled_endpoint(enabled_data: dict, request: Reques
     """
     try:
         enabled = enabled_data.get("enabled", False)
-        async with aiosqlite.connect(DB_NAME) as db:
+        async with request.app.state.pool.write() as db:
             await set_notifications_enabled(db, enabled)
             await commit_changes(db)
-            return {"message": f"Уведомления {'включены' if enabled else 'выключены'}"}
+        await reload_notification_schedule(request.app)
+        return {"message": f"Уведомления {'включены' if enabled else 'выключены'}"}
     except Exception as e:
         logger.error(f"Ошибка при установке статуса уведомлений: {e}")
         raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
@@ -773,8 +1687,6 @@ async def api_create_cartridge(payload: CartridgeCreateRequest, request: Request
     """
     Создает новый картридж с штрих-кодом
     """
-    db = request.app.state.db
-    
     # Валидация входных данных
     if not payload.cartridge_name or not payload.cartridge_name.strip():
         raise HTTPException(status_code=400, detail="Название картриджа не может быть пустым")
@@ -787,26 +1699,19 @@ async def api_create_cartridge(payload: CartridgeCreateRequest, request: Request
     if payload.min_qty < 1:
         raise HTTPException(status_code=400, detail="Минимальный остаток должен быть не менее 1")
     
-    # Проверка на дубль штрих-кода
-    if await barcode_exists(db, payload.barcode):
-        raise HTTPException(status_code=409, detail="Штрих-код уже существует в базе")
-    
     current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     
     # Получаем имя пользователя из сессии
-    session_id = request.cookies.get("session_id")
-    username = None
-    if session_id:
-        session_data = await get_session(db, session_id)
-        if session_data:
-            user_dn = session_data[0]
-            # Извлекаем имя пользователя из DN (например, "cn=username" -> "username")
-            if "cn=" in user_dn:
-                username = user_dn.split("cn=")[1].split(",")[0]
-            else:
-                username = user_dn
+    username = get_request_username(request)
+    client_host, platform, client_info = get_client_info(request)
+    device_id = await resolve_device(request, client_host, platform, client_info)
     
-    try:
+    # Проверка дубля, картридж, штрихкод и история - одна операция писателя
+    async def create_op(db):
+        # Проверка на дубль штрих-кода
+        if await barcode_exists(db, payload.barcode):
+            return None, None
+
         # Создаем картридж и добавляем первый штрих-код
         cartridge_id = await create_cartridge(
             db,
@@ -818,11 +1723,6 @@ async def api_create_cartridge(payload: CartridgeCreateRequest, request: Request
         )
         
         # Записываем в историю (операция добавления - delta = quantity)
-        client_host = request.client.host
-        user_agent = request.headers.get("User-Agent")
-        os_info = "Platform: Windows       " if "Windows" in user_agent else "Platform: Mobile/Other  "
-        client_info = os_info + client_host
-        
         if max(0, payload.quantity) > 0:
             await add_history_record(
                 db,
@@ -831,10 +1731,22 @@ async def api_create_cartridge(payload: CartridgeCreateRequest, request: Request
                 max(0, payload.quantity),
                 client_info,
                 current_time,
-                username
+                username,
+                device_id
             )
         
-        await commit_changes(db)
+        version = await record_catalog_change(db, cartridge_id, 'upsert', current_time)
+        return cartridge_id, version
+
+    try:
+        cartridge_id, version = await request.app.state.writer.submit(create_op)
+        if cartridge_id is None:
+            raise HTTPException(status_code=409, detail="Штрих-код уже существует в базе")
+
+        barcode_index.add(payload.barcode, cartridge_id)
+        await publish_cartridge_change(request.app.state.pool, version, cartridge_id)
+        if max(0, payload.quantity) > 0:
+            device_registry.touch(device_id, current_time, int(time.time()), edits=1)
         
         logger.info(f"{client_host} - 'Создан картридж ID: {cartridge_id} | Имя: {payload.cartridge_name} | Кол-во: {max(0, payload.quantity)}'")
         
@@ -843,6 +1755,8 @@ async def api_create_cartridge(payload: CartridgeCreateRequest, request: Request
             "message": "Картридж успешно создан"
         }
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при создании картриджа: {e}")
         raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
@@ -854,24 +1768,24 @@ async def api_delete_cartridge(cartridge_id: int, request: Request):
     Удаляет картридж и все его штрих-коды из БД
     История операций остается нетронутой
     """
-    db = request.app.state.db
-    
-    # Проверяем, существует ли картридж
-    cartridge = await get_cartridge_by_id(db, cartridge_id)
-    if not cartridge:
-        raise HTTPException(status_code=404, detail="Картридж не найден")
-    
-    # Получаем имя картриджа перед удалением для логирования
-    cartridge_name = await get_cartridge_name(db, cartridge_id)
-    
+    # Проверка, удаление и запись в журнал каталога - одна операция писателя
+    async def delete_op(db):
+        # Получаем имя картриджа перед удалением для логирования (заодно проверяем, что он существует)
+        cartridge_name = await get_cartridge_name(db, cartridge_id)
+        if cartridge_name is None or not await delete_cartridge(db, cartridge_id):
+            return None, None
+        version = await record_catalog_change(db, cartridge_id, 'delete', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        return cartridge_name, version
+
     try:
-        # Удаляем картридж и штрих-коды
-        success = await delete_cartridge(db, cartridge_id)
+        cartridge_name, version = await request.app.state.writer.submit(delete_op)
         
-        if not success:
+        if version is None:
             raise HTTPException(status_code=404, detail="Картридж не найден")
+        # Из индекса убираем после коммита, как и при отвязке штрихкода
+        barcode_index.remove_cartridge(cartridge_id)
         
-        await commit_changes(db)
+        publish_cartridge_deleted(version, cartridge_id)
         
         client_host = request.client.host
         logger.info(f"{client_host} - 'Удален картридж ID: {cartridge_id} | Имя: {cartridge_name}'")
@@ -885,6 +1799,26 @@ async def api_delete_cartridge(cartridge_id: int, request: Request):
         raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
 
 
+################################ Метрики ###################################################
+
+def is_local_request(request: Request) -> bool:
+    """
+    Запрос пришел напрямую с этого сервера, а не через Caddy
+    (Caddy тоже ходит с localhost, но всегда добавляет X-Forwarded-For)
+    """
+    client_host = request.client.host if request.client else ""
+    return client_host in ("127.0.0.1", "::1", "localhost") and "x-forwarded-for" not in request.headers
+
+
+# Путь не начинается с /api/, поэтому session_middleware куку не проверяет.
+# Доступ только локально, например для Prometheus на этом же сервере.
+@app.get("/metrics")
+async def get_metrics(request: Request):
+    if not is_local_request(request):
+        raise HTTPException(status_code=404, detail="Not Found")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 # Перенаправление пользователя на файл админки    
 @app.get("/")
 async def redirect():
@@ -0,0 +1,267 @@
+"""
+CartridgeMaster - архив журнала операций по годам.
+
+В основной базе остаются записи history за текущий и предыдущий год. Закрытые годы переносятся
+в отдельные файлы history-YYYY.db (только для чтения), основная база перестает расти вместе
+с журналом, а контрольные точки WAL и резервные копии остаются быстрыми.
+Выборки журнала (GET /api/v1/history и выгрузка) подключают нужные годы через ATTACH
+и читают каждый год отдельно, с keyset и LIMIT в каждой части (см. server_db.attach_history_archives).
+Сводные таблицы расхода (тепловая карта) остаются в основной базе и архивом не затрагиваются.
+
+Здесь же необязательное сжатие старого журнала: серии одиночных сканов одного картриджа
+с одного устройства сливаются в одну строку (см. server_db.compact_history_day).
+"""
+
+import logging
+import os
+import re
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import aiosqlite
+
+from server_db import (
+    get_history_min_ts, get_history_next_ts, delete_history_range, compact_history_day,
+    get_setting, set_setting, HISTORY_COLUMNS
+)
+
+logger = logging.getLogger("my_custom_logger")
+
+ARCHIVE_FILE_PATTERN = re.compile(r"^history-(\d{4})\.db$")
+
+
+def history_archive_path(archive_dir: str, year: int) -> str:
+    """Путь к файлу архива за год"""
+    return os.path.join(archive_dir, f"history-{year}.db")
+
+
+def year_bounds(year: int):
+    """
+    Returns:
+        Кортеж (начало года, начало следующего года) в unix time по локальному времени
+    """
+    return int(datetime(year, 1, 1).timestamp()), int(datetime(year + 1, 1, 1).timestamp())
+
+
+def list_history_archives(archive_dir: str) -> list:
+    """
+    Находит готовые файлы архива
+
+    Returns:
+        Список пар (год, путь) по возрастанию года
+    """
+    try:
+        names = os.listdir(archive_dir)
+    except FileNotFoundError:
+        return []
+    archives = []
+    for name in names:
+        match = ARCHIVE_FILE_PATTERN.match(name)
+        if match:
+            archives.append((int(match.group(1)), os.path.join(archive_dir, name)))
+    return sorted(archives)
+
+
+def archives_for_period(archives: list, ts_from: int = None, ts_to: int = None) -> list:
+    """
+    Оставляет только архивы, годы которых пересекаются с периодом [ts_from, ts_to)
+    """
+    selected = []
+    for year, path in archives:
+        start, end = year_bounds(year)
+        if (ts_from is None or ts_from < end) and (ts_to is None or ts_to > start):
+            selected.append((year, path))
+    return selected
+
+
+async def build_archive_file(db_name: str, path: str, ts_from: int, ts_to: int) -> tuple:
+    """
+    Копирует записи history за период из основной базы в новый файл архива
+
+    Копирование идет на отдельном соединении с архивом, основная база подключается к нему только
+    для чтения: писатель и читатели пула не заняты, а строки не проходят через память процесса.
+    Файл сначала пишется как .tmp и переименовывается только после сверки количества и суммы delta.
+
+    Args:
+        db_name: Путь к основной базе
+        path: Путь к итоговому файлу архива
+        ts_from: Начало периода, unix time включительно
+        ts_to: Конец периода, unix time не включительно
+
+    Returns:
+        Кортеж (количество записей, increment последней записи в архиве)
+
+    Raises:
+        RuntimeError: копия не совпала с основной базой
+    """
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = await aiosqlite.connect(Path(tmp_path).resolve().as_uri(), uri=True)
+    try:
+        await conn.execute("""
+            CREATE TABLE history (
+                increment INTEGER PRIMARY KEY,
+                cartridge_id INTEGER NOT NULL,
+                cartridge_name TEXT NOT NULL,
+                delta INTEGER NOT NULL,
+                editor TEXT NOT NULL,
+                username TEXT,
+                created_at TIMESTAMP,
+                created_ts INTEGER,
+                op_count INTEGER,
+                ended_at TIMESTAMP,
+                ended_ts INTEGER,
+                device_id INTEGER
+            )
+        """)
+        await conn.execute("ATTACH DATABASE ? AS live", (Path(db_name).resolve().as_uri() + "?mode=ro",))
+        # editor в архив пишется текстом из справочника устройств, чтобы файл архива был самодостаточным
+        await conn.execute(f"""
+            INSERT INTO history ({HISTORY_COLUMNS})
+            SELECT {HISTORY_COLUMNS} FROM live.history_full
+            WHERE created_ts >= ? AND created_ts < ?
+        """, (ts_from, ts_to))
+
+        # Сверка в той же транзакции: чтение live идет по тому же снимку, что и копирование
+        cursor = await conn.execute("SELECT COUNT(*), COALESCE(SUM(delta), 0), COALESCE(MAX(increment), 0) FROM history")
+        copied, copied_sum, until = await cursor.fetchone()
+        cursor = await conn.execute("""
+            SELECT COUNT(*), COALESCE(SUM(delta), 0) FROM live.history
+            WHERE created_ts >= ? AND created_ts < ? AND increment <= ?
+        """, (ts_from, ts_to, until))
+        source, source_sum = await cursor.fetchone()
+        if (copied, copied_sum) != (source, source_sum):
+            raise RuntimeError(f"архив не совпал с основной базой: {copied}/{copied_sum} против {source}/{source_sum}")
+
+        await conn.execute("CREATE INDEX idx_history_created_ts ON history(created_ts)")
+        await conn.execute("CREATE INDEX idx_history_cartridge_created_ts ON history(cartridge_id, created_ts)")
+        await conn.commit()
+        await conn.execute("DETACH DATABASE live")
+        await conn.close()
+    except BaseException:
+        await conn.close()
+        os.remove(tmp_path)
+        raise
+
+    os.replace(tmp_path, path)
+    os.chmod(path, 0o444)
+    return copied, until
+
+
+async def read_archive_until(path: str) -> int:
+    """Возвращает increment последней записи в готовом файле архива"""
+    async with aiosqlite.connect(Path(path).resolve().as_uri() + "?mode=ro", uri=True) as conn:
+        cursor = await conn.execute("SELECT COALESCE(MAX(increment), 0) FROM history")
+        row = await cursor.fetchone()
+        return row[0]
+
+
+async def archive_history_year(pool, writer, year: int, archive_dir: str, delete_chunk: int = 2000) -> int:
+    """
+    Переносит год журнала в архив и удаляет его записи из основной базы
+
+    Если файл года уже есть (прошлый перенос прервался на удалении), он не пересоздается,
+    а удаление продолжается до последней записи, попавшей в архив.
+
+    Args:
+        pool: DatabasePool (путь к основной базе)
+        writer: WriteCoalescer - удаление идет порциями через групповой коммит и не задерживает сканы
+        year: Архивируемый год
+        archive_dir: Каталог архива
+        delete_chunk: Сколько строк удалять за одну операцию писателя
+
+    Returns:
+        Количество удаленных из основной базы записей
+    """
+    ts_from, ts_to = year_bounds(year)
+    path = history_archive_path(archive_dir, year)
+    if os.path.exists(path):
+        until = await read_archive_until(path)
+    else:
+        os.makedirs(archive_dir, exist_ok=True)
+        copied, until = await build_archive_file(pool.db_name, path, ts_from, ts_to)
+        logger.info(f"Журнал за {year} год перенесен в архив {path}. Записей: {copied}")
+
+    async def delete_op(db):
+        return await delete_history_range(db, ts_from, ts_to, until, delete_chunk)
+
+    deleted = 0
+    while True:
+        removed = await writer.submit(delete_op)
+        deleted += removed
+        if removed < delete_chunk:
+            break
+    return deleted
+
+
+async def archive_closed_years(pool, writer, archive_dir: str, live_years: int = 2, delete_chunk: int = 2000) -> list:
+    """
+    Переносит в архив все годы старше live_years последних
+
+    Returns:
+        Список перенесенных годов
+    """
+    first_live_year = datetime.now().year - live_years + 1
+    archived = []
+    while True:
+        async with pool.reader() as db:
+            min_ts = await get_history_min_ts(db)
+        if min_ts is None:
+            break
+        year = datetime.fromtimestamp(min_ts).year
+        if year >= first_live_year:
+            break
+        deleted = await archive_history_year(pool, writer, year, archive_dir, delete_chunk)
+        logger.info(f"Журнал за {year} год удален из основной базы. Записей: {deleted}")
+        archived.append(year)
+        if year in archived[:-1]:
+            # Записи года остались после удаления (increment больше архивного) - не зацикливаемся
+            logger.error(f"Журнал за {year} год не удалось полностью перенести в архив")
+            break
+    return archived
+
+
+async def compact_old_history(pool, writer, older_than_days: int, gap_seconds: int) -> tuple:
+    """
+    Сжимает журнал по суткам от самой старой несжатой записи до older_than_days дней назад
+
+    Каждые сутки сжимаются отдельной операцией писателя вместе с отметкой прогресса в settings,
+    поэтому прерванное сжатие продолжается со следующих суток, а сканы ждут не дольше одних суток журнала.
+
+    Args:
+        pool: DatabasePool
+        writer: WriteCoalescer
+        older_than_days: Сжимаются только сутки, целиком лежащие старше этого возраста
+        gap_seconds: Максимальный перерыв между операциями одной серии
+
+    Returns:
+        Кортеж (обработано суток, удалено строк)
+    """
+    cutoff_date = (datetime.now() - timedelta(days=older_than_days)).date()
+    cutoff = int(datetime(cutoff_date.year, cutoff_date.month, cutoff_date.day).timestamp())
+    async with pool.reader() as db:
+        progress = int(await get_setting(db, "history_compacted_until", "0") or 0)
+
+    days = 0
+    removed_total = 0
+    while True:
+        async with pool.reader() as db:
+            next_ts = await get_history_next_ts(db, progress)
+        if next_ts is None or next_ts >= cutoff:
+            break
+        day = datetime.fromtimestamp(next_ts).date()
+        ts_from = int(datetime(day.year, day.month, day.day).timestamp())
+        day_after = day + timedelta(days=1)
+        ts_to = int(datetime(day_after.year, day_after.month, day_after.day).timestamp())
+
+        async def compact_op(db):
+            result = await compact_history_day(db, ts_from, ts_to, gap_seconds)
+            await set_setting(db, "history_compacted_until", str(ts_to))
+            return result
+
+        _, removed = await writer.submit(compact_op)
+        days += 1
+        removed_total += removed
+        progress = ts_to
+    return days, removed_total
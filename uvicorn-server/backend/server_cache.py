@@ -0,0 +1,475 @@
+"""
+CartridgeMaster - структуры данных в памяти процесса.
+
+Содержит кэши и индексы, которые избавляют горячие эндпоинты от лишних обращений к БД.
+"""
+
+import time
+from datetime import datetime
+
+
+class ReplayCache:
+    """
+    Защита от повторных запросов ТСД с ограниченной памятью
+
+    ID запросов раскладываются по корзинам в одну секунду по полю time из тела запроса.
+    Повторно отправленный пакет несет тот же time, поэтому искать его ID нужно только в одной корзине.
+    Корзины старше окна свежести удаляются целиком: такие запросы и так отсекаются проверкой времени.
+    """
+
+    def __init__(self, window_seconds: int = 10):
+        """
+        Args:
+            window_seconds: Окно свежести запроса в секундах
+        """
+        self.window_seconds = window_seconds
+        self._buckets = {}
+        self._size = 0
+        self._last_evict = None
+        self.evictions = 0
+
+    def check_and_add(self, req_id, req_time: int, now: int = None) -> bool:
+        """
+        Проверяет ID запроса на повтор и запоминает его
+
+        Args:
+            req_id: ID запроса от ТСД
+            req_time: Время формирования запроса (unix time, секунды)
+            now: Текущее время, по умолчанию time.time()
+
+        Returns:
+            True если запрос новый, False если такой ID уже был в этой секунде
+        """
+        if now is None:
+            now = int(time.time())
+        self._evict(now)
+
+        bucket = self._buckets.get(req_time)
+        if bucket is None:
+            bucket = self._buckets[req_time] = set()
+        elif req_id in bucket:
+            return False
+        bucket.add(req_id)
+        self._size += 1
+        return True
+
+    def _evict(self, now: int):
+        # Корзин не больше 2 * window + 1, поэтому проход по ключам занимает константное время
+        if self._last_evict == now:
+            return
+        self._last_evict = now
+        oldest_allowed = now - self.window_seconds
+        for bucket_time in [t for t in self._buckets if t < oldest_allowed]:
+            bucket = self._buckets.pop(bucket_time)
+            self._size -= len(bucket)
+            self.evictions += len(bucket)
+
+    def __len__(self):
+        return self._size
+
+    def stats(self) -> dict:
+        """Текущий размер кэша и количество вытесненных ID"""
+        return {
+            "size": self._size,
+            "buckets": len(self._buckets),
+            "evictions_total": self.evictions,
+        }
+
+
+class BarcodeIndex:
+    """
+    Индекс штрихкод -> ID картриджа в памяти процесса
+
+    Загружается из таблицы barcodes при старте и обновляется эндпоинтами после коммита изменения привязок.
+    Промах индекса перепроверяется по БД, попадание проверяет сам UPDATE скана.
+    Периодическая сверка с таблицей (load) исправляет возможный дрейф. Каждое изменение индекса
+    увеличивает generation: снимок таблицы, прочитанный до изменения, не затирает его.
+    """
+
+    def __init__(self):
+        self._index = {}
+        self.loaded = False
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.drift_total = 0
+        self.stale_loads_total = 0
+
+    def load(self, rows, generation: int = None):
+        """
+        Полностью заменяет содержимое индекса
+
+        Args:
+            rows: Пары (barcode, cartridge_id) из таблицы barcodes
+            generation: Значение generation перед чтением rows. Если с тех пор индекс менялся,
+                        снимок мог устареть, и индекс не заменяется
+
+        Returns:
+            Количество расхождений между старым и новым содержимым индекса или None, если снимок устарел
+        """
+        if generation is not None and generation != self.generation:
+            self.stale_loads_total += 1
+            return None
+        new_index = dict(rows)
+        drift = 0
+        if self.loaded:
+            old_index = self._index
+            drift = sum(1 for barcode, cartridge_id in new_index.items() if old_index.get(barcode) != cartridge_id)
+            drift += sum(1 for barcode in old_index if barcode not in new_index)
+            self.drift_total += drift
+        self._index = new_index
+        self.loaded = True
+        self.generation += 1
+        return drift
+
+    def get(self, barcode: str):
+        """
+        Ищет картридж по штрихкоду
+
+        Returns:
+            ID картриджа или None, если штрихкод не привязан
+        """
+        cartridge_id = self._index.get(barcode)
+        if cartridge_id is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return cartridge_id
+
+    def add(self, barcode: str, cartridge_id: int):
+        """Добавляет привязку штрихкода к картриджу"""
+        self._index[barcode] = cartridge_id
+        self.generation += 1
+
+    def remove(self, barcode: str, cartridge_id: int = None):
+        """Удаляет привязку штрихкода (если указан cartridge_id - только привязку к этому картриджу)"""
+        if cartridge_id is None or self._index.get(barcode) == cartridge_id:
+            self._index.pop(barcode, None)
+        self.generation += 1
+
+    def remove_cartridge(self, cartridge_id: int):
+        """Удаляет все штрихкоды картриджа"""
+        for barcode in [b for b, c in self._index.items() if c == cartridge_id]:
+            del self._index[barcode]
+        self.generation += 1
+
+    def __len__(self):
+        return len(self._index)
+
+    def stats(self) -> dict:
+        """Размер индекса, попадания, промахи и найденный при сверках дрейф"""
+        return {
+            "size": len(self._index),
+            "hits_total": self.hits,
+            "misses_total": self.misses,
+            "drift_total": self.drift_total,
+            "stale_loads_total": self.stale_loads_total,
+        }
+
+
+class SessionCache:
+    """
+    Кэш сессий session_id -> (user_dn, expires_at)
+
+    Заполняется при логине и при первом обращении к БД, сбрасывается при logout.
+    Запись живет не дольше срока сессии и не дольше ttl_seconds с момента попадания в кэш,
+    чтобы изменения таблицы sessions в обход приложения не жили в памяти вечно.
+    """
+
+    def __init__(self, ttl_seconds: int = 300):
+        """
+        Args:
+            ttl_seconds: Сколько секунд доверять записи без перечитывания из БД
+        """
+        self.ttl_seconds = ttl_seconds
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, session_id: str):
+        """
+        Returns:
+            Кортеж (user_dn, expires_at) или None, если записи нет или она устарела
+        """
+        entry = self._entries.get(session_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        user_dn, expires_at, valid_until = entry
+        if time.monotonic() >= valid_until or datetime.now() >= expires_at:
+            del self._entries[session_id]
+            self.misses += 1
+            return None
+        self.hits += 1
+        return user_dn, expires_at
+
+    def put(self, session_id: str, user_dn: str, expires_at: datetime):
+        """Запоминает сессию"""
+        self._entries[session_id] = (user_dn, expires_at, time.monotonic() + self.ttl_seconds)
+
+    def invalidate(self, session_id: str):
+        """Удаляет сессию из кэша (logout)"""
+        self._entries.pop(session_id, None)
+
+    def purge_expired(self) -> int:
+        """Удаляет истекшие записи, возвращает их количество"""
+        now = datetime.now()
+        monotonic_now = time.monotonic()
+        expired = [sid for sid, (_, expires_at, valid_until) in self._entries.items()
+                   if now >= expires_at or monotonic_now >= valid_until]
+        for session_id in expired:
+            del self._entries[session_id]
+        return len(expired)
+
+    def stats(self) -> dict:
+        """Размер кэша, попадания и промахи"""
+        return {
+            "size": len(self._entries),
+            "hits_total": self.hits,
+            "misses_total": self.misses,
+        }
+
+
+class CatalogCache:
+    """
+    Версия каталога картриджей и сериализованный JSON каталога для этой версии
+
+    Версия - номер последней записи журнала изменений каталога в БД. Каждый путь записи,
+    меняющий картриджи или штрихкоды, после коммита передает сюда новую версию через bump().
+    GET каталога отдает ETag с версией: браузер с актуальной копией получает 304 без запроса к БД,
+    а остальные получают готовый JSON, который строится один раз на версию.
+    """
+
+    def __init__(self, version: int = 0):
+        # Метка запуска процесса в ETag: если базу подменят или восстановят из копии,
+        # совпавшая версия из другой базы не даст браузеру ложный 304
+        self.boot_id = format(int(time.time()), "x")
+        self.version = version
+        self._body = None
+        self._body_version = None
+        self.bumps = 0
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def bump(self, version: int):
+        """
+        Отмечает изменение каталога, закэшированный JSON больше не актуален
+
+        Args:
+            version: Версия каталога после закоммиченного изменения (из журнала в БД).
+                     Коммиты соседних запросов могут сообщать версии не по порядку, берется наибольшая
+        """
+        self.bumps += 1
+        if version > self.version:
+            self.version = version
+        self._body = None
+        self._body_version = None
+
+    def etag(self, version: int = None) -> str:
+        """Слабый ETag для версии (по умолчанию текущей)"""
+        if version is None:
+            version = self.version
+        return f'W/"{self.boot_id}-{version}"'
+
+    def matches(self, if_none_match: str) -> bool:
+        """
+        Проверяет заголовок If-None-Match на совпадение с текущей версией
+
+        Returns:
+            True если у клиента актуальная копия и можно ответить 304
+        """
+        if not if_none_match:
+            return False
+        current = self.etag()
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag == "*" or tag == current or f"W/{tag}" == current:
+                self.not_modified += 1
+                return True
+        return False
+
+    def get(self, version: int):
+        """
+        Returns:
+            Сериализованный каталог для версии или None
+        """
+        if self._body is not None and self._body_version == version:
+            self.hits += 1
+            return self._body
+        self.misses += 1
+        return None
+
+    def put(self, version: int, body: bytes):
+        """
+        Запоминает сериализованный каталог
+
+        Args:
+            version: Версия, прочитанная ДО запроса к БД (если каталог успел измениться,
+                     версия уже ушла вперед и устаревший JSON не сохранится)
+            body: JSON каталога
+        """
+        if version == self.version:
+            self._body = body
+            self._body_version = version
+
+    def stats(self) -> dict:
+        """Текущая версия, попадания, промахи и ответы 304"""
+        return {
+            "version": self.version,
+            "bumps_total": self.bumps,
+            "hits_total": self.hits,
+            "misses_total": self.misses,
+            "not_modified_total": self.not_modified,
+        }
+
+
+class DeviceRegistry:
+    """
+    Справочник устройств editor -> device_id в памяти и счетчики активности до сброса в БД
+
+    Горячие пути (/scan) находят устройство без обращения к БД и только накапливают счетчики,
+    фоновая задача периодически прибавляет их к таблице devices одной операцией писателя.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._pending = {}
+        self.created = 0
+        self.flushes = 0
+
+    def load(self, rows):
+        """Полностью заменяет справочник парами (editor, device_id) из таблицы devices"""
+        self._ids = dict(rows)
+
+    def get(self, editor: str):
+        """
+        Returns:
+            ID устройства или None, если устройство еще не заведено
+        """
+        return self._ids.get(editor)
+
+    def add(self, editor: str, device_id: int):
+        """Запоминает новое устройство"""
+        self._ids[editor] = device_id
+        self.created += 1
+
+    def touch(self, device_id: int, timestamp: str, ts: int, scans: int = 0, edits: int = 0):
+        """
+        Отмечает активность устройства
+
+        Args:
+            device_id: ID устройства
+            timestamp: Время операции в формате БД
+            ts: То же время, unix time
+            scans: Сколько сканов ТСД добавить
+            edits: Сколько правок из веб-интерфейса добавить
+        """
+        entry = self._pending.get(device_id)
+        if entry is None:
+            self._pending[device_id] = [scans, edits, timestamp, ts]
+            return
+        entry[0] += scans
+        entry[1] += edits
+        if ts >= entry[3]:
+            entry[2] = timestamp
+            entry[3] = ts
+
+    def take_pending(self) -> list:
+        """
+        Забирает накопленные счетчики для записи в БД
+
+        Returns:
+            Кортежи (device_id, scans, edits, last_seen, last_seen_ts)
+        """
+        pending, self._pending = self._pending, {}
+        return [(device_id, *entry) for device_id, entry in pending.items()]
+
+    def restore_pending(self, rows: list):
+        """Возвращает счетчики, которые не удалось записать, чтобы они ушли со следующим сбросом"""
+        for device_id, scans, edits, last_seen, last_seen_ts in rows:
+            self.touch(device_id, last_seen, last_seen_ts, scans, edits)
+
+    def pending_for(self, device_id: int):
+        """Еще не записанные в БД счетчики устройства (scans, edits, last_seen, last_seen_ts) или None"""
+        entry = self._pending.get(device_id)
+        return tuple(entry) if entry else None
+
+    def stats(self) -> dict:
+        """Размер справочника, новые устройства, ожидающие записи счетчики и сбросы"""
+        return {
+            "size": len(self._ids),
+            "created_total": self.created,
+            "pending": len(self._pending),
+            "flushes_total": self.flushes,
+        }
+
+
+def crossed_below_min(old_quantity: int, new_quantity: int, old_min: int, new_min: int) -> bool:
+    """
+    Проверяет, что картридж только что перешел в низкий запас (quantity < min_qty)
+
+    True только на переходе: если запас уже был низким, повторные списания новых оповещений не дают.
+    """
+    return old_quantity >= old_min and new_quantity < new_min
+
+
+class LowStockAlerts:
+    """
+    Картриджи, запас которых опустился ниже минимума, до отправки оповещения
+
+    Пути записи (сканы и PATCH) сами определяют переход через минимум по старому и новому остатку
+    и отмечают его здесь за O(1), без просмотра таблицы. Фоновая задача раз в окно агрегации
+    забирает накопленные переходы и отправляет одно письмо на всех. Картридж, по которому
+    оповещение уже уходило, повторно не попадает в письмо до истечения cooldown_seconds.
+    """
+
+    def __init__(self, cooldown_seconds: int = 86400):
+        """
+        Args:
+            cooldown_seconds: Минимальный интервал между оповещениями по одному картриджу
+        """
+        self.cooldown_seconds = cooldown_seconds
+        self._pending = {}
+        self._alerted_at = {}
+        self.crossings = 0
+        self.suppressed = 0
+        self.alerted = 0
+
+    def note(self, cartridge_id: int, name: str, quantity: int, min_qty: int, now: float = None):
+        """Отмечает переход картриджа через минимум"""
+        if now is None:
+            now = time.time()
+        self.crossings += 1
+        alerted_at = self._alerted_at.get(cartridge_id)
+        if alerted_at is not None and now - alerted_at < self.cooldown_seconds:
+            self.suppressed += 1
+            return
+        self._pending[cartridge_id] = {"id": cartridge_id, "name": name, "quantity": quantity, "min_qty": min_qty}
+
+    def take_pending(self) -> list:
+        """Забирает накопленные за окно картриджи"""
+        pending, self._pending = self._pending, {}
+        return list(pending.values())
+
+    def restore_pending(self, items: list):
+        """Возвращает картриджи, оповещение по которым не удалось поставить в очередь"""
+        for item in items:
+            self._pending.setdefault(item["id"], item)
+
+    def mark_alerted(self, cartridge_ids: list, now: float = None):
+        """Запоминает время оповещения для cooldown"""
+        if now is None:
+            now = time.time()
+        for cartridge_id in cartridge_ids:
+            self._alerted_at[cartridge_id] = now
+        self.alerted += len(cartridge_ids)
+
+    def stats(self) -> dict:
+        """Ожидающие оповещения, переходы через минимум, подавленные cooldown'ом и оповещенные картриджи"""
+        return {
+            "pending": len(self._pending),
+            "crossings_total": self.crossings,
+            "suppressed_total": self.suppressed,
+            "alerted_total": self.alerted,
+        }
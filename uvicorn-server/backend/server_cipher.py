@@ -2,52 +2,88 @@
 CartridgeMaster - модуль для шифрования и расшифровки данных.
 
 Содержит функции для работы с AES шифрованием при обмене данными с ТСД.
+Формат сообщения: base64(IV 16 байт + AES-CBC шифротекст с PKCS7 паддингом).
 """
 
 import base64
+import logging
+
 from Crypto.Cipher import AES
 from Crypto.Util.Padding import unpad, pad
 from config import AES_KEY
 
+logger = logging.getLogger("my_custom_logger")
+
+
+class AESCipher:
+    """
+    Сервис шифрования с заранее подготовленным ключом
+
+    Ключ кодируется в байты один раз при создании объекта, а не на каждый запрос.
+    CBC-объект привязан к IV и хранит состояние цепочки, поэтому создается на каждое сообщение.
+    """
+
+    def __init__(self, key: str):
+        """
+        Args:
+            key: Ключ AES (16/24/32 символа)
+        """
+        self._key = key.encode('utf-8')
+
+    def decrypt(self, encrypted_b64: str):
+        """
+        Расшифровывает строку base64 (IV + шифротекст)
+
+        Returns:
+            Расшифрованная строка в utf-8 или None, если пакет поврежден или ключ не тот
+        """
+        try:
+            combined = base64.b64decode(encrypted_b64)
+            if len(combined) < 32:
+                raise ValueError("Неверная длина шифротекста")
+            cipher = AES.new(self._key, AES.MODE_CBC, combined[:16])
+            return unpad(cipher.decrypt(combined[16:]), AES.block_size).decode('utf-8')
+        except Exception as e:
+            logger.warning(f"Ошибка расшифровки: {e}")
+            return None
+
+    def encrypt(self, data_str: str) -> str:
+        """
+        Шифрует строку, IV генерируется случайно для каждого сообщения
+
+        Returns:
+            Строка base64 (IV + шифротекст)
+        """
+        cipher = AES.new(self._key, AES.MODE_CBC)
+        ct_bytes = cipher.encrypt(pad(data_str.encode('utf-8'), AES.block_size))
+        return base64.b64encode(cipher.iv + ct_bytes).decode('utf-8')
+
+
+# Общий экземпляр на весь процесс
+cipher = AESCipher(AES_KEY)
+
 
 def decrypt_payload(encrypted_b64: str):
     """
     Расшифровывает переданную строку encrypted_b64 по алгоритму AES и ключу 'AES_KEY'
-    
+
     Args:
         encrypted_b64: строка в base64
-       
+
     Returns:
         decrypted_bytes: расшифрованная строка в utf-8 или None
     """
-    try:
-        # Декодируем из Base64
-        combined = base64.b64decode(encrypted_b64)
-        # Извлекаем IV (первые 16 байт) и зашифрованные данные
-        iv = combined[:16]
-        ciphertext = combined[16:]
-        # Настраиваем AES CBC
-        cipher = AES.new(AES_KEY.encode('utf-8'), AES.MODE_CBC, iv)
-        # Расшифровываем и убираем Padding
-        decrypted_bytes = unpad(cipher.decrypt(ciphertext), AES.block_size)
-        return decrypted_bytes.decode('utf-8')
-    except Exception as e:
-        print(f"Ошибка расшифровки: {e}")
-        return None
-    
+    return cipher.decrypt(encrypted_b64)
+
 
 def encrypt_payload(data_str: str):
     """
     Шифрует переданную строку data_str по алгоритму AES и ключу 'AES_KEY'
-    
+
     Args:
         data_str: строка для шифрования
-       
+
     Returns:
         str: строка в base64
     """
-    # IV сгенерируется сам
-    cipher = AES.new(AES_KEY.encode('utf-8'), AES.MODE_CBC) 
-    ct_bytes = cipher.encrypt(pad(data_str.encode('utf-8'), AES.block_size))
-    combined = cipher.iv + ct_bytes
-    return base64.b64encode(combined).decode('utf-8')
+    return cipher.encrypt(data_str)
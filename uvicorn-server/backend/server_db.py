@@ -4,12 +4,195 @@
 """
 
 import aiosqlite
+import asyncio
+import json
 import logging
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from pathlib import Path
 from config import DB_NAME
 
 logger = logging.getLogger("my_custom_logger")
 
 
+def sql_casefold(value):
+    """SQL функция casefold(x): регистронезависимый поиск, в том числе по кириллице (встроенный lower() только ASCII)"""
+    return value.casefold() if isinstance(value, str) else value
+
+
+def to_epoch(timestamp: str) -> int:
+    """
+    Переводит текстовое время в формате БД ('YYYY-MM-DD HH:MM:SS', локальное) в unix time
+
+    Текстовые колонки остаются для вывода в API, а рядом хранится целое время для фильтров и индексов.
+    """
+    return int(datetime.fromisoformat(timestamp).timestamp())
+
+
+################################### Пул соединений ########################################################
+class PoolTimeoutError(Exception):
+    """Не удалось получить соединение с БД за отведенное время"""
+
+
+class DatabasePool:
+    """
+    Пул соединений с БД: одно соединение-писатель и несколько соединений только для чтения
+
+    Каждое aiosqlite соединение - это отдельный рабочий поток, поэтому тяжелые SELECT'ы
+    (тепловая карта, каталог) на читателях не блокируют сканы на писателе.
+    В режиме WAL читатели видят последние закоммиченные данные и не мешают записи.
+    Писателем одновременно пользуется кто-то один: write() и пачки WriteCoalescer держат общий write_lock.
+    """
+
+    def __init__(self, db_name: str = DB_NAME, readers: int = 4, acquire_timeout: float = 5.0,
+                 health_check_idle: float = 30.0):
+        """
+        Args:
+            db_name: Путь к файлу БД
+            readers: Количество соединений для чтения
+            acquire_timeout: Сколько секунд ждать свободного читателя или писателя
+            health_check_idle: Через сколько секунд простоя проверять соединение перед выдачей
+        """
+        self.db_name = db_name
+        self.readers_count = readers
+        self.acquire_timeout = acquire_timeout
+        self.health_check_idle = health_check_idle
+        self.writer = None
+        self.write_lock = asyncio.Lock()
+        self._idle = asyncio.Queue()
+        self._last_used = {}
+        self._waiters = 0
+
+        self.acquire_total = 0
+        self.acquire_timeouts_total = 0
+        self.acquire_wait_seconds_total = 0.0
+        self.reconnects_total = 0
+        self.write_acquire_total = 0
+        self.write_acquire_timeouts_total = 0
+        self.write_acquire_wait_seconds_total = 0.0
+
+    async def open_writer(self) -> aiosqlite.Connection:
+        """Открывает соединение-писатель (таблицы и WAL создает init_database на нём)"""
+        self.writer = await aiosqlite.connect(self.db_name)
+        return self.writer
+
+    async def open_readers(self):
+        """Открывает соединения только для чтения, вызывать после init_database"""
+        for _ in range(self.readers_count):
+            conn = await self._connect_reader()
+            self._idle.put_nowait(conn)
+
+    async def _connect_reader(self) -> aiosqlite.Connection:
+        uri = Path(self.db_name).resolve().as_uri() + "?mode=ro"
+        conn = await aiosqlite.connect(uri, uri=True)
+        await conn.create_function("casefold", 1, sql_casefold, deterministic=True)
+        self._last_used[id(conn)] = time.monotonic()
+        return conn
+
+    async def _healthy(self, conn: aiosqlite.Connection) -> bool:
+        try:
+            cursor = await conn.execute("SELECT 1")
+            await cursor.fetchone()
+            return True
+        except Exception:
+            return False
+
+    @asynccontextmanager
+    async def reader(self):
+        """
+        Выдает соединение только для чтения и возвращает его в пул после использования
+
+        Raises:
+            PoolTimeoutError: если свободного соединения нет дольше acquire_timeout
+        """
+        started = time.monotonic()
+        self._waiters += 1
+        try:
+            conn = await asyncio.wait_for(self._idle.get(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.acquire_timeouts_total += 1
+            raise PoolTimeoutError("Нет свободных соединений с БД")
+        finally:
+            self._waiters -= 1
+        self.acquire_total += 1
+        self.acquire_wait_seconds_total += time.monotonic() - started
+
+        # Давно простаивавшее соединение проверяем и при необходимости переоткрываем
+        if time.monotonic() - self._last_used.get(id(conn), 0) > self.health_check_idle:
+            if not await self._healthy(conn):
+                conn = await self._replace(conn)
+
+        try:
+            yield conn
+        finally:
+            self._last_used[id(conn)] = time.monotonic()
+            self._idle.put_nowait(conn)
+
+    async def _replace(self, conn: aiosqlite.Connection) -> aiosqlite.Connection:
+        logger.warning("Соединение с БД для чтения не отвечает, переподключаемся")
+        self._last_used.pop(id(conn), None)
+        try:
+            await conn.close()
+        except Exception:
+            pass
+        self.reconnects_total += 1
+        return await self._connect_reader()
+
+    @asynccontextmanager
+    async def write(self):
+        """
+        Выдает соединение-писатель под write_lock (коммиты делает вызывающий)
+
+        Незакоммиченные к выходу изменения откатываются, чтобы их не подхватил следующий коммит.
+
+        Raises:
+            PoolTimeoutError: если писатель занят дольше acquire_timeout
+        """
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(self.write_lock.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.write_acquire_timeouts_total += 1
+            raise PoolTimeoutError("Соединение с БД для записи занято")
+        self.write_acquire_total += 1
+        self.write_acquire_wait_seconds_total += time.monotonic() - started
+        try:
+            yield self.writer
+        finally:
+            try:
+                if self.writer.in_transaction:
+                    await self.writer.rollback()
+            finally:
+                self.write_lock.release()
+
+    async def close(self):
+        """Закрывает все соединения"""
+        while not self._idle.empty():
+            conn = self._idle.get_nowait()
+            await conn.close()
+        self._last_used.clear()
+        if self.writer is not None:
+            await self.writer.close()
+            self.writer = None
+
+    def stats(self) -> dict:
+        """Состояние пула для мониторинга"""
+        return {
+            "readers": self.readers_count,
+            "readers_idle": self._idle.qsize(),
+            "waiters": self._waiters,
+            "acquire_total": self.acquire_total,
+            "acquire_timeouts_total": self.acquire_timeouts_total,
+            "acquire_wait_seconds_total": self.acquire_wait_seconds_total,
+            "reconnects_total": self.reconnects_total,
+            "write_locked": int(self.write_lock.locked()),
+            "write_acquire_total": self.write_acquire_total,
+            "write_acquire_timeouts_total": self.write_acquire_timeouts_total,
+            "write_acquire_wait_seconds_total": self.write_acquire_wait_seconds_total,
+        }
+
+
 ################################### Инициализация таблиц БД ########################################################
 async def init_database(db_connection):
     """
@@ -72,6 +255,67 @@ async def init_database(db_connection):
             )
         """)
         
+        # Целочисленное время (unix time) рядом с текстовыми колонками: диапазонные фильтры
+        # идут по индексу без strftime на каждой строке, а формат вывода в API не меняется
+        for table, column in (("history", "created_ts"), ("cartridges", "last_update_ts"), ("sessions", "expires_ts")):
+            try:
+                await db_connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} INTEGER")
+            except:
+                pass  # Колонка уже существует
+        
+        # Заполняем целое время из текстовых значений. Время в базе локальное, поэтому модификатор 'utc'
+        # переводит его в UTC перед '%s' - получается то же значение, что дает to_epoch()
+        for table, column, text_column in (("history", "created_ts", "created_at"),
+                                           ("cartridges", "last_update_ts", "last_update"),
+                                           ("sessions", "expires_ts", "expires_at")):
+            await db_connection.execute(f"""
+                UPDATE {table} SET {column} = CAST(strftime('%s', {text_column}, 'utc') AS INTEGER)
+                WHERE {column} IS NULL AND {text_column} IS NOT NULL
+            """)
+        
+        # Сжатые строки журнала (server_archive.compact_old_history): сколько операций объединено
+        # и время последней из них. Для обычной строки op_count и ended_* пустые (одна операция)
+        for column, column_type in (("op_count", "INTEGER"), ("ended_at", "TIMESTAMP"), ("ended_ts", "INTEGER")):
+            try:
+                await db_connection.execute(f"ALTER TABLE history ADD COLUMN {column} {column_type}")
+            except:
+                pass  # Колонка уже существует
+        
+        # Справочник устройств (ТСД и браузеры), с которых меняются остатки, со счетчиками активности.
+        # История ссылается на устройство через device_id, а колонка editor у таких строк пустая
+        await db_connection.execute("""
+            CREATE TABLE IF NOT EXISTS devices (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                editor TEXT NOT NULL UNIQUE,
+                platform TEXT,
+                host TEXT,
+                first_seen TIMESTAMP,
+                last_seen TIMESTAMP,
+                last_seen_ts INTEGER,
+                scans_total INTEGER NOT NULL DEFAULT 0,
+                edits_total INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        try:
+            await db_connection.execute("ALTER TABLE history ADD COLUMN device_id INTEGER REFERENCES devices(id)")
+        except:
+            pass  # Колонка уже существует
+        
+        # Журнал с текстом editor из справочника устройств - через него читают API, выгрузка и архив
+        await db_connection.execute(f"""
+            CREATE VIEW IF NOT EXISTS history_full AS
+            SELECT h.increment, h.cartridge_id, h.cartridge_name, h.delta,
+                   COALESCE(d.editor, h.editor) AS editor,
+                   h.username, h.created_at, h.created_ts, h.op_count, h.ended_at, h.ended_ts, h.device_id
+            FROM history h
+            LEFT JOIN devices d ON d.id = h.device_id
+        """)
+        
+        await db_connection.execute("CREATE INDEX IF NOT EXISTS idx_history_created_ts ON history(created_ts)")
+        await db_connection.execute("CREATE INDEX IF NOT EXISTS idx_history_cartridge_created_ts ON history(cartridge_id, created_ts)")
+        await db_connection.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires_ts ON sessions(expires_ts)")
+        await db_connection.execute("CREATE INDEX IF NOT EXISTS idx_history_device_created_ts ON history(device_id, created_ts)")
+        
         # Таблица email адресов для уведомлений
         await db_connection.execute("""
             CREATE TABLE IF NOT EXISTS emails (
@@ -89,6 +333,77 @@ async def init_database(db_connection):
             )
         """)
         
+        # Сводные таблицы расхода по дням и месяцам. Обновляются вместе с каждой записью в history,
+        # чтобы аналитика не сканировала всю историю. Ключ включает название картриджа,
+        # потому что аналитика показывает переименованный картридж отдельной строкой
+        for table, period in (("consumption_daily", "day"), ("consumption_monthly", "month")):
+            await db_connection.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    {period} TEXT NOT NULL,
+                    cartridge_id INTEGER NOT NULL,
+                    cartridge_name TEXT NOT NULL,
+                    spent INTEGER NOT NULL DEFAULT 0,
+                    added INTEGER NOT NULL DEFAULT 0,
+                    ops INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY ({period}, cartridge_id, cartridge_name)
+                )
+            """)
+        
+        # Индексы для постраничного каталога: сортировки и фильтр "есть штрихкод"
+        await db_connection.execute("CREATE INDEX IF NOT EXISTS idx_cartridges_name ON cartridges(cartridge_name)")
+        await db_connection.execute("CREATE INDEX IF NOT EXISTS idx_cartridges_quantity ON cartridges(quantity)")
+        await db_connection.execute("DROP INDEX IF EXISTS idx_cartridges_last_update")
+        await db_connection.execute("CREATE INDEX IF NOT EXISTS idx_cartridges_last_update_ts ON cartridges(last_update_ts)")
+        await db_connection.execute("CREATE INDEX IF NOT EXISTS idx_barcodes_cartridge ON barcodes(cartridge_id)")
+        # Частичный индекс - множество картриджей с низким запасом. SQLite поддерживает его сам в каждом
+        # UPDATE quantity/min_qty, а выборки с условием quantity < min_qty читают только его строки
+        await db_connection.execute(
+            "CREATE INDEX IF NOT EXISTS idx_cartridges_low_stock ON cartridges(cartridge_name) WHERE quantity < min_qty"
+        )
+        
+        # Журнал изменений каталога: version - версия каталога после изменения картриджа.
+        # AUTOINCREMENT гарантирует, что версии не переиспользуются после компактирования журнала
+        await db_connection.execute("""
+            CREATE TABLE IF NOT EXISTS catalog_changes (
+                version INTEGER PRIMARY KEY AUTOINCREMENT,
+                cartridge_id INTEGER NOT NULL,
+                op TEXT NOT NULL,
+                changed_at TIMESTAMP NOT NULL
+            )
+        """)
+
+        # Очередь исходящих писем (server_outbox): одна строка на получателя.
+        # digest - хэш темы и тела, по нему отсекаются повторы и собираются письма на несколько адресов
+        await db_connection.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                recipient TEXT NOT NULL,
+                subject TEXT NOT NULL,
+                body TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_ts INTEGER NOT NULL,
+                next_attempt_ts INTEGER NOT NULL,
+                sent_ts INTEGER,
+                last_error TEXT
+            )
+        """)
+        await db_connection.execute("CREATE INDEX IF NOT EXISTS idx_outbox_status_next ON outbox(status, next_attempt_ts)")
+        await db_connection.execute("CREATE INDEX IF NOT EXISTS idx_outbox_digest ON outbox(digest, recipient, created_ts)")
+
+        # Результаты сканов из /scan/batch по ID скана: ТСД, не получивший ответ, отправляет очередь
+        # повторно в новом пакете, и уже примененные сканы получают свой прежний результат
+        await db_connection.execute("""
+            CREATE TABLE IF NOT EXISTS scan_results (
+                item_id TEXT PRIMARY KEY,
+                created_ts INTEGER NOT NULL,
+                result TEXT NOT NULL
+            ) WITHOUT ROWID
+        """)
+        await db_connection.execute("CREATE INDEX IF NOT EXISTS idx_scan_results_created_ts ON scan_results(created_ts)")
+
         await db_connection.commit()
         logger.info("База данных проинициализирована.")
         
@@ -112,22 +427,18 @@ async def get_cartridge_by_barcode(db: aiosqlite.Connection, barcode: str):
     return await cursor.fetchone()
 
 
-async def get_cartridge_name_and_quantity(db: aiosqlite.Connection, cartridge_id: int):
+async def get_all_barcodes(db: aiosqlite.Connection):
     """
-    Получает название и количество картриджа по ID
+    Получает все привязки штрихкодов к картриджам
     
     Args:
         db: Подключение к БД
-        cartridge_id: ID картриджа
         
     Returns:
-        Кортеж (cartridge_name, quantity) или None если не найден
+        Список кортежей (barcode, cartridge_id)
     """
-    cursor = await db.execute(
-        "SELECT cartridge_name, quantity FROM cartridges WHERE id = ?", 
-        (cartridge_id,)
-    )
-    return await cursor.fetchone()
+    cursor = await db.execute("SELECT barcode, cartridge_id FROM barcodes")
+    return await cursor.fetchall()
 
 
 async def get_cartridge_name(db: aiosqlite.Connection, cartridge_id: int):
@@ -149,36 +460,54 @@ async def get_cartridge_name(db: aiosqlite.Connection, cartridge_id: int):
     return row[0] if row else None
 
 
-async def update_cartridge_quantity_add(db: aiosqlite.Connection, cartridge_id: int):
+async def apply_scan_delta(db: aiosqlite.Connection, barcode: str, delta: int):
     """
-    Увеличивает количество картриджа на 1
+    Атомарно применяет скан: находит картридж по штрихкоду и меняет остаток на delta
+    одним UPDATE ... RETURNING. Остаток не может уйти в минус.
     
     Args:
         db: Подключение к БД
-        cartridge_id: ID картриджа
+        barcode: Отсканированный штрихкод
+        delta: Изменение количества (+1 или -1)
+        
+    Returns:
+        Кортеж (cartridge_id, cartridge_name, quantity, min_qty) с новым остатком
+        или None, если штрихкод не привязан или остаток ушел бы в минус.
+        min_qty нужен для проверки перехода через минимум без отдельного запроса
     """
-    await db.execute(
-        "UPDATE cartridges SET quantity = quantity + 1 WHERE id = ?", 
-        (cartridge_id,)
+    cursor = await db.execute(
+        """
+        UPDATE cartridges SET quantity = quantity + ?
+        WHERE id = (SELECT cartridge_id FROM barcodes WHERE barcode = ?)
+          AND quantity + ? >= 0
+        RETURNING id, cartridge_name, quantity, min_qty
+        """,
+        (delta, barcode, delta)
     )
+    # fetchall дочитывает RETURNING до конца, чтобы выражение не осталось незавершенным
+    rows = await cursor.fetchall()
+    return rows[0] if rows else None
 
 
-async def update_cartridge_quantity_subtract(db: aiosqlite.Connection, cartridge_id: int):
+async def apply_scan(db: aiosqlite.Connection, barcode: str, delta: int, editor: str, timestamp: str, device_id: int = None):
     """
-    Уменьшает количество картриджа на 1 (если остаток > 0)
+    Применяет скан и сразу пишет его в историю в той же транзакции
     
     Args:
         db: Подключение к БД
-        cartridge_id: ID картриджа
+        barcode: Отсканированный штрихкод
+        delta: Изменение количества (+1 или -1)
+        editor: Информация о редакторе (IP, платформа)
+        timestamp: Время записи
+        device_id: ID устройства из справочника devices
         
     Returns:
-        Объект cursor для проверки rowcount (количество затронутых строк)
+        Кортеж (cartridge_id, cartridge_name, quantity, min_qty) или None, как в apply_scan_delta
     """
-    cursor = await db.execute(
-        "UPDATE cartridges SET quantity = quantity - 1 WHERE id = ? AND quantity > 0", 
-        (cartridge_id,)
-    )
-    return cursor
+    row = await apply_scan_delta(db, barcode, delta)
+    if row:
+        await add_history_record(db, row[0], row[1], delta, editor, timestamp, device_id=device_id)
+    return row
 
 
 async def get_all_cartridges(db: aiosqlite.Connection):
@@ -217,23 +546,120 @@ async def get_all_cartridges(db: aiosqlite.Connection):
     ]
 
 
-async def get_cartridge_quantity(db: aiosqlite.Connection, cartridge_id: int):
+async def get_cartridge_item(db: aiosqlite.Connection, cartridge_id: int):
     """
-    Получает текущее количество картриджа
+    Получает информацию об одном картридже в том же формате, что и get_all_cartridges
     
     Args:
         db: Подключение к БД
         cartridge_id: ID картриджа
         
     Returns:
-        Количество картриджа (quantity) или None
+        Словарь с данными картриджа или None если картридж не найден
     """
-    async with db.execute(
-        "SELECT quantity FROM cartridges WHERE id = ?", 
-        (cartridge_id,)
-    ) as cursor:
-        row = await cursor.fetchone()
-        return row[0] if row else None
+    cursor = await db.execute("""
+        SELECT 
+            c.id, 
+            c.cartridge_name,
+            c.quantity,
+            c.min_qty,
+            c.last_update, 
+            GROUP_CONCAT(DISTINCT b.barcode) as barcodes
+        FROM cartridges c
+        LEFT JOIN barcodes b ON c.id = b.cartridge_id
+        WHERE c.id = ?
+        GROUP BY c.id
+    """, (cartridge_id,))
+    r = await cursor.fetchone()
+    if not r:
+        return None
+    return {
+        "id": r[0],
+        "name": r[1],
+        "quantity": r[2],
+        "min_qty": r[3],
+        "last_update": r[4],
+        "barcodes": r[5].split(",") if r[5] else []
+    }
+
+
+# Допустимые сортировки постраничного каталога: имя параметра -> колонка
+CATALOG_SORT_COLUMNS = {
+    "name": "c.cartridge_name",
+    "quantity": "c.quantity",
+    "last_update": "c.last_update_ts",
+}
+
+
+async def get_cartridges_page(db: aiosqlite.Connection, limit: int, sort: str = "name", descending: bool = False,
+                              after: tuple = None, q: str = None, low_stock: bool = False, has_barcode: bool = False):
+    """
+    Получает страницу каталога с фильтрами и keyset-пагинацией
+    
+    Страница продолжается строго после ключа (значение сортировки, id) последней строки
+    предыдущей страницы, поэтому глубина страницы не влияет на стоимость запроса,
+    а вставки и удаления между запросами не дают дублей и пропусков.
+    Поиск по подстроке (q) требует функции casefold, она есть на соединениях-читателях пула.
+    
+    Args:
+        db: Подключение к БД (читатель из DatabasePool)
+        limit: Размер страницы
+        sort: Ключ из CATALOG_SORT_COLUMNS
+        descending: Сортировка по убыванию
+        after: Ключ (значение сортировки, id) последней строки предыдущей страницы или None
+        q: Подстрока названия (без учета регистра)
+        low_stock: Только картриджи с остатком меньше минимума
+        has_barcode: Только картриджи с привязанными штрихкодами
+        
+    Returns:
+        Кортеж (список словарей в формате get_all_cartridges,
+                ключ (значение сортировки, id) последней строки для следующей страницы или None)
+    """
+    column = CATALOG_SORT_COLUMNS[sort]
+    direction = "DESC" if descending else "ASC"
+    conditions = []
+    params = []
+
+    if after is not None:
+        conditions.append(f"({column}, c.id) {'<' if descending else '>'} (?, ?)")
+        params.extend(after)
+    if q:
+        conditions.append("instr(casefold(c.cartridge_name), ?) > 0")
+        params.append(q.casefold())
+    if low_stock:
+        conditions.append("c.quantity < c.min_qty")
+    if has_barcode:
+        conditions.append("EXISTS (SELECT 1 FROM barcodes b WHERE b.cartridge_id = c.id)")
+
+    where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+    # Берем на одну строку больше, чтобы узнать, есть ли следующая страница
+    params.append(limit + 1)
+    cursor = await db.execute(f"""
+        SELECT 
+            c.id, 
+            c.cartridge_name,
+            c.quantity,
+            c.min_qty,
+            c.last_update, 
+            (SELECT GROUP_CONCAT(b.barcode) FROM barcodes b WHERE b.cartridge_id = c.id) AS barcodes,
+            {column} AS sort_key
+        FROM cartridges c
+        {where}
+        ORDER BY {column} {direction}, c.id {direction}
+        LIMIT ?
+    """, params)
+    rows = await cursor.fetchall()
+    next_key = (rows[limit - 1][6], rows[limit - 1][0]) if len(rows) > limit else None
+    return [
+        {
+            "id": r[0],
+            "name": r[1],
+            "quantity": r[2],
+            "min_qty": r[3],
+            "last_update": r[4],
+            "barcodes": r[5].split(",") if r[5] else []
+        } for r in rows[:limit]
+    ], next_key
 
 
 async def get_cartridge_by_id(db: aiosqlite.Connection, cartridge_id: int):
@@ -265,8 +691,8 @@ async def update_cartridge_details(db: aiosqlite.Connection, cartridge_id: int,
     Обновляет карточку картриджа по всем полям, используемым в API PATCH
     """
     await db.execute(
-        "UPDATE cartridges SET quantity = ?, min_qty = ?, cartridge_name = ?, last_update = ? WHERE id = ?",
-        (new_stock, new_min, new_name, timestamp, cartridge_id)
+        "UPDATE cartridges SET quantity = ?, min_qty = ?, cartridge_name = ?, last_update = ?, last_update_ts = ? WHERE id = ?",
+        (new_stock, new_min, new_name, timestamp, to_epoch(timestamp), cartridge_id)
     )
 
 
@@ -284,28 +710,42 @@ async def remove_barcode(db: aiosqlite.Connection, barcode: str, cartridge_id: i
     return cursor.rowcount
 
 
-async def update_cartridge_quantity(db: aiosqlite.Connection, cartridge_id: int, new_quantity: int, timestamp: str):
+# Прибавление одной записи истории к сводным таблицам расхода: spent - списано, added - добавлено
+CONSUMPTION_ROLLUP_SQL = [
     """
-    Обновляет количество и время обновления картриджа
-    
-    Args:
-        db: Подключение к БД
-        cartridge_id: ID картриджа
-        new_quantity: Новое количество
-        timestamp: Новое время обновления
-    Returns:
-        Ничего не возвращает, выполняет операцию с базой
+    INSERT INTO consumption_daily (day, cartridge_id, cartridge_name, spent, added, ops)
+    VALUES (strftime('%Y-%m-%d', :ts), :cartridge_id, :cartridge_name, :spent, :added, 1)
+    ON CONFLICT (day, cartridge_id, cartridge_name) DO UPDATE SET
+        spent = spent + excluded.spent,
+        added = added + excluded.added,
+        ops = ops + 1
+    """,
     """
-    await db.execute(
-        "UPDATE cartridges SET quantity = ?, last_update = ? WHERE id = ?", 
-        (new_quantity, timestamp, cartridge_id)
-    )
+    INSERT INTO consumption_monthly (month, cartridge_id, cartridge_name, spent, added, ops)
+    VALUES (strftime('%Y-%m', :ts), :cartridge_id, :cartridge_name, :spent, :added, 1)
+    ON CONFLICT (month, cartridge_id, cartridge_name) DO UPDATE SET
+        spent = spent + excluded.spent,
+        added = added + excluded.added,
+        ops = ops + 1
+    """,
+]
+
+
+def _rollup_params(cartridge_id: int, cartridge_name: str, delta: int, timestamp: str) -> dict:
+    return {
+        "ts": timestamp,
+        "cartridge_id": cartridge_id,
+        "cartridge_name": cartridge_name,
+        "spent": -delta if delta < 0 else 0,
+        "added": delta if delta > 0 else 0,
+    }
 
 
 async def add_history_record(db: aiosqlite.Connection, cartridge_id: int, 
-                             cartridge_name: str, delta: int, editor: str, timestamp: str, username: str = None):
+                             cartridge_name: str, delta: int, editor: str, timestamp: str, username: str = None,
+                             device_id: int = None):
     """
-    Добавляет запись в историю изменений
+    Добавляет запись в историю изменений и обновляет сводные таблицы расхода
     
     Args:
         db: Подключение к БД
@@ -315,22 +755,113 @@ async def add_history_record(db: aiosqlite.Connection, cartridge_id: int,
         editor: Информация о редакторе (IP, платформа, и т.д.)
         timestamp: Время записи
         username: Имя пользователя (опционально, для операций от пользователя через веб)
+        device_id: ID устройства из справочника devices (тогда editor в строке не хранится)
     Returns:
         Ничего не возвращает, выполняет операцию с базой
     """
     await db.execute(
         """
-        INSERT INTO history (cartridge_id, cartridge_name, delta, editor, username, created_at) 
-        VALUES (?, ?, ?, ?, ?, ?)
+        INSERT INTO history (cartridge_id, cartridge_name, delta, editor, username, created_at, created_ts, device_id) 
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, 
+        (cartridge_id, cartridge_name, delta, "" if device_id else editor, username, timestamp, to_epoch(timestamp), device_id)
+    )
+    params = _rollup_params(cartridge_id, cartridge_name, delta, timestamp)
+    for sql in CONSUMPTION_ROLLUP_SQL:
+        await db.execute(sql, params)
+
+
+async def add_history_records(db: aiosqlite.Connection, records: list):
+    """
+    Добавляет пачку записей в историю изменений одним executemany и обновляет сводные таблицы расхода
+    
+    Args:
+        db: Подключение к БД
+        records: Список кортежей (cartridge_id, cartridge_name, delta, editor, username, timestamp, device_id)
+    Returns:
+        Ничего не возвращает, выполняет операцию с базой
+    """
+    if not records:
+        return
+    await db.executemany(
+        """
+        INSERT INTO history (cartridge_id, cartridge_name, delta, editor, username, created_at, created_ts, device_id) 
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
         """, 
-        (cartridge_id, cartridge_name, delta, editor, username, timestamp)
+        [
+            (cartridge_id, cartridge_name, delta, "" if device_id else editor, username, timestamp, to_epoch(timestamp), device_id)
+            for cartridge_id, cartridge_name, delta, editor, username, timestamp, device_id in records
+        ]
     )
+    params = [
+        _rollup_params(cartridge_id, cartridge_name, delta, timestamp)
+        for cartridge_id, cartridge_name, delta, _, _, timestamp, _ in records
+    ]
+    for sql in CONSUMPTION_ROLLUP_SQL:
+        await db.executemany(sql, params)
+
+
+# Версия заполнения сводных таблиц из history: при изменении формата сводок увеличить, backfill пройдет заново
+CONSUMPTION_ROLLUP_VERSION = "2"
+
+
+async def backfill_consumption_rollups(db: aiosqlite.Connection, archives: list = ()) -> bool:
+    """
+    Однократно заполняет сводные таблицы расхода из всей истории, включая файлы архива
+
+    Выполняется при старте до запуска писателя. Пересчет и отметка о нем в settings
+    коммитятся одной транзакцией, поэтому прерванный пересчет просто повторится при следующем старте.
+    Сжатая строка журнала (compact_history_day) считается за op_count операций.
+
+    Args:
+        db: Подключение к БД (писатель)
+        archives: Пары (год, путь к файлу) из server_archive.list_history_archives - годы,
+                  перенесенные из основной базы, без них пересчет потерял бы их сводки
+
+    Returns:
+        True если пересчет выполнялся, False если сводки уже актуальны
+    """
+    if await get_setting(db, "consumption_rollup_version") == CONSUMPTION_ROLLUP_VERSION:
+        return False
+
+    # Архивы подключаются только на время пересчета: писателю они больше не нужны
+    sources = await attach_history_archives(db, archives)
+    try:
+        await _fill_consumption_rollups(db, history_union(
+            sources, "cartridge_id, cartridge_name, delta, created_at, op_count"
+        ))
+    finally:
+        if len(sources) > 1:
+            # DETACH невозможен внутри транзакции: после ошибки сначала откатываем пересчет
+            if db.in_transaction:
+                await db.rollback()
+            await attach_history_archives(db, [])
+    return True
+
+
+async def _fill_consumption_rollups(db: aiosqlite.Connection, source: str):
+    for table, period, period_format in (("consumption_daily", "day", "%Y-%m-%d"), ("consumption_monthly", "month", "%Y-%m")):
+        await db.execute(f"DELETE FROM {table}")
+        await db.execute(f"""
+            INSERT INTO {table} ({period}, cartridge_id, cartridge_name, spent, added, ops)
+            SELECT strftime('{period_format}', created_at),
+                   cartridge_id,
+                   cartridge_name,
+                   SUM(CASE WHEN delta < 0 THEN -delta ELSE 0 END),
+                   SUM(CASE WHEN delta > 0 THEN delta ELSE 0 END),
+                   SUM(COALESCE(op_count, 1))
+            FROM {source}
+            WHERE created_at IS NOT NULL AND strftime('{period_format}', created_at) IS NOT NULL
+            GROUP BY 1, cartridge_id, cartridge_name
+        """)
+    await set_setting(db, "consumption_rollup_version", CONSUMPTION_ROLLUP_VERSION)
+    await db.commit()
 
 
 async def get_yearly_expense_heatmap(db: aiosqlite.Connection, year: int):
     """
     Собирает данные для тепловой карты расходов по картриджам за выбранный год.
-    Учитываются только отрицательные значения delta из таблицы history.
+    Учитываются только отрицательные значения delta (столбец spent сводной таблицы consumption_monthly).
 
     Args:
         db: Подключение к БД
@@ -346,11 +877,12 @@ async def get_yearly_expense_heatmap(db: aiosqlite.Connection, year: int):
         "Июль", "Август", "Сентябрь", "Октябрь", "Ноябрь", "Декабрь"
     ]
 
+    # Читаем только месячную сводку: ее размер зависит от числа картриджей и месяцев, а не от длины истории
     years_cursor = await db.execute(
         """
-        SELECT DISTINCT CAST(strftime('%Y', created_at) AS INTEGER) AS year_value
-        FROM history
-        WHERE delta < 0 AND created_at IS NOT NULL
+        SELECT DISTINCT CAST(substr(month, 1, 4) AS INTEGER) AS year_value
+        FROM consumption_monthly
+        WHERE spent > 0
         ORDER BY year_value DESC
         """
     )
@@ -360,16 +892,15 @@ async def get_yearly_expense_heatmap(db: aiosqlite.Connection, year: int):
     cursor = await db.execute(
         """
         SELECT cartridge_name,
-               CAST(strftime('%m', created_at) AS INTEGER) AS month_value,
-               SUM(ABS(delta)) AS total_spent
-        FROM history
-        WHERE delta < 0
-          AND created_at IS NOT NULL
-          AND strftime('%Y', created_at) = ?
+               CAST(substr(month, 6, 2) AS INTEGER) AS month_value,
+               SUM(spent) AS total_spent
+        FROM consumption_monthly
+        WHERE month BETWEEN ? AND ?
+          AND spent > 0
         GROUP BY cartridge_id, cartridge_name, month_value
         ORDER BY cartridge_name COLLATE NOCASE ASC, month_value ASC
         """,
-        (str(year),)
+        (f"{year:04d}-01", f"{year:04d}-12")
     )
     rows = await cursor.fetchall()
 
@@ -397,6 +928,294 @@ async def get_yearly_expense_heatmap(db: aiosqlite.Connection, year: int):
     }
 
 
+async def get_history_page(db: aiosqlite.Connection, limit: int, after: int = None, descending: bool = True,
+                           until: int = None, cartridge_id: int = None, ts_from: int = None, ts_to: int = None,
+                           editor: str = None, username: str = None, sign: str = None, device_id: int = None,
+                           sources: list = ("history_full",)):
+    """
+    Страница журнала history с фильтрами, keyset-пагинация по increment
+
+    Args:
+        db: Подключение к БД
+        limit: Размер страницы
+        after: increment последней строки предыдущей страницы или None
+        descending: Сначала новые записи
+        until: Верхняя граница increment включительно (выгрузка фиксирует ее в начале, чтобы не догонять новые сканы)
+        cartridge_id: Только записи картриджа
+        ts_from: Начало периода, unix time включительно
+        ts_to: Конец периода, unix time не включительно
+        editor: Точное значение editor (устройство/клиент)
+        username: Точное имя пользователя
+        sign: 'negative' - только списания, 'positive' - только приходы
+        device_id: Только записи устройства (по индексу idx_history_device_created_ts)
+        sources: Таблицы журнала (history_full и подключенные архивы, см. attach_history_archives)
+
+    Returns:
+        Кортеж (список словарей записей, increment последней строки для следующей страницы или None)
+    """
+    conditions = []
+    params = []
+    if after is not None:
+        conditions.append("increment < ?" if descending else "increment > ?")
+        params.append(after)
+    if until is not None:
+        conditions.append("increment <= ?")
+        params.append(until)
+    if cartridge_id is not None:
+        conditions.append("cartridge_id = ?")
+        params.append(cartridge_id)
+    # Диапазон по целому времени идет по индексам idx_history_created_ts / idx_history_cartridge_created_ts
+    if ts_from is not None:
+        conditions.append("created_ts >= ?")
+        params.append(ts_from)
+    if ts_to is not None:
+        conditions.append("created_ts < ?")
+        params.append(ts_to)
+    if editor:
+        conditions.append("editor = ?")
+        params.append(editor)
+    if device_id is not None:
+        conditions.append("device_id = ?")
+        params.append(device_id)
+    if username:
+        conditions.append("username = ?")
+        params.append(username)
+    if sign == "negative":
+        conditions.append("delta < 0")
+    elif sign == "positive":
+        conditions.append("delta > 0")
+
+    where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+    order = "DESC" if descending else "ASC"
+    # Берем на одну строку больше, чтобы узнать, есть ли следующая страница
+    page_size = limit + 1
+    # Keyset и LIMIT стоят в каждой части объединения: каждый источник отдает не больше страницы
+    # по своему increment, и сортируются только они, а не весь журнал вместе с архивами
+    arms = [f"""
+        SELECT * FROM (
+            SELECT increment, cartridge_id, cartridge_name, delta, editor, username, created_at,
+                   COALESCE(op_count, 1), COALESCE(ended_at, created_at), device_id
+            FROM {source}
+            {where}
+            ORDER BY increment {order}
+            LIMIT ?
+        )""" for source in sources]
+    cursor = await db.execute(
+        " UNION ALL ".join(arms) + (f" ORDER BY 1 {order} LIMIT ?" if len(arms) > 1 else ""),
+        (params + [page_size]) * len(arms) + ([page_size] if len(arms) > 1 else [])
+    )
+    rows = await cursor.fetchall()
+    next_key = rows[limit - 1][0] if len(rows) > limit else None
+    return [
+        {
+            "increment": r[0],
+            "cartridge_id": r[1],
+            "cartridge_name": r[2],
+            "delta": r[3],
+            "editor": r[4],
+            "username": r[5],
+            "created_at": r[6],
+            "op_count": r[7],
+            "ended_at": r[8],
+            "device_id": r[9]
+        } for r in rows[:limit]
+    ], next_key
+
+
+async def get_history_max_increment(db: aiosqlite.Connection, sources: list = ("history",)) -> int:
+    """
+    Возвращает increment последней записи history (0 если журнал пуст)
+
+    Args:
+        db: Подключение к БД
+        sources: Таблицы журнала (см. attach_history_archives), максимум берется по каждой отдельно
+    """
+    result = 0
+    for source in sources:
+        cursor = await db.execute(f"SELECT MAX(increment) FROM {source}")
+        row = await cursor.fetchone()
+        result = max(result, row[0] or 0)
+    return result
+
+
+HISTORY_COLUMNS = ("increment, cartridge_id, cartridge_name, delta, editor, username, created_at, created_ts, "
+                   "op_count, ended_at, ended_ts, device_id")
+
+
+async def attach_history_archives(db: aiosqlite.Connection, archives: list) -> list:
+    """
+    Подключает к соединению файлы архива журнала и строит для каждого временное представление history_archive_YYYY
+
+    Архивы подключаются только для чтения (immutable - файл закрытого года больше не меняется).
+    Подключения и представления живут на соединении между запросами, пересоздаются только при смене набора.
+    increment в архиве сохраняется, поэтому он уникален во всех источниках и годится для keyset.
+    Общего представления через UNION ALL нет: сортировка по нему не использует индексы частей,
+    поэтому запросы обращаются к каждому источнику отдельно (см. get_history_page).
+
+    Args:
+        db: Подключение к БД (читатель)
+        archives: Пары (год, путь к файлу) из server_archive.list_history_archives
+
+    Returns:
+        Список таблиц для запросов: history_full и представления подключенных архивов
+    """
+    wanted = {f"history_{year}": path for year, path in archives}
+    cursor = await db.execute("PRAGMA database_list")
+    attached = {row[1] for row in await cursor.fetchall() if row[1].startswith("history_")}
+    cursor = await db.execute("SELECT name FROM temp.sqlite_master WHERE type = 'view' AND name LIKE 'history_archive_%'")
+    views = {row[0] for row in await cursor.fetchall()}
+
+    for name in attached - wanted.keys():
+        await db.execute(f"DROP VIEW IF EXISTS temp.history_archive_{name[len('history_'):]}")
+        await db.execute(f"DETACH DATABASE {name}")
+    sources = ["history_full"]
+    for name in sorted(wanted):
+        view = f"history_archive_{name[len('history_'):]}"
+        if name not in attached:
+            uri = Path(wanted[name]).resolve().as_uri() + "?mode=ro&immutable=1"
+            await db.execute(f"ATTACH DATABASE ? AS {name}", (uri,))
+        if name not in attached or view not in views:
+            # Колонки, которых нет в архивах старого формата, читаются как NULL
+            cursor = await db.execute(f"PRAGMA {name}.table_info(history)")
+            archive_columns = {row[1] for row in await cursor.fetchall()}
+            columns = [c if c in archive_columns else f"NULL AS {c}" for c in HISTORY_COLUMNS.split(", ")]
+            await db.execute(f"DROP VIEW IF EXISTS temp.{view}")
+            await db.execute(f"CREATE TEMP VIEW {view} AS SELECT {', '.join(columns)} FROM {name}.history")
+        sources.append(view)
+    return sources
+
+
+def history_union(sources: list, columns: str = HISTORY_COLUMNS) -> str:
+    """
+    Подзапрос со всеми строками источников журнала для агрегатов (сводки), где нужен полный проход
+
+    Args:
+        sources: Таблицы из attach_history_archives
+        columns: Нужные колонки
+    """
+    if len(sources) == 1:
+        return sources[0]
+    return "(" + " UNION ALL ".join(f"SELECT {columns} FROM {source}" for source in sources) + ")"
+
+
+async def compact_history_day(db: aiosqlite.Connection, ts_from: int, ts_to: int, gap_seconds: int) -> tuple:
+    """
+    Сжимает записи history за одни сутки, без коммита
+
+    Подряд идущие записи одного картриджа (с тем же названием), устройства (editor) и пользователя
+    с одним знаком delta и перерывами не больше gap_seconds сливаются в первую запись серии:
+    delta - сумма, op_count - количество операций, ended_at/ended_ts - время последней.
+    Серия не выходит за сутки и не смешивает списания с приходами, поэтому суммы по картриджу
+    за день и месяц, а также сводки расхода (spent/added) не меняются. Это проверяется до коммита:
+    при расхождении выбрасывается исключение, и писатель откатывает операцию.
+
+    Args:
+        db: Подключение к БД (писатель)
+        ts_from: Начало суток, unix time
+        ts_to: Начало следующих суток, unix time
+        gap_seconds: Максимальный перерыв между операциями одной серии
+
+    Returns:
+        Кортеж (строк за сутки до сжатия, удалено строк)
+
+    Raises:
+        RuntimeError: суммы после сжатия не совпали с исходными
+    """
+    totals_sql = """
+        SELECT cartridge_id,
+               SUM(delta),
+               SUM(CASE WHEN delta < 0 THEN -delta ELSE 0 END),
+               SUM(COALESCE(op_count, 1))
+        FROM history
+        WHERE created_ts >= ? AND created_ts < ?
+        GROUP BY cartridge_id
+    """
+    cursor = await db.execute(totals_sql, (ts_from, ts_to))
+    totals_before = await cursor.fetchall()
+
+    cursor = await db.execute("""
+        SELECT increment, cartridge_id, cartridge_name, device_id, editor, username, delta,
+               COALESCE(op_count, 1), COALESCE(ended_at, created_at), COALESCE(ended_ts, created_ts), created_ts
+        FROM history
+        WHERE created_ts >= ? AND created_ts < ? AND delta != 0
+        ORDER BY cartridge_id, cartridge_name, device_id, editor, username, created_ts, increment
+    """, (ts_from, ts_to))
+    rows = await cursor.fetchall()
+
+    runs = []
+    run = None
+    for increment, cartridge_id, cartridge_name, device_id, editor, username, delta, op_count, ended_at, ended_ts, created_ts in rows:
+        key = (cartridge_id, cartridge_name, device_id, editor, username, delta > 0)
+        if run is not None and run["key"] == key and created_ts - run["ended_ts"] <= gap_seconds:
+            run["delta"] += delta
+            run["op_count"] += op_count
+            run["ended_at"] = ended_at
+            run["ended_ts"] = max(run["ended_ts"], ended_ts)
+            run["merged"].append(increment)
+        else:
+            run = {"key": key, "increment": increment, "delta": delta, "op_count": op_count,
+                   "ended_at": ended_at, "ended_ts": ended_ts, "merged": []}
+            runs.append(run)
+
+    runs = [run for run in runs if run["merged"]]
+    if not runs:
+        return len(rows), 0
+    await db.executemany(
+        "UPDATE history SET delta = ?, op_count = ?, ended_at = ?, ended_ts = ? WHERE increment = ?",
+        [(run["delta"], run["op_count"], run["ended_at"], run["ended_ts"], run["increment"]) for run in runs]
+    )
+    removed = [(increment,) for run in runs for increment in run["merged"]]
+    await db.executemany("DELETE FROM history WHERE increment = ?", removed)
+
+    cursor = await db.execute(totals_sql, (ts_from, ts_to))
+    totals_after = await cursor.fetchall()
+    if totals_after != totals_before:
+        raise RuntimeError("суммы журнала после сжатия не совпали с исходными")
+    return len(rows), len(removed)
+
+
+async def get_history_next_ts(db: aiosqlite.Connection, ts_from: int):
+    """
+    Возвращает время первой записи history не раньше ts_from (unix time) или None
+    """
+    cursor = await db.execute("SELECT MIN(created_ts) FROM history WHERE created_ts >= ?", (ts_from,))
+    row = await cursor.fetchone()
+    return row[0]
+
+
+async def get_history_min_ts(db: aiosqlite.Connection):
+    """
+    Возвращает время самой старой записи history (unix time) или None, если журнал пуст
+    """
+    cursor = await db.execute("SELECT MIN(created_ts) FROM history")
+    row = await cursor.fetchone()
+    return row[0]
+
+
+async def delete_history_range(db: aiosqlite.Connection, ts_from: int, ts_to: int, until: int, limit: int) -> int:
+    """
+    Удаляет порцию записей history за период (после переноса в архив), без коммита
+
+    Args:
+        db: Подключение к БД (писатель)
+        ts_from: Начало периода, unix time включительно
+        ts_to: Конец периода, unix time не включительно
+        until: Удаляются только записи с increment не больше этого (последняя запись, попавшая в архив)
+        limit: Максимум строк за один вызов
+
+    Returns:
+        Количество удаленных строк
+    """
+    cursor = await db.execute("""
+        DELETE FROM history WHERE increment IN (
+            SELECT increment FROM history
+            WHERE created_ts >= ? AND created_ts < ? AND increment <= ?
+            LIMIT ?
+        )
+    """, (ts_from, ts_to, until, limit))
+    return cursor.rowcount
+
+
 async def commit_changes(db: aiosqlite.Connection):
     """
     Сохраняет все изменения в БД
@@ -416,24 +1235,23 @@ from datetime import datetime, timedelta
 
 async def create_session(db: aiosqlite.Connection, user_dn: str) -> str:
     """
-    Создает новую сессию для пользователя
+    Создает новую сессию для пользователя, без коммита (операция писателя)
     
     Args:
         db: Подключение к БД
         user_dn: DN пользователя
         
     Returns:
-        session_id: Уникальный ID сессии
+        Кортеж (session_id, expires_at): уникальный ID сессии и время её истечения
     """
     session_id = str(uuid.uuid4())
     expires_at = datetime.now() + timedelta(days=7)  # Сессия на 7 дней
     
     await db.execute(
-        "INSERT INTO sessions (session_id, user_dn, expires_at) VALUES (?, ?, ?)",
-        (session_id, user_dn, expires_at.isoformat())
+        "INSERT INTO sessions (session_id, user_dn, expires_at, expires_ts) VALUES (?, ?, ?, ?)",
+        (session_id, user_dn, expires_at.isoformat(), int(expires_at.timestamp()))
     )
-    await db.commit()
-    return session_id
+    return session_id, expires_at
 
 
 async def get_session(db: aiosqlite.Connection, session_id: str):
@@ -448,28 +1266,25 @@ async def get_session(db: aiosqlite.Connection, session_id: str):
         Кортеж (user_dn, expires_at) или None если сессия не найдена или истекла
     """
     cursor = await db.execute(
-        "SELECT user_dn, expires_at FROM sessions WHERE session_id = ?",
-        (session_id,)
+        "SELECT user_dn, expires_ts FROM sessions WHERE session_id = ? AND expires_ts > ?",
+        (session_id, int(time.time()))
     )
     row = await cursor.fetchone()
     if row:
-        user_dn, expires_at_str = row
-        expires_at = datetime.fromisoformat(expires_at_str)
-        if datetime.now() < expires_at:
-            return user_dn, expires_at
+        user_dn, expires_ts = row
+        return user_dn, datetime.fromtimestamp(expires_ts)
     return None
 
 
 async def delete_session(db: aiosqlite.Connection, session_id: str):
     """
-    Удаляет сессию
+    Удаляет сессию, без коммита (операция писателя)
     
     Args:
         db: Подключение к БД
         session_id: ID сессии
     """
     await db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
-    await db.commit()
 
 
 async def cleanup_expired_sessions(db: aiosqlite.Connection):
@@ -479,7 +1294,7 @@ async def cleanup_expired_sessions(db: aiosqlite.Connection):
     Args:
         db: Подключение к БД
     """
-    await db.execute("DELETE FROM sessions WHERE expires_at < ?", (datetime.now().isoformat(),))
+    await db.execute("DELETE FROM sessions WHERE expires_ts < ?", (int(time.time()),))
     await db.commit()
 
 
@@ -569,7 +1384,7 @@ async def get_emails_for_notifications(db: aiosqlite.Connection):
 
 async def get_low_stock_cartridges(db: aiosqlite.Connection):
     """
-    Получает картриджи с низким запасом (quantity <= min_qty)
+    Получает картриджи с низким запасом (quantity < min_qty), через частичный индекс idx_cartridges_low_stock
     
     Args:
         db: Подключение к БД
@@ -595,6 +1410,44 @@ async def get_low_stock_cartridges(db: aiosqlite.Connection):
     ]
 
 
+async def get_low_stock_items(db: aiosqlite.Connection):
+    """
+    Получает картриджи с низким запасом в формате get_all_cartridges, по названию
+
+    Читает только частичный индекс idx_cartridges_low_stock и строки найденных картриджей,
+    поэтому стоимость зависит от размера результата, а не каталога.
+
+    Args:
+        db: Подключение к БД
+
+    Returns:
+        Список словарей картриджей
+    """
+    cursor = await db.execute("""
+        SELECT
+            c.id,
+            c.cartridge_name,
+            c.quantity,
+            c.min_qty,
+            c.last_update,
+            (SELECT GROUP_CONCAT(b.barcode) FROM barcodes b WHERE b.cartridge_id = c.id) AS barcodes
+        FROM cartridges c
+        WHERE c.quantity < c.min_qty
+        ORDER BY c.cartridge_name
+    """)
+    rows = await cursor.fetchall()
+    return [
+        {
+            "id": r[0],
+            "name": r[1],
+            "quantity": r[2],
+            "min_qty": r[3],
+            "last_update": r[4],
+            "barcodes": r[5].split(",") if r[5] else []
+        } for r in rows
+    ]
+
+
 ################################### Функции для работы с настройками ###################################################
 
 async def get_setting(db: aiosqlite.Connection, key: str, default_value: str = ""):
@@ -629,6 +1482,12 @@ async def set_setting(db: aiosqlite.Connection, key: str, value: str):
     )
 
 
+# Время последней рассылки по расписанию (unix time) - для догоняющей рассылки после перезапуска сервера
+NOTIFICATION_LAST_RUN_KEY = "notification_last_run"
+# Ключи settings, от которых зависит расписание рассылки
+NOTIFICATION_SCHEDULE_KEYS = ("notification_days", "notification_time", "notifications_enabled")
+
+
 async def get_notification_schedule(db: aiosqlite.Connection):
     """
     Получает расписание отправки уведомлений
@@ -741,10 +1600,10 @@ async def create_cartridge(db: aiosqlite.Connection, cartridge_name: str, quanti
     """
     cursor = await db.execute(
         """
-        INSERT INTO cartridges (cartridge_name, quantity, min_qty, last_update) 
-        VALUES (?, ?, ?, ?)
+        INSERT INTO cartridges (cartridge_name, quantity, min_qty, last_update, last_update_ts) 
+        VALUES (?, ?, ?, ?, ?)
         """,
-        (cartridge_name, quantity, min_qty, timestamp)
+        (cartridge_name, quantity, min_qty, timestamp, to_epoch(timestamp))
     )
     cartridge_id = cursor.lastrowid
     
@@ -781,3 +1640,473 @@ async def delete_cartridge(db: aiosqlite.Connection, cartridge_id: int) -> bool:
     await db.execute("DELETE FROM cartridges WHERE id = ?", (cartridge_id,))
     
     return True
+
+
+################################### Функции для работы с журналом изменений каталога ###################################################
+# Настройка с версией, до которой журнал уже компактирован: клиенту со старой версией отдается каталог целиком
+CATALOG_CHANGES_FLOOR_KEY = "catalog_changes_floor"
+
+
+async def record_catalog_change(db: aiosqlite.Connection, cartridge_id: int, op: str, timestamp: str) -> int:
+    """
+    Записывает изменение картриджа в журнал каталога (в той же транзакции, что и само изменение)
+    
+    Args:
+        db: Подключение к БД
+        cartridge_id: ID картриджа
+        op: 'upsert' (создан или изменен) или 'delete'
+        timestamp: Время изменения
+        
+    Returns:
+        Новая версия каталога
+    """
+    cursor = await db.execute(
+        "INSERT INTO catalog_changes (cartridge_id, op, changed_at) VALUES (?, ?, ?)",
+        (cartridge_id, op, timestamp)
+    )
+    return cursor.lastrowid
+
+
+async def get_catalog_version(db: aiosqlite.Connection) -> int:
+    """
+    Получает текущую версию каталога
+    
+    Args:
+        db: Подключение к БД
+        
+    Returns:
+        Последняя выданная версия (0, если изменений еще не было)
+    """
+    # sqlite_sequence хранит последнюю версию, даже если ее строка уже удалена компактированием
+    cursor = await db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'catalog_changes'")
+    row = await cursor.fetchone()
+    return row[0] if row else 0
+
+
+async def get_catalog_floor(db: aiosqlite.Connection) -> int:
+    """
+    Получает версию, до которой журнал изменений компактирован
+    
+    Args:
+        db: Подключение к БД
+        
+    Returns:
+        Версия; запрос изменений с меньшей версией не может быть выполнен по журналу
+    """
+    return int(await get_setting(db, CATALOG_CHANGES_FLOOR_KEY, "0") or 0)
+
+
+async def get_catalog_changes(db: aiosqlite.Connection, since: int):
+    """
+    Получает картриджи, изменившиеся после версии since
+    
+    Args:
+        db: Подключение к БД
+        since: Версия каталога, которая уже есть у клиента
+        
+    Returns:
+        Список кортежей (cartridge_id, последняя версия изменения) по возрастанию версии
+    """
+    cursor = await db.execute("""
+        SELECT cartridge_id, MAX(version) AS last_version
+        FROM catalog_changes
+        WHERE version > ?
+        GROUP BY cartridge_id
+        ORDER BY last_version
+    """, (since,))
+    return await cursor.fetchall()
+
+
+async def get_cartridges_by_ids(db: aiosqlite.Connection, cartridge_ids: list):
+    """
+    Получает информацию о нескольких картриджах в том же формате, что и get_all_cartridges
+    
+    Args:
+        db: Подключение к БД
+        cartridge_ids: Список ID картриджей
+        
+    Returns:
+        Список словарей только для существующих картриджей
+    """
+    if not cartridge_ids:
+        return []
+    placeholders = ",".join("?" * len(cartridge_ids))
+    cursor = await db.execute(f"""
+        SELECT 
+            c.id, 
+            c.cartridge_name,
+            c.quantity,
+            c.min_qty,
+            c.last_update, 
+            GROUP_CONCAT(DISTINCT b.barcode) as barcodes
+        FROM cartridges c
+        LEFT JOIN barcodes b ON c.id = b.cartridge_id
+        WHERE c.id IN ({placeholders})
+        GROUP BY c.id
+    """, list(cartridge_ids))
+    rows = await cursor.fetchall()
+    return [
+        {
+            "id": r[0],
+            "name": r[1],
+            "quantity": r[2],
+            "min_qty": r[3],
+            "last_update": r[4],
+            "barcodes": r[5].split(",") if r[5] else []
+        } for r in rows
+    ]
+
+
+async def compact_catalog_changes(db: aiosqlite.Connection, older_than: str):
+    """
+    Компактирует журнал изменений каталога
+    
+    Для каждого картриджа нужна только последняя запись, поэтому более ранние удаляются всегда.
+    Записи старше older_than удаляются целиком, а версия самой новой из них запоминается как
+    нижняя граница журнала.
+    
+    Args:
+        db: Подключение к БД
+        older_than: Граница окна хранения ('YYYY-MM-DD HH:MM:SS')
+        
+    Returns:
+        Кортеж (количество удаленных записей, новая нижняя граница)
+    """
+    cursor = await db.execute("""
+        DELETE FROM catalog_changes
+        WHERE version NOT IN (SELECT MAX(version) FROM catalog_changes GROUP BY cartridge_id)
+    """)
+    removed = cursor.rowcount
+
+    floor = await get_catalog_floor(db)
+    cursor = await db.execute("SELECT MAX(version) FROM catalog_changes WHERE changed_at < ?", (older_than,))
+    row = await cursor.fetchone()
+    if row and row[0] is not None:
+        floor = max(floor, row[0])
+        cursor = await db.execute("DELETE FROM catalog_changes WHERE version <= ?", (floor,))
+        removed += cursor.rowcount
+        await set_setting(db, CATALOG_CHANGES_FLOOR_KEY, str(floor))
+    return removed, floor
+
+
+################################### Функции для работы со справочником устройств ###################################################
+
+# Версия переноса editor из history в справочник devices: при изменении формата увеличить, перенос пройдет заново
+HISTORY_DEVICES_VERSION = "1"
+
+
+async def migrate_history_devices(db: aiosqlite.Connection) -> bool:
+    """
+    Однократно заводит устройства из текстовых editor журнала и проставляет history.device_id
+
+    Выполняется при старте до запуска писателя, как и backfill_consumption_rollups.
+    Строка editor формата "Platform: <платформа>  <ip>" раскладывается на platform и host.
+    Счетчики: scans_total - операции без пользователя (ТСД), edits_total - операции из веб-интерфейса.
+
+    Args:
+        db: Подключение к БД (писатель)
+
+    Returns:
+        True если перенос выполнялся, False если уже выполнен
+    """
+    if await get_setting(db, "history_devices_version") == HISTORY_DEVICES_VERSION:
+        return False
+
+    await db.execute("""
+        INSERT INTO devices (editor, platform, host, first_seen, last_seen, last_seen_ts, scans_total, edits_total)
+        SELECT editor,
+               CASE WHEN editor LIKE 'Platform: %' THEN trim(substr(editor, 11, 14)) END,
+               CASE WHEN editor LIKE 'Platform: %' THEN substr(editor, 25) END,
+               MIN(created_at),
+               MAX(COALESCE(ended_at, created_at)),
+               MAX(COALESCE(ended_ts, created_ts)),
+               SUM(CASE WHEN username IS NULL THEN COALESCE(op_count, 1) ELSE 0 END),
+               SUM(CASE WHEN username IS NOT NULL THEN COALESCE(op_count, 1) ELSE 0 END)
+        FROM history
+        WHERE device_id IS NULL AND editor != ''
+        GROUP BY editor
+        ON CONFLICT (editor) DO UPDATE SET
+            scans_total = scans_total + excluded.scans_total,
+            edits_total = edits_total + excluded.edits_total
+    """)
+    await db.execute("""
+        UPDATE history SET device_id = (SELECT id FROM devices WHERE devices.editor = history.editor), editor = ''
+        WHERE device_id IS NULL AND editor != ''
+    """)
+    await set_setting(db, "history_devices_version", HISTORY_DEVICES_VERSION)
+    await db.commit()
+    return True
+
+
+async def get_all_devices(db: aiosqlite.Connection):
+    """
+    Returns:
+        Список пар (editor, device_id) для загрузки в кэш устройств
+    """
+    cursor = await db.execute("SELECT editor, id FROM devices")
+    return await cursor.fetchall()
+
+
+async def create_device(db: aiosqlite.Connection, editor: str, platform: str, host: str, timestamp: str) -> int:
+    """
+    Заводит устройство в справочнике (или находит уже заведенное), без коммита
+
+    Returns:
+        ID устройства
+    """
+    await db.execute(
+        "INSERT OR IGNORE INTO devices (editor, platform, host, first_seen) VALUES (?, ?, ?, ?)",
+        (editor, platform, host, timestamp)
+    )
+    cursor = await db.execute("SELECT id FROM devices WHERE editor = ?", (editor,))
+    row = await cursor.fetchone()
+    return row[0]
+
+
+async def add_device_stats(db: aiosqlite.Connection, rows: list):
+    """
+    Прибавляет накопленные в памяти счетчики устройств, без коммита
+
+    Args:
+        db: Подключение к БД (писатель)
+        rows: Кортежи (device_id, scans, edits, last_seen, last_seen_ts)
+    """
+    await db.executemany(
+        """
+        UPDATE devices SET
+            scans_total = scans_total + :scans,
+            edits_total = edits_total + :edits,
+            last_seen = CASE WHEN last_seen_ts IS NULL OR last_seen_ts <= :ts THEN :last_seen ELSE last_seen END,
+            last_seen_ts = MAX(COALESCE(last_seen_ts, 0), :ts)
+        WHERE id = :id
+        """,
+        [
+            {"id": device_id, "scans": scans, "edits": edits, "last_seen": last_seen, "ts": last_seen_ts}
+            for device_id, scans, edits, last_seen, last_seen_ts in rows
+        ]
+    )
+
+
+async def get_devices(db: aiosqlite.Connection):
+    """
+    Returns:
+        Список словарей устройств со счетчиками, сначала недавно активные
+    """
+    cursor = await db.execute("""
+        SELECT id, editor, platform, host, first_seen, last_seen, last_seen_ts, scans_total, edits_total
+        FROM devices
+        ORDER BY last_seen_ts DESC, id
+    """)
+    rows = await cursor.fetchall()
+    return [
+        {
+            "id": r[0],
+            "editor": r[1],
+            "platform": r[2],
+            "host": r[3],
+            "first_seen": r[4],
+            "last_seen": r[5],
+            "last_seen_ts": r[6],
+            "scans_total": r[7],
+            "edits_total": r[8]
+        } for r in rows
+    ]
+
+
+################################### Функции для работы с очередью писем ###################################################
+
+async def enqueue_outbox(db: aiosqlite.Connection, kind: str, recipients: list, subject: str, body: str,
+                         digest: str, now_ts: int, dedupe_seconds: int) -> int:
+    """
+    Ставит письмо в очередь для каждого получателя, без коммита
+
+    Получатель пропускается, если такое же письмо (digest) ему уже ставилось за последние
+    dedupe_seconds секунд и не ушло в окончательную ошибку.
+
+    Args:
+        db: Подключение к БД (писатель)
+        kind: Тип письма (low_stock и т.п.)
+        recipients: Адреса получателей
+        subject: Тема
+        body: HTML тело
+        digest: Хэш темы и тела
+        now_ts: Текущее время, unix time
+        dedupe_seconds: Окно отсечения повторов
+
+    Returns:
+        Количество поставленных в очередь строк
+    """
+    queued = 0
+    for recipient in recipients:
+        cursor = await db.execute("""
+            INSERT INTO outbox (kind, recipient, subject, body, digest, created_ts, next_attempt_ts)
+            SELECT ?, ?, ?, ?, ?, ?, ?
+            WHERE NOT EXISTS (
+                SELECT 1 FROM outbox
+                WHERE digest = ? AND recipient = ? AND created_ts >= ? AND status != 'failed'
+            )
+        """, (kind, recipient, subject, body, digest, now_ts, now_ts, digest, recipient, now_ts - dedupe_seconds))
+        queued += cursor.rowcount
+    return queued
+
+
+async def get_outbox_due(db: aiosqlite.Connection, now_ts: int, limit: int):
+    """
+    Returns:
+        Письма, которым пора уходить: список словарей по возрастанию id
+    """
+    cursor = await db.execute("""
+        SELECT id, recipient, subject, body, digest, attempts, created_ts
+        FROM outbox
+        WHERE status = 'pending' AND next_attempt_ts <= ?
+        ORDER BY next_attempt_ts, id
+        LIMIT ?
+    """, (now_ts, limit))
+    rows = await cursor.fetchall()
+    return [
+        {
+            "id": r[0],
+            "recipient": r[1],
+            "subject": r[2],
+            "body": r[3],
+            "digest": r[4],
+            "attempts": r[5],
+            "created_ts": r[6]
+        } for r in rows
+    ]
+
+
+async def get_outbox_next_due_ts(db: aiosqlite.Connection):
+    """
+    Returns:
+        Время ближайшей попытки отправки (unix time) или None, если очередь пуста
+    """
+    cursor = await db.execute("SELECT MIN(next_attempt_ts) FROM outbox WHERE status = 'pending'")
+    row = await cursor.fetchone()
+    return row[0]
+
+
+async def mark_outbox_sent(db: aiosqlite.Connection, ids: list, sent_ts: int):
+    """Отмечает письма отправленными, без коммита"""
+    await db.executemany(
+        "UPDATE outbox SET status = 'sent', attempts = attempts + 1, sent_ts = ?, last_error = NULL WHERE id = ?",
+        [(sent_ts, outbox_id) for outbox_id in ids]
+    )
+
+
+async def mark_outbox_failed_attempts(db: aiosqlite.Connection, rows: list):
+    """
+    Записывает неудачные попытки отправки, без коммита
+
+    Args:
+        rows: Кортежи (id, status, next_attempt_ts, error). status - pending для повтора или failed
+    """
+    await db.executemany(
+        "UPDATE outbox SET status = ?, attempts = attempts + 1, next_attempt_ts = ?, last_error = ? WHERE id = ?",
+        [(status, next_attempt_ts, error, outbox_id) for outbox_id, status, next_attempt_ts, error in rows]
+    )
+
+
+async def get_outbox_counts(db: aiosqlite.Connection) -> dict:
+    """
+    Returns:
+        Словарь {status: количество} и время самой старой неотправленной записи в ключе oldest_pending_ts
+    """
+    cursor = await db.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status")
+    counts = {status: count for status, count in await cursor.fetchall()}
+    cursor = await db.execute("SELECT MIN(created_ts) FROM outbox WHERE status = 'pending'")
+    counts["oldest_pending_ts"] = (await cursor.fetchone())[0]
+    return counts
+
+
+async def get_outbox_recent(db: aiosqlite.Connection, limit: int):
+    """
+    Returns:
+        Последние записи очереди без тела письма, сначала новые
+    """
+    cursor = await db.execute("""
+        SELECT id, kind, recipient, subject, status, attempts, created_ts, next_attempt_ts, sent_ts, last_error
+        FROM outbox
+        ORDER BY id DESC
+        LIMIT ?
+    """, (limit,))
+    rows = await cursor.fetchall()
+    return [
+        {
+            "id": r[0],
+            "kind": r[1],
+            "recipient": r[2],
+            "subject": r[3],
+            "status": r[4],
+            "attempts": r[5],
+            "created_ts": r[6],
+            "next_attempt_ts": r[7],
+            "sent_ts": r[8],
+            "last_error": r[9]
+        } for r in rows
+    ]
+
+
+async def purge_outbox(db: aiosqlite.Connection, older_than_ts: int) -> int:
+    """
+    Удаляет отправленные и окончательно не отправленные письма старше older_than_ts, без коммита
+
+    Returns:
+        Количество удаленных строк
+    """
+    cursor = await db.execute(
+        "DELETE FROM outbox WHERE status != 'pending' AND created_ts < ?", (older_than_ts,)
+    )
+    return cursor.rowcount
+
+
+################################### Функции для работы с результатами пакетных сканов ###################################################
+async def get_scan_results(db: aiosqlite.Connection, item_ids: list) -> dict:
+    """
+    Находит сохраненные результаты уже обработанных сканов
+
+    Args:
+        db: Подключение к БД
+        item_ids: ID сканов от ТСД (не больше SCAN_BATCH_MAX_ITEMS)
+
+    Returns:
+        Словарь {ID скана: результат}
+    """
+    if not item_ids:
+        return {}
+    placeholders = ",".join("?" * len(item_ids))
+    cursor = await db.execute(
+        f"SELECT item_id, result FROM scan_results WHERE item_id IN ({placeholders})",
+        [str(item_id) for item_id in item_ids]
+    )
+    return {row[0]: json.loads(row[1]) for row in await cursor.fetchall()}
+
+
+async def save_scan_results(db: aiosqlite.Connection, results: list, now_ts: int):
+    """
+    Запоминает результаты примененных сканов по их ID, без коммита
+
+    Args:
+        db: Подключение к БД (писатель)
+        results: Результаты сканов (словари с ключом id), сканы без ID пропускаются
+        now_ts: Текущее время, unix time
+    """
+    rows = [
+        (str(result["id"]), now_ts, json.dumps(result, ensure_ascii=False))
+        for result in results if result.get("id") is not None
+    ]
+    if rows:
+        await db.executemany(
+            "INSERT OR IGNORE INTO scan_results (item_id, created_ts, result) VALUES (?, ?, ?)", rows
+        )
+
+
+async def purge_scan_results(db: aiosqlite.Connection, older_than_ts: int) -> int:
+    """
+    Удаляет результаты сканов старше older_than_ts, без коммита
+
+    Returns:
+        Количество удаленных строк
+    """
+    cursor = await db.execute("DELETE FROM scan_results WHERE created_ts < ?", (older_than_ts,))
+    return cursor.rowcount
@@ -0,0 +1,147 @@
+"""
+CartridgeMaster - поток изменений каталога для дашборда (Server-Sent Events).
+
+Эндпоинты записи после коммита публикуют маленькие события (изменение остатка, обновление
+или удаление картриджа), а каждый открытый браузер получает их через свою очередь.
+Очередь клиента ограничена: если клиент не успевает читать, он отключается и при
+переподключении просто перечитывает каталог целиком.
+"""
+
+import asyncio
+import json
+import logging
+
+logger = logging.getLogger("my_custom_logger")
+
+
+class Subscriber:
+    """Один подписчик потока: очередь готовых к отправке SSE сообщений"""
+
+    __slots__ = ("queue", "dropped")
+
+    def __init__(self, queue_size: int):
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = False
+
+
+class EventBroker:
+    """
+    Рассылка событий подписчикам с ограниченными очередями
+
+    Событие сериализуется один раз на все очереди. Отправка никогда не ждет медленного
+    клиента: при переполнении его очередь очищается, в нее кладется None (конец потока)
+    и подписчик удаляется.
+    """
+
+    def __init__(self, queue_size: int = 256):
+        """
+        Args:
+            queue_size: Максимум неотправленных сообщений одного клиента
+        """
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self.published = 0
+        self.dropped = 0
+        self.connections = 0
+
+    @property
+    def has_subscribers(self) -> bool:
+        return bool(self._subscribers)
+
+    def subscribe(self) -> Subscriber:
+        """Регистрирует нового клиента"""
+        subscriber = Subscriber(self.queue_size)
+        self._subscribers.add(subscriber)
+        self.connections += 1
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        """Убирает клиента (соединение закрыто)"""
+        self._subscribers.discard(subscriber)
+
+    def publish(self, event_type: str, data: dict, event_id: int = None):
+        """
+        Отправляет событие всем подписчикам
+
+        Args:
+            event_type: Тип события (stock, upsert, delete)
+            data: Данные события, уходят в браузер как JSON
+            event_id: ID события (версия каталога после изменения)
+        """
+        if not self._subscribers:
+            return
+        message = format_sse(event_type, data, event_id)
+        self.published += 1
+        for subscriber in list(self._subscribers):
+            try:
+                subscriber.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                self._drop(subscriber)
+
+    def close(self):
+        """Завершает потоки всех клиентов (остановка сервера)"""
+        for subscriber in list(self._subscribers):
+            self._drop(subscriber, count=False)
+
+    def _drop(self, subscriber: Subscriber, count: bool = True):
+        queue = subscriber.queue
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+        subscriber.dropped = True
+        self._subscribers.discard(subscriber)
+        if count:
+            self.dropped += 1
+            logger.warning("Клиент потока изменений не успевает читать события и отключен")
+
+    def stats(self) -> dict:
+        """Количество клиентов, опубликованных событий и отключенных медленных клиентов"""
+        return {
+            "subscribers": len(self._subscribers),
+            "connections_total": self.connections,
+            "published_total": self.published,
+            "dropped_total": self.dropped,
+        }
+
+
+def format_sse(event_type: str, data: dict, event_id: int = None) -> str:
+    """
+    Формирует одно сообщение в формате text/event-stream
+
+    Returns:
+        Строка вида "id: ...\\nevent: ...\\ndata: {...}\\n\\n"
+    """
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event_type}")
+    lines.append("data: " + json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+    return "\n".join(lines) + "\n\n"
+
+
+async def stream_events(subscriber: Subscriber, broker: EventBroker, is_disconnected, heartbeat_seconds: float = 15):
+    """
+    Асинхронный генератор тела SSE ответа для одного клиента
+
+    Args:
+        subscriber: Подписчик, созданный broker.subscribe()
+        broker: Брокер, от которого нужно отписаться по завершении
+        is_disconnected: Корутинная функция, проверяющая разрыв соединения (request.is_disconnected)
+        heartbeat_seconds: Интервал комментариев-пингов при отсутствии событий
+    """
+    try:
+        # Браузер переподключается через retry миллисекунд после обрыва
+        yield "retry: 3000\n\n"
+        while True:
+            try:
+                message = await asyncio.wait_for(subscriber.queue.get(), heartbeat_seconds)
+            except asyncio.TimeoutError:
+                if await is_disconnected():
+                    break
+                yield ": ping\n\n"
+                continue
+            if message is None:
+                break
+            yield message
+    finally:
+        broker.unsubscribe(subscriber)
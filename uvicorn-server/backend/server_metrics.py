@@ -0,0 +1,194 @@
+"""
+CartridgeMaster - метрики в формате Prometheus.
+
+Легковесные счетчики и гистограммы без внешних зависимостей. Запись значения - это
+поиск корзины bisect'ом и пара сложений в словаре, поэтому метрики можно держать
+включенными в проде. Отдаются текстом через локальный эндпоинт /metrics.
+"""
+
+import time
+from bisect import bisect_left
+
+# Корзины по умолчанию для времени стадий, в секундах: от 50 мкс до 5 с
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+def _format_labels(labelnames: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value) -> str:
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Counter:
+    """Монотонный счетчик с метками"""
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def inc(self, *labelvalues, amount: float = 1):
+        """Увеличивает счетчик для набора значений меток (в порядке labelnames)"""
+        self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def value(self, *labelvalues):
+        return self._values.get(labelvalues, 0)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labelvalues, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами и метками"""
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Для каждого набора меток: [счетчики по корзинам (+Inf последняя), сумма, количество]
+        self._series = {}
+
+    def observe(self, value: float, *labelvalues):
+        """Записывает одно наблюдение"""
+        series = self._series.get(labelvalues)
+        if series is None:
+            series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def count(self, *labelvalues):
+        series = self._series.get(labelvalues)
+        return series[2] if series else 0
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labelvalues, (bucket_counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, labelvalues, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, labelvalues, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class StatsCollector:
+    """
+    Метрики, которые читаются из готового словаря stats() какого-нибудь объекта в момент выдачи
+
+    Ключи с суффиксом _total отдаются как counter, остальные как gauge.
+    """
+
+    def __init__(self, prefix: str, help_text: str, stats_func):
+        self.prefix = prefix
+        self.help = help_text
+        self.stats_func = stats_func
+
+    def render(self) -> list:
+        try:
+            stats = self.stats_func()
+        except Exception:
+            return []
+        lines = []
+        for key, value in stats.items():
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                continue
+            name = f"{self.prefix}_{key}"
+            metric_type = "counter" if key.endswith("_total") else "gauge"
+            lines.append(f"# HELP {name} {self.help}: {key}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.append(f"{name} {_format_value(value)}")
+        return lines
+
+
+class MetricsRegistry:
+    """Реестр всех метрик процесса"""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def counter(self, name: str, help_text: str, labelnames: tuple = ()) -> Counter:
+        return self._register(name, Counter(name, help_text, labelnames))
+
+    def histogram(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(name, Histogram(name, help_text, labelnames, buckets))
+
+    def register_stats(self, prefix: str, help_text: str, stats_func) -> StatsCollector:
+        """Подключает объект со словарем stats() (кэши, писатель, пул соединений и т.д.)"""
+        collector = StatsCollector(prefix, help_text, stats_func)
+        self._metrics[prefix] = collector
+        return collector
+
+    def _register(self, name, metric):
+        # Повторная регистрация возвращает уже существующую метрику (например, при повторном импорте)
+        existing = self._metrics.get(name)
+        if existing is not None:
+            return existing
+        self._metrics[name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# Общий реестр процесса
+metrics = MetricsRegistry()
+
+# Время стадий обработки запросов: endpoint - имя обработчика, stage - стадия внутри него
+STAGE_SECONDS = metrics.histogram(
+    "cartridge_stage_seconds",
+    "Время выполнения стадий обработки запроса, секунды",
+    ("endpoint", "stage")
+)
+
+
+class StageTimer:
+    """
+    Засекает время стадий одного запроса
+
+    Использование:
+        timer = StageTimer("scan")
+        ... расшифровка ...
+        timer.mark("decrypt")   # записывает время с предыдущей отметки
+        ...
+        timer.finish()          # записывает общее время в стадию "total"
+    """
+
+    __slots__ = ("endpoint", "_started", "_last")
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self._started = self._last = time.perf_counter()
+
+    def mark(self, stage: str):
+        now = time.perf_counter()
+        STAGE_SECONDS.observe(now - self._last, self.endpoint, stage)
+        self._last = now
+
+    def finish(self):
+        STAGE_SECONDS.observe(time.perf_counter() - self._started, self.endpoint, "total")
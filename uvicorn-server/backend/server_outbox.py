@@ -0,0 +1,310 @@
+"""
+CartridgeMaster - очередь исходящих писем.
+
+Эндпоинты и расписание не ждут SMTP: письмо записывается в таблицу outbox (одна строка на получателя)
+в той же БД, и запрос сразу отвечает. Фоновый рассыльщик забирает строки, которым пора уходить,
+отправляет их не больше чем в concurrency потоков и записывает результат. Неудачная попытка
+откладывается с экспоненциально растущей паузой, после max_attempts попыток строка помечается failed.
+Постоянный отказ сервера по адресу (код 5xx, в том числе когда отказаны все адреса письма) не повторяется:
+строка сразу помечается failed.
+Очередь переживает перезапуск сервера; письмо, отправка которого оборвалась вместе с процессом,
+после запуска уйдет еще раз (доставка "хотя бы один раз").
+"""
+
+import asyncio
+import hashlib
+import logging
+import smtplib
+import time
+
+from server_db import (
+    enqueue_outbox, get_outbox_due, get_outbox_next_due_ts, get_outbox_counts,
+    mark_outbox_sent, mark_outbox_failed_attempts, purge_outbox
+)
+from server_metrics import metrics
+
+logger = logging.getLogger("my_custom_logger")
+
+OUTBOX_DELIVERY_SECONDS = metrics.histogram(
+    "cartridge_outbox_delivery_seconds",
+    "Время от постановки письма в очередь до отправки, секунды",
+    buckets=(1, 5, 15, 30, 60, 300, 900, 1800, 3600, 7200, 21600, 86400)
+)
+OUTBOX_SEND_SECONDS = metrics.histogram(
+    "cartridge_outbox_send_seconds",
+    "Длительность одной отправки письма по SMTP, секунды",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+
+# Как часто удалять из outbox старые отправленные и неотправленные письма, в секундах
+OUTBOX_PURGE_INTERVAL_SECONDS = 3600
+
+
+def email_digest(subject: str, body: str) -> str:
+    """Хэш темы и тела письма: одинаковые письма получают одинаковый digest"""
+    return hashlib.sha256(f"{subject}\n{body}".encode("utf-8")).hexdigest()
+
+
+def backoff_seconds(attempts: int, base: float, maximum: float) -> int:
+    """
+    Пауза перед следующей попыткой: base, 2*base, 4*base... но не больше maximum
+
+    Args:
+        attempts: Сколько попыток уже сделано (включая только что неудачную)
+    """
+    return int(min(base * 2 ** (attempts - 1), maximum))
+
+
+class OutboxWorker:
+    """
+    Фоновый рассыльщик таблицы outbox
+
+    Строки одного письма (одинаковый digest) при batch_recipients уходят одним письмом
+    на несколько адресов, иначе каждому адресу отдельно. Все записи в БД идут через писатель.
+    """
+
+    def __init__(self, pool, writer, send_func, concurrency: int = 2, batch_recipients: bool = False,
+                 max_recipients: int = 50, max_attempts: int = 8, backoff_base: float = 30,
+                 backoff_max: float = 3600, poll_seconds: float = 30, fetch_limit: int = 100,
+                 retention_days: int = 30):
+        """
+        Args:
+            pool: DatabasePool - чтение очереди
+            writer: WriteCoalescer - постановка в очередь и результаты отправки
+            send_func: Корутина send_func(recipients, subject, body) -> {адрес: (код, текст)} отказов,
+                       при ошибке отправки выбрасывает исключение (server_post.deliver_email)
+            concurrency: Сколько писем отправлять одновременно
+            batch_recipients: Одно письмо сразу на несколько адресов
+            max_recipients: Максимум адресов в одном письме
+            max_attempts: После стольких неудачных попыток письмо помечается failed
+            backoff_base: Пауза после первой неудачной попытки, секунды
+            backoff_max: Максимальная пауза между попытками, секунды
+            poll_seconds: Как часто перечитывать очередь, если рассыльщика никто не разбудил
+            fetch_limit: Сколько строк забирать из очереди за один проход
+            retention_days: Сколько дней хранить отправленные и failed письма
+        """
+        self.pool = pool
+        self.writer = writer
+        self.send_func = send_func
+        self.concurrency = concurrency
+        self.batch_recipients = batch_recipients
+        self.max_recipients = max_recipients
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.poll_seconds = poll_seconds
+        self.fetch_limit = fetch_limit
+        self.retention_days = retention_days
+
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._in_flight = set()
+        self._deliveries = set()
+        self._task = None
+        self._last_purge = 0
+
+        # Счетчики для мониторинга
+        self.pending = 0
+        self.failed = 0
+        self.oldest_pending_ts = None
+        self.enqueued_total = 0
+        self.deduplicated_total = 0
+        self.sent_total = 0
+        self.retries_total = 0
+        self.failed_total = 0
+
+    async def start(self):
+        """Запускает фоновую задачу-рассыльщика"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 30):
+        """
+        Останавливает рассыльщика, дожидаясь уже начатых отправок не дольше timeout секунд
+
+        Письма, которые не успели уйти, остаются в outbox и уйдут после следующего запуска.
+        """
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        if self._deliveries:
+            _, not_done = await asyncio.wait(self._deliveries, timeout=timeout)
+            for task in not_done:
+                task.cancel()
+
+    async def enqueue(self, kind: str, recipients: list, subject: str, body: str, dedupe_seconds: int) -> int:
+        """
+        Ставит письмо в очередь и будит рассыльщика
+
+        Получатели, которым такое же письмо уже ставилось за dedupe_seconds секунд, пропускаются.
+
+        Returns:
+            Количество адресов, поставленных в очередь
+        """
+        digest = email_digest(subject, body)
+        now_ts = int(time.time())
+
+        async def enqueue_op(db):
+            return await enqueue_outbox(db, kind, recipients, subject, body, digest, now_ts, dedupe_seconds)
+
+        queued = await self.writer.submit(enqueue_op)
+        self.enqueued_total += queued
+        self.deduplicated_total += len(recipients) - queued
+        if queued:
+            self.pending += queued
+            if self.oldest_pending_ts is None:
+                self.oldest_pending_ts = now_ts
+            self._wakeup.set()
+        return queued
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                timeout = await self._dispatch()
+            except Exception as e:
+                logger.error(f"Ошибка рассыльщика очереди писем: {e}")
+                timeout = self.poll_seconds
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _dispatch(self) -> float:
+        """
+        Запускает отправку писем, которым пора уходить
+
+        Returns:
+            Сколько секунд можно ждать до следующего прохода, если рассыльщика не разбудят
+        """
+        now_ts = int(time.time())
+        if now_ts - self._last_purge >= OUTBOX_PURGE_INTERVAL_SECONDS:
+            self._last_purge = now_ts
+            older_than = now_ts - self.retention_days * 86400
+
+            async def purge_op(db):
+                return await purge_outbox(db, older_than)
+
+            removed = await self.writer.submit(purge_op)
+            if removed:
+                logger.info(f"Из очереди писем удалены старые записи: {removed}")
+
+        async with self.pool.reader() as db:
+            rows = await get_outbox_due(db, now_ts, self.fetch_limit + len(self._in_flight))
+            next_due_ts = await get_outbox_next_due_ts(db)
+            counts = await get_outbox_counts(db)
+        self.pending = counts.get("pending", 0)
+        self.failed = counts.get("failed", 0)
+        self.oldest_pending_ts = counts["oldest_pending_ts"]
+
+        for group in self._group([row for row in rows if row["id"] not in self._in_flight]):
+            self._in_flight.update(row["id"] for row in group)
+            task = asyncio.create_task(self._deliver(group))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+
+        # Идущие отправки сами разбудят рассыльщика по завершении,
+        # иначе ближайшая отложенная попытка определяет, когда проснуться
+        if self._in_flight or next_due_ts is None:
+            return self.poll_seconds
+        return min(max(next_due_ts - now_ts, 1), self.poll_seconds)
+
+    def _group(self, rows: list) -> list:
+        # Строки с одинаковым digest - одно и то же письмо разным адресатам
+        if not self.batch_recipients:
+            return [[row] for row in rows]
+        by_digest = {}
+        for row in rows:
+            by_digest.setdefault(row["digest"], []).append(row)
+        groups = []
+        for same in by_digest.values():
+            for i in range(0, len(same), self.max_recipients):
+                groups.append(same[i:i + self.max_recipients])
+        return groups
+
+    async def _deliver(self, group: list):
+        ids = [row["id"] for row in group]
+        recipients = [row["recipient"] for row in group]
+        try:
+            async with self._semaphore:
+                started = time.perf_counter()
+                try:
+                    refused = await self.send_func(recipients, group[0]["subject"], group[0]["body"])
+                    error = None
+                except smtplib.SMTPRecipientsRefused as e:
+                    # Сервер отказал по всем адресам: результат по каждому адресу, как при частичном отказе
+                    refused = e.recipients
+                    error = None
+                except Exception as e:
+                    refused = {}
+                    error = str(e) or type(e).__name__
+                OUTBOX_SEND_SECONDS.observe(time.perf_counter() - started)
+            await self._record(group, refused, error)
+        except Exception as e:
+            # Результат не записан: строки остаются pending и уйдут повторно
+            logger.error(f"Ошибка при записи результата отправки на {', '.join(recipients)}: {e}")
+        finally:
+            self._in_flight.difference_update(ids)
+            self._wakeup.set()
+
+    async def _record(self, group: list, refused: dict, error: str):
+        now_ts = int(time.time())
+        sent = []
+        failed_attempts = []
+        for row in group:
+            if error is None and row["recipient"] not in refused:
+                sent.append(row)
+                continue
+            if error is None:
+                code, text = refused[row["recipient"]]
+                row_error = f"{code} {text.decode('utf-8', 'replace') if isinstance(text, bytes) else text}"
+            else:
+                code, row_error = None, error
+            attempts = row["attempts"] + 1
+            if code is not None and code >= 500:
+                failed_attempts.append((row["id"], "failed", now_ts, row_error))
+                logger.error(f"'EMAIL: Сервер окончательно отказал в доставке на {row['recipient']}: {row_error}'")
+            elif attempts >= self.max_attempts:
+                failed_attempts.append((row["id"], "failed", now_ts, row_error))
+                logger.error(f"'EMAIL: Письмо на {row['recipient']} не отправлено после {attempts} попыток: {row_error}'")
+            else:
+                delay = backoff_seconds(attempts, self.backoff_base, self.backoff_max)
+                failed_attempts.append((row["id"], "pending", now_ts + delay, row_error))
+                logger.warning(f"'EMAIL: Ошибка при отправке на {row['recipient']}, повтор через {delay} с: {row_error}'")
+
+        async def record_op(db):
+            if sent:
+                await mark_outbox_sent(db, [row["id"] for row in sent], now_ts)
+            if failed_attempts:
+                await mark_outbox_failed_attempts(db, failed_attempts)
+
+        await self.writer.submit(record_op)
+
+        if sent:
+            logger.info(f"'EMAIL: Уведомление отправлено на {', '.join(row['recipient'] for row in sent)}'")
+            for row in sent:
+                OUTBOX_DELIVERY_SECONDS.observe(max(now_ts - row["created_ts"], 0))
+        final = sum(1 for _, status, _, _ in failed_attempts if status == "failed")
+        self.sent_total += len(sent)
+        self.failed_total += final
+        self.retries_total += len(failed_attempts) - final
+
+    def stats(self) -> dict:
+        """Глубина очереди, возраст самого старого письма и результаты отправок"""
+        oldest = self.oldest_pending_ts
+        return {
+            "pending": self.pending,
+            "in_flight": len(self._in_flight),
+            "failed": self.failed,
+            "oldest_pending_seconds": max(int(time.time()) - oldest, 0) if oldest else 0,
+            "enqueued_total": self.enqueued_total,
+            "deduplicated_total": self.deduplicated_total,
+            "sent_total": self.sent_total,
+            "retries_total": self.retries_total,
+            "failed_total": self.failed_total,
+        }
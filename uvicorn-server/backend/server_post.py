@@ -1,4 +1,7 @@
 import smtplib
+import queue
+import threading
+import time
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import logging
@@ -6,6 +9,9 @@ import asyncio
 from concurrent.futures import ThreadPoolExecutor
 
 from config import SMTP_SERVER, SMTP_PORT, EMAIL_ADDRESS, EMAIL_PASSWORD
+from config import (
+    SMTP_POOL_SIZE, SMTP_SESSION_IDLE_SECONDS, SMTP_USE_SSL
+)
 
 logger = logging.getLogger("my_custom_logger")
 
@@ -15,52 +21,221 @@ smtp_port = SMTP_PORT
 email_address = EMAIL_ADDRESS
 email_password = EMAIL_PASSWORD
 
+# Ошибки соединения, после которых сессия выбрасывается, а письмо повторяется на новой сессии.
+# Отказы сервера по адресам (SMTPRecipientsRefused и т.п.) не повторяются
+SMTP_CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, ConnectionError, TimeoutError)
 
-def _send_email_sync(recipient, subject, body):
+
+class SMTPSessionPool:
     """
-    Синхронная функция для отправки одного письма
+    Пул авторизованных SMTP сессий
+
+    TLS рукопожатие и login выполняются один раз на сессию, а не на каждое письмо: сессия после
+    отправки возвращается в пул и используется для следующих получателей и следующих рассылок.
+    Сессия, простоявшая дольше idle_seconds, закрывается вместо повторного использования
+    (серверы сами рвут простаивающие соединения). Сессия, на которой случилась ошибка соединения,
+    выбрасывается, а письмо один раз повторяется на новой.
+    Методы блокирующие и вызываются из потоков общего executor'а.
     """
-    try:
-        server = smtplib.SMTP_SSL(smtp_server, smtp_port)
-        server.login(email_address, email_password)
-        
-        message = MIMEMultipart()
-        message["From"] = email_address
-        message["To"] = recipient
-        message["Subject"] = subject
-        message.attach(MIMEText(body, "html"))
-        
-        text = message.as_string()
-        server.sendmail(email_address, recipient, text)
-        server.quit()
-        
-        logger.info(f"'EMAIL: Уведомление отправлено на {recipient}'")
-        return True
-    except Exception as e:
-        logger.error(f"'EMAIL: Ошибка при отправке на {recipient}: {e}'")
-        return False
 
+    def __init__(self, host: str, port: int, username: str, password: str, size: int = 2,
+                 use_ssl: bool = True, idle_seconds: float = 60, timeout: float = 30):
+        """
+        Args:
+            host: SMTP сервер
+            port: Порт
+            username: Логин (он же адрес отправителя)
+            password: Пароль
+            size: Максимум одновременно открытых сессий
+            use_ssl: SMTP_SSL (порт 465) или обычный SMTP
+            idle_seconds: Сессия, простоявшая дольше, открывается заново
+            timeout: Таймаут сетевых операций, секунды
+        """
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.size = size
+        self.use_ssl = use_ssl
+        self.idle_seconds = idle_seconds
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+        self.connects_total = 0
+        self.reuses_total = 0
+        self.reconnects_total = 0
+        self.messages_total = 0
+
+    def _connect(self):
+        if self.use_ssl:
+            server = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+        else:
+            server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            server.login(self.username, self.password)
+        except Exception:
+            self._close(server)
+            raise
+        self.connects_total += 1
+        return server
+
+    @staticmethod
+    def _close(server):
+        try:
+            server.quit()
+        except Exception:
+            try:
+                server.close()
+            except Exception:
+                pass
+
+    def _acquire(self):
+        # Свободная сессия из пула, если она не простаивала слишком долго, иначе новая
+        while True:
+            try:
+                server, released_at = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if time.monotonic() - released_at <= self.idle_seconds:
+                self.reuses_total += 1
+                return server
+            self._close(server)
+
+    def send(self, from_addr: str, recipients: list, message: str) -> dict:
+        """
+        Отправляет одно письмо (конверт может содержать несколько получателей)
+
+        Returns:
+            Отказы сервера по адресам {адрес: (код, текст)}, как у smtplib.sendmail
+
+        Raises:
+            smtplib.SMTPException / OSError: письмо не отправлено
+        """
+        with self._slots:
+            for attempt in range(2):
+                server = self._acquire()
+                try:
+                    refused = server.sendmail(from_addr, recipients, message)
+                except SMTP_CONNECTION_ERRORS:
+                    self._close(server)
+                    if attempt:
+                        raise
+                    self.reconnects_total += 1
+                    continue
+                except smtplib.SMTPRecipientsRefused:
+                    # Сессия исправна, сервер отказал по всем адресам
+                    self._idle.put((server, time.monotonic()))
+                    raise
+                except Exception:
+                    self._close(server)
+                    raise
+                self._idle.put((server, time.monotonic()))
+                self.messages_total += 1
+                return refused
+
+    def close(self):
+        """Закрывает все свободные сессии"""
+        while True:
+            try:
+                server, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._close(server)
+
+    def stats(self) -> dict:
+        """Открытия сессий, повторные использования, переподключения и отправленные письма"""
+        return {
+            "idle": self._idle.qsize(),
+            "connects_total": self.connects_total,
+            "reuses_total": self.reuses_total,
+            "reconnects_total": self.reconnects_total,
+            "messages_total": self.messages_total,
+        }
+
+
+# Общие на процесс пул SMTP сессий и потоки отправки: создаются при первой рассылке
+smtp_pool = None
+_executor = None
+
+
+def get_smtp_pool() -> SMTPSessionPool:
+    global smtp_pool
+    if smtp_pool is None:
+        smtp_pool = SMTPSessionPool(
+            smtp_server, smtp_port, email_address, email_password,
+            size=SMTP_POOL_SIZE, use_ssl=SMTP_USE_SSL, idle_seconds=SMTP_SESSION_IDLE_SECONDS
+        )
+    return smtp_pool
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=SMTP_POOL_SIZE, thread_name_prefix="smtp")
+    return _executor
 
-import asyncio
-from concurrent.futures import ThreadPoolExecutor
-import logging
 
-logger = logging.getLogger(__name__)
+def shutdown_mailer():
+    """Закрывает SMTP сессии и потоки отправки (остановка сервера)"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+    if smtp_pool is not None:
+        smtp_pool.close()
 
-async def send_low_stock_notifications(emails: list, low_stock_cartridges: list):
+
+def _build_message(to_header: str, subject: str, html_body: str) -> str:
+    message = MIMEMultipart()
+    message["From"] = email_address
+    message["To"] = to_header
+    message["Subject"] = subject
+    message.attach(MIMEText(html_body, "html"))
+    return message.as_string()
+
+
+def _deliver_sync(recipients: list, to_header: str, subject: str, html_body: str) -> dict:
+    return get_smtp_pool().send(email_address, recipients, _build_message(to_header, subject, html_body))
+
+
+async def deliver_email(recipients: list, subject: str, html_body: str) -> dict:
     """
-    Отправляет уведомления о низком запасе картриджей на список email адресов
-    
+    Отправляет одно HTML письмо через пул сессий, не перехватывая ошибки (для очереди писем с повторами)
+
+    Несколько получателей уходят одним письмом в скрытой копии.
+
+    Returns:
+        Отказы сервера по адресам {адрес: (код, текст)}
+
+    Raises:
+        smtplib.SMTPException / OSError: письмо не отправлено никому
+    """
+    to_header = recipients[0] if len(recipients) == 1 else "undisclosed-recipients:;"
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), _deliver_sync, recipients, to_header, subject, html_body)
+
+
+LOW_STOCK_SUBJECT = "CartridgeMaster: отчёт о состоянии расходных материалов"
+LOW_STOCK_HEADING = "Список расходников для закупки:"
+# Оповещение о картриджах, запас которых только что опустился ниже минимума
+LOW_STOCK_ALERT_SUBJECT = "CartridgeMaster: запас картриджей ниже минимума"
+LOW_STOCK_ALERT_HEADING = "Запас опустился ниже минимума:"
+
+
+def build_low_stock_email(low_stock_cartridges: list, subject: str = LOW_STOCK_SUBJECT,
+                          heading: str = LOW_STOCK_HEADING) -> tuple:
+    """
+    Формирует письмо о низком запасе картриджей
+
     Args:
-        emails: Список email адресов для отправки
         low_stock_cartridges: Список картриджей с низким запасом
-        
+        subject: Тема письма
+        heading: Заголовок над таблицей
+
     Returns:
-        Количество успешно отправленных уведомлений
+        Кортеж (тема, HTML тело)
     """
-    if not emails or not low_stock_cartridges:
-        return 0
-    
     # Формируем HTML-тело письма
     html_body = """
     <html>
@@ -76,7 +251,7 @@ async def send_low_stock_notifications(emails: list, low_stock_cartridges: list)
         </style>
     </head>
     <body>
-        <h3 class="header">Список расходников для закупки:</h3>
+        <h3 class="header">""" + heading + """</h3>
         <table>
             <thead>
                 <tr>
@@ -108,26 +283,4 @@ async def send_low_stock_notifications(emails: list, low_stock_cartridges: list)
     </html>
     """
     
-    subject = "CartridgeMaster: отчёт о состоянии расходных материалов"
-    sent_count = 0
-    
-    try:
-        # Используем ThreadPoolExecutor для запуска синхронного SMTP кода в отдельных потоках
-        loop = asyncio.get_event_loop()
-        executor = ThreadPoolExecutor(max_workers=5)
-        
-        tasks = []
-        for recipient in emails:
-            # Передаем html_body вместо обычного текста
-            task = loop.run_in_executor(executor, _send_email_sync, recipient, subject, html_body)
-            tasks.append(task)
-        
-        results = await asyncio.gather(*tasks)
-        sent_count = sum(1 for result in results if result)
-        
-    except Exception as e:
-        logger.error(f"Ошибка при отправке уведомлений: {e}")
-        return 0
-    
-    return sent_count
-
+    return subject, html_body
@@ -0,0 +1,270 @@
+"""
+CartridgeMaster - планировщик фоновых задач.
+
+Все периодические задачи сервера (сверка индекса штрихкодов, сброс счетчиков устройств, очистка
+сессий, архив журнала, рассылка по расписанию и т.д.) выполняются одной задачей-планировщиком
+вместо отдельных циклов while True: sleep. Для каждой задачи заранее вычисляется время следующего
+запуска, и планировщик спит ровно до ближайшего из них. Расписание задачи меняется через reschedule()
+в тот момент, когда его меняют в настройках, а не перечитывается из БД каждую минуту.
+
+Задача, время которой прошло, пока цикл событий был занят, запускается сразу по пробуждению
+(сравнение "время наступило", а не "сейчас ровно ЧЧ:ММ"). Пропущенные за время остановки сервера
+запуски догоняются одним запуском, если с пропущенного времени прошло не больше catch_up_seconds.
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+
+from server_metrics import metrics
+
+logger = logging.getLogger("my_custom_logger")
+
+JOB_RUN_SECONDS = metrics.histogram(
+    "cartridge_job_run_seconds",
+    "Длительность выполнения фоновой задачи, секунды",
+    ("job",),
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+)
+
+
+class IntervalTrigger:
+    """Запуск через каждые seconds секунд после окончания предыдущего запуска"""
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+
+    def next_after(self, ts: float) -> float:
+        return ts + self.seconds
+
+    def previous_before(self, ts: float):
+        # У интервальной задачи нет привязки к часам, догонять нечего
+        return None
+
+    def __repr__(self):
+        return f"каждые {self.seconds} с"
+
+
+class WeeklyTrigger:
+    """Запуск в заданное время по местным часам в выбранные дни недели"""
+
+    def __init__(self, weekdays, hour: int, minute: int):
+        """
+        Args:
+            weekdays: Дни недели в формате datetime.weekday() (0 - понедельник, 6 - воскресенье)
+            hour: Час
+            minute: Минута
+        """
+        self.weekdays = frozenset(weekdays)
+        self.hour = hour
+        self.minute = minute
+        if not self.weekdays:
+            raise ValueError("Не выбран ни один день недели")
+        if not (0 <= hour <= 23 and 0 <= minute <= 59):
+            raise ValueError("Неверное время запуска")
+
+    def _fire_time(self, day) -> float:
+        return datetime(day.year, day.month, day.day, self.hour, self.minute).timestamp()
+
+    def next_after(self, ts: float) -> float:
+        """Ближайшее время запуска строго позже ts (unix time)"""
+        day = datetime.fromtimestamp(ts).date()
+        for offset in range(8):
+            candidate = day + timedelta(days=offset)
+            if candidate.weekday() in self.weekdays:
+                fire_ts = self._fire_time(candidate)
+                if fire_ts > ts:
+                    return fire_ts
+        raise RuntimeError("Не найдено время следующего запуска")
+
+    def previous_before(self, ts: float):
+        """Последнее время запуска не позже ts (unix time)"""
+        day = datetime.fromtimestamp(ts).date()
+        for offset in range(8):
+            candidate = day - timedelta(days=offset)
+            if candidate.weekday() in self.weekdays:
+                fire_ts = self._fire_time(candidate)
+                if fire_ts <= ts:
+                    return fire_ts
+        return None
+
+    def __repr__(self):
+        days = ",".join(str(day) for day in sorted(self.weekdays))
+        return f"дни {days} в {self.hour:02d}:{self.minute:02d}"
+
+
+class Job:
+    """Фоновая задача планировщика со счетчиками для мониторинга"""
+
+    def __init__(self, name: str, description: str, func, trigger=None, catch_up_seconds: float = 0):
+        self.name = name
+        self.description = description
+        self.func = func
+        self.trigger = trigger
+        self.catch_up_seconds = catch_up_seconds
+        self.next_run_ts = None
+        self.running = False
+
+        # Счетчики для мониторинга
+        self.runs_total = 0
+        self.failures_total = 0
+        self.catch_ups_total = 0
+        self.last_run_ts = None
+        self.last_success_ts = None
+        self.last_duration_seconds = 0.0
+
+    def plan(self, now: float, last_run_ts: float = None):
+        """
+        Вычисляет время следующего запуска
+
+        Args:
+            now: Текущее время, unix time
+            last_run_ts: Время последнего выполненного запуска (например, до перезапуска сервера).
+                         Если после него было пропущенное время запуска не старше catch_up_seconds,
+                         задача запускается сразу
+        """
+        if self.trigger is None:
+            self.next_run_ts = None
+            return
+        if self.catch_up_seconds and last_run_ts is not None:
+            missed_ts = self.trigger.previous_before(now)
+            if missed_ts is not None and missed_ts > last_run_ts and now - missed_ts <= self.catch_up_seconds:
+                logger.info(f"Фоновая задача '{self.description}' пропустила запуск в "
+                            f"{datetime.fromtimestamp(missed_ts):%Y-%m-%d %H:%M}, запуск сейчас")
+                self.catch_ups_total += 1
+                self.next_run_ts = now
+                return
+        self.next_run_ts = self.trigger.next_after(now)
+
+    def stats(self) -> dict:
+        """Запуски, ошибки, длительность и время последнего успешного запуска"""
+        return {
+            "running": int(self.running),
+            "runs_total": self.runs_total,
+            "failures_total": self.failures_total,
+            "catch_ups_total": self.catch_ups_total,
+            "last_duration_seconds": self.last_duration_seconds,
+            "last_success_timestamp": self.last_success_ts or 0,
+            "next_run_timestamp": self.next_run_ts or 0,
+        }
+
+
+class Scheduler:
+    """
+    Одна задача asyncio, которая запускает фоновые задачи по их расписанию
+
+    Задача - корутинная функция без аргументов. Один и тот же Job не запускается параллельно сам с собой:
+    следующее время запуска вычисляется после окончания текущего. Исключение задачи логируется
+    и учитывается в failures_total, на расписание оно не влияет.
+    """
+
+    def __init__(self, max_sleep_seconds: float = 300):
+        """
+        Args:
+            max_sleep_seconds: Максимальный сон без проверки часов. Сон считается по монотонным часам,
+                               поэтому после перевода системных часов или сна машины расписание
+                               сверяется с настенным временем не реже этого интервала
+        """
+        self.max_sleep_seconds = max_sleep_seconds
+        self.jobs = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._running = set()
+        self.wakeups_total = 0
+
+    def add(self, name: str, description: str, func, trigger=None, catch_up_seconds: float = 0,
+            last_run_ts: float = None) -> Job:
+        """
+        Регистрирует задачу
+
+        Args:
+            name: Короткое имя (латиница, используется в метриках)
+            description: Описание для логов
+            func: Корутинная функция без аргументов
+            trigger: IntervalTrigger / WeeklyTrigger или None (задача зарегистрирована, но не запускается)
+            catch_up_seconds: Окно догоняющего запуска (см. Job.plan)
+            last_run_ts: Время последнего запуска до старта сервера
+        """
+        job = Job(name, description, func, trigger, catch_up_seconds)
+        job.plan(time.time(), last_run_ts)
+        self.jobs[name] = job
+        metrics.register_stats(f"cartridge_job_{name}", f"Фоновая задача: {description}", job.stats)
+        self._wakeup.set()
+        return job
+
+    def reschedule(self, name: str, trigger, last_run_ts: float = None):
+        """
+        Меняет расписание задачи (None - приостановить) и будит планировщик
+
+        Если задача сейчас выполняется, новое расписание применится после ее окончания.
+        """
+        job = self.jobs[name]
+        job.trigger = trigger
+        if not job.running:
+            job.plan(time.time(), last_run_ts)
+        self._wakeup.set()
+
+    async def start(self):
+        """Запускает задачу-планировщик"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает планировщик и прерывает выполняющиеся задачи"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        for task in list(self._running):
+            task.cancel()
+        await asyncio.gather(self._task, *self._running, return_exceptions=True)
+        self._task = None
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            next_ts = None
+            for job in self.jobs.values():
+                if job.running or job.next_run_ts is None:
+                    continue
+                if job.next_run_ts <= now:
+                    self._launch(job)
+                elif next_ts is None or job.next_run_ts < next_ts:
+                    next_ts = job.next_run_ts
+
+            timeout = self.max_sleep_seconds if next_ts is None else min(next_ts - now, self.max_sleep_seconds)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(timeout, 0))
+            except asyncio.TimeoutError:
+                pass
+            self.wakeups_total += 1
+
+    def _launch(self, job: Job):
+        job.running = True
+        job.next_run_ts = None
+        task = asyncio.create_task(self._execute(job))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _execute(self, job: Job):
+        started_ts = time.time()
+        started = time.perf_counter()
+        try:
+            await job.func()
+            job.last_success_ts = time.time()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            job.failures_total += 1
+            logger.error(f"Ошибка фоновой задачи '{job.description}': {e}")
+        finally:
+            duration = time.perf_counter() - started
+            JOB_RUN_SECONDS.observe(duration, job.name)
+            job.runs_total += 1
+            job.last_run_ts = started_ts
+            job.last_duration_seconds = duration
+            job.running = False
+            # Несколько пропущенных запусков подряд (сон машины, долгая задача) сливаются в один
+            job.plan(time.time())
+            self._wakeup.set()
@@ -0,0 +1,193 @@
+"""
+CartridgeMaster - групповой коммит записей в БД.
+
+Все запросы на запись (/scan, PATCH остатков) не коммитят сами, а отдают свою операцию
+единственной задаче-писателю. Писатель несколько миллисекунд собирает операции от
+конкурентных запросов, выполняет их в одной транзакции и делает один коммит (один fsync WAL),
+после чего каждому вызывающему возвращается его собственный результат.
+"""
+
+import asyncio
+import logging
+import time
+
+import aiosqlite
+
+from server_metrics import metrics
+
+logger = logging.getLogger("my_custom_logger")
+
+WRITE_BATCH_SIZE = metrics.histogram(
+    "cartridge_write_batch_size",
+    "Количество операций в одном групповом коммите",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256)
+)
+WRITE_COMMIT_SECONDS = metrics.histogram(
+    "cartridge_write_commit_seconds",
+    "Время коммита пачки записей (fsync WAL), секунды"
+)
+
+
+class WriteCoalescer:
+    """
+    Писатель с групповым коммитом поверх одного aiosqlite соединения
+
+    Каждая операция - это корутина op(db), которая выполняет запросы без коммита и возвращает результат.
+    Операции одной пачки изолированы друг от друга через SAVEPOINT: исключение в одной операции
+    откатывает только её изменения и пробрасывается только её вызывающему.
+    Писатель - единственный владелец соединения: все записи идут через submit(), а если кто-то
+    все же работает с соединением напрямую, он обязан держать тот же lock, что и пачка.
+    """
+
+    def __init__(self, db: aiosqlite.Connection, max_batch_size: int = 64, max_wait_ms: float = 5,
+                 lock: asyncio.Lock = None):
+        """
+        Args:
+            db: Подключение к БД, на котором выполняются записи
+            max_batch_size: Максимум операций в одном коммите
+            max_wait_ms: Сколько миллисекунд ждать новые операции после первой в пачке
+            lock: Блокировка соединения-писателя, общая с прямыми записями (по умолчанию своя)
+        """
+        self.db = db
+        self.lock = lock or asyncio.Lock()
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = asyncio.Queue()
+        self._task = None
+
+        # Счетчики для мониторинга
+        self.batches_total = 0
+        self.ops_total = 0
+        self.ops_failed_total = 0
+        self.last_batch_size = 0
+        self.max_batch_size_seen = 0
+        self.commit_seconds_total = 0.0
+        self.last_commit_seconds = 0.0
+
+    async def start(self):
+        """Запускает фоновую задачу-писателя"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Дожидается выполнения уже поставленных операций и останавливает писателя"""
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    async def submit(self, op):
+        """
+        Ставит операцию в очередь и ждет коммита пачки, в которую она попала
+
+        Args:
+            op: Корутинная функция op(db), не делающая commit
+
+        Returns:
+            То, что вернула op, после успешного коммита
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((op, future))
+        return await future
+
+    def stats(self) -> dict:
+        """Текущие значения счетчиков писателя"""
+        return {
+            "batches_total": self.batches_total,
+            "ops_total": self.ops_total,
+            "ops_failed_total": self.ops_failed_total,
+            "last_batch_size": self.last_batch_size,
+            "max_batch_size_seen": self.max_batch_size_seen,
+            "avg_batch_size": self.ops_total / self.batches_total if self.batches_total else 0,
+            "commit_seconds_total": self.commit_seconds_total,
+            "last_commit_seconds": self.last_commit_seconds,
+            "queue_depth": self._queue.qsize(),
+        }
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+
+            batch = [item]
+            deadline = loop.time() + self.max_wait
+            # Добираем операции, пришедшие за окно ожидания
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                try:
+                    if timeout <= 0:
+                        item = self._queue.get_nowait()
+                    else:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            try:
+                await self._execute(batch)
+            except Exception as e:
+                logger.error(f"Ошибка группового коммита: {e}")
+
+    async def _execute(self, batch: list):
+        async with self.lock:
+            await self._execute_locked(batch)
+
+    async def _execute_locked(self, batch: list):
+        db = self.db
+        outcomes = []
+        if db.in_transaction:
+            # Чужая незакоммиченная транзакция: коммит пачки не должен ее подхватить
+            logger.error("На соединении-писателе осталась незакоммиченная транзакция, она отменена")
+            await db.rollback()
+        try:
+            await db.execute("BEGIN")
+            for op, future in batch:
+                await db.execute("SAVEPOINT write_op")
+                try:
+                    result = await op(db)
+                    await db.execute("RELEASE write_op")
+                    outcomes.append((future, result, None))
+                except Exception as e:
+                    await db.execute("ROLLBACK TO write_op")
+                    await db.execute("RELEASE write_op")
+                    outcomes.append((future, None, e))
+
+            started = time.perf_counter()
+            await db.commit()
+            elapsed = time.perf_counter() - started
+        except Exception as e:
+            # Пачка не закоммитилась - все вызывающие получают ошибку
+            try:
+                await db.rollback()
+            except Exception:
+                pass
+            self.ops_failed_total += len(batch)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            raise
+
+        self.batches_total += 1
+        self.ops_total += len(batch)
+        self.last_batch_size = len(batch)
+        self.max_batch_size_seen = max(self.max_batch_size_seen, len(batch))
+        self.commit_seconds_total += elapsed
+        self.last_commit_seconds = elapsed
+        WRITE_BATCH_SIZE.observe(len(batch))
+        WRITE_COMMIT_SECONDS.observe(elapsed)
+
+        for future, result, error in outcomes:
+            if future.done():
+                continue
+            if error is not None:
+                self.ops_failed_total += 1
+                future.set_exception(error)
+            else:
+                future.set_result(result)
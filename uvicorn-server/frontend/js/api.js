@@ -211,40 +211,153 @@ async function loadExpenseHeatmap() {
     }
 }
 
+// Размер одной страницы каталога (сервер ограничивает его сверху)
+const CATALOG_PAGE_LIMIT = 50;
+
 /**
- * Загружает данные картриджей с сервера и обновляет все вкладки карточек
+ * Вкладки с карточками картриджей. Каждая вкладка грузит каталог постранично
+ * со своим поиском, а список расходников - еще и с сортировкой и фильтрами.
+ * cursor - курсор следующей страницы, requestId отсекает ответы на устаревшие запросы.
  */
-async function updateDashboard() {
-    try {
-        const listSearchInput = document.getElementById('searchInput-1');
-        const editorSearchInput = document.getElementById('searchInput-2');
-        const deleteSearchInput = document.getElementById('searchInput-3');
-        const listSearchValue = listSearchInput ? listSearchInput.value : '';
-        const editorSearchValue = editorSearchInput ? editorSearchInput.value : '';
-        const deleteSearchValue = deleteSearchInput ? deleteSearchInput.value : '';
-        const openedCardIds = Array.from(document.querySelectorAll('#editor-list details[open]')).map(card => card.dataset.cartridgeId);
+const catalogViews = {
+    list: {
+        listId: 'inv-list', searchId: 'searchInput-1', moreId: 'loadMore-1',
+        sortId: 'sortSelect-1', lowStockId: 'lowStockOnly-1', hasBarcodeId: 'hasBarcodeOnly-1',
+        renderList: renderSimpleList, renderCard: renderSimpleCard,
+        cursor: null, requestId: 0
+    },
+    editor: {
+        listId: 'editor-list', searchId: 'searchInput-2', moreId: 'loadMore-2',
+        renderList: renderEditorList, renderCard: renderEditorCard,
+        cursor: null, requestId: 0
+    },
+    delete: {
+        listId: 'delete-list', searchId: 'searchInput-3', moreId: 'loadMore-3',
+        renderList: renderDeleteList, renderCard: renderDeleteCard,
+        cursor: null, requestId: 0
+    }
+};
 
-        const response = await fetch('/api/v1/cartridges');
-        const data = await response.json();
+/**
+ * Собирает параметры запроса страницы каталога из поиска и фильтров вкладки
+ *
+ * @param {Object} view - описание вкладки из catalogViews
+ * @returns {URLSearchParams}
+ */
+function buildCatalogQuery(view) {
+    const params = new URLSearchParams({ limit: CATALOG_PAGE_LIMIT });
 
-        renderSimpleList(data);
-        renderEditorList(data);
-        renderDeleteList(data);
-        initializeEditorCards();
+    const searchInput = document.getElementById(view.searchId);
+    if (searchInput && searchInput.value.trim()) {
+        params.set('q', searchInput.value.trim());
+    }
 
-        if (listSearchInput) {
-            listSearchInput.value = listSearchValue;
-            filterTable_list();
-        }
+    const sortSelect = view.sortId ? document.getElementById(view.sortId) : null;
+    if (sortSelect && sortSelect.value) {
+        const [sort, order] = sortSelect.value.split(':');
+        params.set('sort', sort);
+        params.set('order', order);
+    }
 
-        if (editorSearchInput) {
-            editorSearchInput.value = editorSearchValue;
-            filterTable_edit();
-        }
+    const lowStockOnly = view.lowStockId ? document.getElementById(view.lowStockId) : null;
+    if (lowStockOnly && lowStockOnly.checked) {
+        params.set('low_stock', 'true');
+    }
+
+    const hasBarcodeOnly = view.hasBarcodeId ? document.getElementById(view.hasBarcodeId) : null;
+    if (hasBarcodeOnly && hasBarcodeOnly.checked) {
+        params.set('has_barcode', 'true');
+    }
 
-        if (deleteSearchInput) {
-            deleteSearchInput.value = deleteSearchValue;
-            filterTable_delete();
+    return params;
+}
+
+/**
+ * Загружает страницу каталога для вкладки и рисует ее
+ *
+ * @param {string} viewName - вкладка каталога: list, editor или delete
+ * @param {boolean} append - дописать следующую страницу к уже показанным карточкам
+ * @returns {Promise<Object|null>} ответ сервера или null, если ответ устарел
+ */
+async function loadCatalogPage(viewName, append) {
+    const view = catalogViews[viewName];
+    const params = buildCatalogQuery(view);
+    if (append) {
+        if (!view.cursor) return null;
+        params.set('cursor', view.cursor);
+    }
+
+    const requestId = ++view.requestId;
+    const response = await fetch(`/api/v1/cartridges/page?${params}`);
+    if (!response.ok) {
+        throw new Error(`Сервер вернул ${response.status}`);
+    }
+    const data = await response.json();
+
+    // Пока ждали ответ, пользователь изменил поиск - рисовать нечего
+    if (requestId !== view.requestId) return null;
+
+    rememberCartridges(data.items);
+    if (append) {
+        const newCards = appendCards(view.listId, data.items, view.renderCard);
+        if (viewName === 'editor') newCards.forEach(initializeEditorCard);
+    } else {
+        view.renderList(data.items);
+        if (viewName === 'editor') initializeEditorCards();
+    }
+
+    view.cursor = data.next_cursor;
+    const moreBtn = document.getElementById(view.moreId);
+    if (moreBtn) {
+        moreBtn.style.display = view.cursor ? '' : 'none';
+    }
+    return data;
+}
+
+/**
+ * Перезагружает первую страницу одной вкладки (поиск, сортировка или фильтры изменились)
+ *
+ * @param {string} viewName - вкладка каталога
+ */
+async function reloadCatalogView(viewName) {
+    try {
+        await loadCatalogPage(viewName, false);
+    } catch (error) {
+        console.error('Ошибка загрузки данных:', error);
+    }
+}
+
+/**
+ * Дописывает следующую страницу во вкладку (кнопка "Показать еще")
+ *
+ * @param {string} viewName - вкладка каталога
+ */
+async function loadMoreCartridges(viewName) {
+    const moreBtn = document.getElementById(catalogViews[viewName].moreId);
+    if (moreBtn) moreBtn.disabled = true;
+    try {
+        await loadCatalogPage(viewName, true);
+    } catch (error) {
+        console.error('Ошибка загрузки данных:', error);
+    } finally {
+        if (moreBtn) moreBtn.disabled = false;
+    }
+}
+
+/**
+ * Загружает первые страницы каталога с сервера и обновляет все вкладки карточек
+ */
+async function updateDashboard() {
+    try {
+        const openedCardIds = Array.from(document.querySelectorAll('#editor-list details[open]')).map(card => card.dataset.cartridgeId);
+
+        resetCartridges();
+        const pages = await Promise.all(Object.keys(catalogViews).map(viewName => loadCatalogPage(viewName, false)));
+
+        // Пропущенные изменения потом запрашиваются с самой старой из полученных версий
+        const versions = pages.filter(Boolean).map(page => page.version);
+        if (versions.length > 0) {
+            setCatalogVersion(Math.min(...versions));
         }
 
         openedCardIds.forEach(id => {
@@ -257,6 +370,7 @@ async function updateDashboard() {
         console.error('Ошибка загрузки данных:', error);
     }
 }
+
 /**
  * Загружает список email адресов
  */
@@ -3,6 +3,7 @@
  * Это точка входа фронтенда.
  * Здесь инициализируется страница после полной загрузки:
  * - загружается основной список картриджей
+ * - открывается поток изменений с сервера для точечного обновления карточек
  * - настраивается блок анализа расходов
  */
 
@@ -47,12 +48,157 @@ function initializeEmailSection() {
     }
 }
 
+// Данные картриджей с загруженных страниц по ID: события об остатке приходят без
+// минимума и штрих-кодов, поэтому карточка собирается из сохраненного объекта.
+let cartridgesById = new Map();
+
+// Версия каталога (ID события), с которой последний раз перерисована каждая карточка.
+// Запоздавшее событие с меньшей версией игнорируется.
+let cartridgeVersions = new Map();
+
+// Последняя известная версия каталога: с нее запрашиваются пропущенные изменения после обрыва потока
+let catalogVersion = null;
+
+/**
+ * Забывает загруженные картриджи перед полной перезагрузкой вкладок
+ */
+function resetCartridges() {
+    cartridgesById = new Map();
+    cartridgeVersions = new Map();
+    catalogVersion = null;
+}
+
+/**
+ * Запоминает картриджи из загруженной страницы каталога
+ *
+ * @param {Array} data - массив картриджей из API
+ */
+function rememberCartridges(data) {
+    (Array.isArray(data) ? data : []).forEach(item => cartridgesById.set(String(item.id), item));
+}
+
+/**
+ * Запоминает версию каталога, с которой загружены вкладки
+ *
+ * @param {number|string|null} version - версия каталога из ответа сервера
+ */
+function setCatalogVersion(version) {
+    const parsedVersion = parseInt(version, 10);
+    catalogVersion = Number.isNaN(parsedVersion) ? null : parsedVersion;
+}
+
+/**
+ * Подтягивает изменения каталога, пропущенные пока поток событий был недоступен.
+ * Сервер отдает только изменившиеся картриджи, а если журнал изменений
+ * уже не покрывает нашу версию - весь каталог (тогда просто перерисовываем все).
+ */
+async function syncCatalogChanges() {
+    if (catalogVersion === null) {
+        await updateDashboard();
+        return;
+    }
+
+    try {
+        const response = await fetch(`/api/v1/cartridges?since=${catalogVersion}`);
+        if (!response.ok) return;
+        const delta = await response.json();
+
+        if (delta.full) {
+            await updateDashboard();
+            return;
+        }
+
+        delta.upserted.forEach(item => applyCartridgeItem(item));
+        delta.deleted.forEach(cartridgeId => {
+            cartridgesById.delete(String(cartridgeId));
+            removeCartridgeCards(cartridgeId);
+        });
+        catalogVersion = Math.max(catalogVersion, delta.version);
+    } catch (error) {
+        console.error('Ошибка синхронизации каталога:', error);
+    }
+}
+
+/**
+ * Проверяет, что событие новее того, что уже нарисовано в карточке
+ *
+ * @param {string} cartridgeId - ID картриджа
+ * @param {MessageEvent} event - событие EventSource
+ * @returns {boolean}
+ */
+function isFreshEvent(cartridgeId, event) {
+    const version = parseInt(event.lastEventId, 10);
+    if (Number.isNaN(version)) return true;
+    if (catalogVersion !== null && version > catalogVersion) {
+        catalogVersion = version;
+    }
+    if (version <= (cartridgeVersions.get(cartridgeId) || 0)) return false;
+    cartridgeVersions.set(cartridgeId, version);
+    return true;
+}
+
+/**
+ * Обновляет показанные карточки после изменения картриджа.
+ * Картриджи с еще не загруженных страниц не трогаем: они придут актуальными вместе со своей страницей.
+ *
+ * @param {Object} item - объект картриджа
+ */
+function applyCartridgeItem(item) {
+    const cartridgeId = String(item.id);
+    if (!cartridgesById.has(cartridgeId)) return;
+    cartridgesById.set(cartridgeId, item);
+    renderCartridgeUpdate(item);
+}
+
+/**
+ * Подписывается на поток изменений каталога с сервера (Server-Sent Events).
+ * Вместо периодической перезагрузки всего каталога точечно обновляются только
+ * затронутые карточки. После обрыва браузер переподключается сам, а пропущенные
+ * за это время изменения подтягиваются запросом изменений с последней известной версии.
+ */
+function initializeLiveUpdates() {
+    if (typeof EventSource === 'undefined') return;
+
+    const source = new EventSource('/api/v1/events');
+    let connectedOnce = false;
+
+    source.addEventListener('open', () => {
+        if (connectedOnce) {
+            syncCatalogChanges();
+        }
+        connectedOnce = true;
+    });
+
+    // Изменился только остаток (сканы с ТСД)
+    source.addEventListener('stock', event => {
+        const change = JSON.parse(event.data);
+        const cartridgeId = String(change.id);
+        if (!isFreshEvent(cartridgeId, event)) return;
+
+        const item = cartridgesById.get(cartridgeId);
+        if (!item) return;
+        applyCartridgeItem({ ...item, name: change.name, quantity: change.quantity });
+    });
+
+    // Картридж создан или изменен целиком
+    source.addEventListener('upsert', event => {
+        const item = JSON.parse(event.data);
+        if (!isFreshEvent(String(item.id), event)) return;
+        applyCartridgeItem(item);
+    });
+
+    source.addEventListener('delete', event => {
+        const change = JSON.parse(event.data);
+        const cartridgeId = String(change.id);
+        if (!isFreshEvent(cartridgeId, event)) return;
+        cartridgesById.delete(cartridgeId);
+        removeCartridgeCards(cartridgeId);
+    });
+}
+
 window.onload = function() {
     initializeAnalysisControls();
     initializeEmailSection();
     updateDashboard();
-};
-
-// Если когда-нибудь понадобится автообновление данных,
-// можно раскомментировать строку ниже.
-// setInterval(updateDashboard, 5000);
\ No newline at end of file
+    initializeLiveUpdates();
+};
\ No newline at end of file
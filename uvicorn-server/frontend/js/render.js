@@ -2,9 +2,11 @@
  * RENDER.JS
  * Этот файл отвечает только за ОТРИСОВКУ интерфейса.
  * Он берет массив картриджей, пришедший с сервера,
- * и превращает его в HTML-карточки для двух вкладок:
+ * и превращает его в HTML-карточки для вкладок:
  * 1) обычный список
  * 2) редактор с раскрывающимися карточками
+ * 3) удаление позиций
+ * Отдельные карточки можно перерисовать точечно по событиям с сервера.
  */
 
 /**
@@ -171,6 +173,41 @@ function renderExpenseHeatmap(series, selectedYear, totalSpent) {
     expenseHeatmapInstance.render();
 }
 
+/**
+ * Собирает HTML одной карточки для вкладки "Список расходников".
+ *
+ * @param {Object} item - объект картриджа из API
+ * @returns {string} HTML-строка карточки
+ */
+function renderSimpleCard(item) {
+    const stockState = getStockState(item);
+
+    return `
+        <article class="cartridge-card stock-card ${stockState.className}" data-cartridge-id="${item.id}" data-search-name="${escapeHtml(item.name.toLowerCase())}">
+            <div class="card-top">
+                <div class="card-heading">
+                    <span class="card-id">ID ${item.id}</span>
+                    <h3 class="cartridge-name">${escapeHtml(item.name)}</h3>
+                </div>
+                <span class="card-status">${item.quantity} шт</span>
+            </div>
+
+            <div class="card-metrics">
+                <div class="metric">
+                    <span class="metric-label">Необходимый минимум</span>
+                    <span class="metric-value">${item.min_qty} шт</span>
+                </div>
+                <div class="metric">
+                    <span class="metric-label">Последнее обновление</span>
+                    <span class="metric-value">${escapeHtml(item.last_update || '—')}</span>
+                </div>
+            </div>
+
+            <div class="stock-note ${stockState.className}">${stockState.label}</div>
+        </article>
+    `;
+}
+
 /**
  * Рисует вкладку "Список расходников".
  * Здесь карточки только для просмотра: без редактирования, только статус и основные данные.
@@ -189,11 +226,22 @@ function renderSimpleList(data) {
     }
 
     // Для каждого картриджа собираем HTML карточки и вставляем всё одним куском.
-    list.innerHTML = data.map(item => {
-        const stockState = getStockState(item);
+    list.innerHTML = data.map(renderSimpleCard).join('');
+}
 
-        return `
-            <article class="cartridge-card stock-card ${stockState.className}" data-search-name="${escapeHtml(item.name.toLowerCase())}">
+/**
+ * Собирает HTML одной раскрывающейся карточки для вкладки "Редактор БД".
+ *
+ * @param {Object} item - объект картриджа из API
+ * @returns {string} HTML-строка карточки
+ */
+function renderEditorCard(item) {
+    const stockState = getStockState(item);
+
+    return `
+        <details class="cartridge-card editor-card ${stockState.className}" data-cartridge-id="${item.id}" data-search-name="${escapeHtml(item.name.toLowerCase())}">
+            <!-- Верхняя часть карточки, которая видна всегда -->
+            <summary class="editor-card-summary">
                 <div class="card-top">
                     <div class="card-heading">
                         <span class="card-id">ID ${item.id}</span>
@@ -202,21 +250,67 @@ function renderSimpleList(data) {
                     <span class="card-status">${item.quantity} шт</span>
                 </div>
 
-                <div class="card-metrics">
+                <div class="card-metrics compact-metrics">
                     <div class="metric">
-                        <span class="metric-label">Необходимый минимум</span>
-                        <span class="metric-value">${item.min_qty} шт</span>
+                        <span class="metric-label">Количество</span>
+                        <span class="metric-value">${item.quantity} шт</span>
                     </div>
                     <div class="metric">
-                        <span class="metric-label">Последнее обновление</span>
+                        <span class="metric-label">Изменено</span>
                         <span class="metric-value">${escapeHtml(item.last_update || '—')}</span>
                     </div>
                 </div>
 
-                <div class="stock-note ${stockState.className}">${stockState.label}</div>
-            </article>
-        `;
-    }).join('');
+                <div class="editor-hint">Нажми на меня</div>
+            </summary>
+
+            <!-- Нижняя скрытая часть карточки: поля редактирования -->
+            <div class="editor-card-body">
+                <div class="editor-form-grid">
+                    <label class="editor-field editor-field-full">
+                        <span>Название картриджа</span>
+                        <input type="text" class="name-input" value="${escapeHtml(item.name)}" />
+                    </label>
+
+                    <label class="editor-field">
+                        <span>Текущее количество</span>
+                        <div class="qty-controls">
+                            <button type="button" class="qty-btn" onclick="adjustNumber(this, -1)">-</button>
+                            <input type="number" min="0" class="qty-input current-qty" value="${item.quantity}" />
+                            <button type="button" class="qty-btn" onclick="adjustNumber(this, 1)">+</button>
+                        </div>
+                    </label>
+
+                    <label class="editor-field">
+                        <span>Минимальный остаток</span>
+                        <div class="qty-controls">
+                            <button type="button" class="qty-btn" onclick="adjustNumber(this, -1)">-</button>
+                            <input type="number" min="0" class="qty-input min-qty" value="${item.min_qty}" />
+                            <button type="button" class="qty-btn" onclick="adjustNumber(this, 1)">+</button>
+                        </div>
+                    </label>
+
+                    <div class="editor-field editor-field-full">
+                        <span>Штрих-коды</span>
+                        <div class="barcodes-cell" data-cartridge-id="${item.id}">
+                            <div class="barcodes-list">
+                                ${renderBarcodes(item)}
+                            </div>
+                            <div class="add-barcode">
+                                <input type="text" class="new-barcode-input" placeholder="Новый штрих-код">
+                                <button type="button" class="add-btn" onclick="addBarcode(this)">+</button>
+                            </div>
+                        </div>
+                    </div>
+                </div>
+
+                <div class="editor-actions">
+                    <span class="timedate-note">Последнее изменение: <span class="timedate_value">${escapeHtml(item.last_update || '—')}</span></span>
+                    <button type="button" class="save-btn" onclick="saveRow(this)">Сохранить</button>
+                </div>
+            </div>
+        </details>
+    `;
 }
 
 /**
@@ -236,83 +330,48 @@ function renderEditorList(data) {
         return;
     }
 
-    list.innerHTML = data.map(item => {
-        const stockState = getStockState(item);
-
-        return `
-            <details class="cartridge-card editor-card ${stockState.className}" data-cartridge-id="${item.id}" data-search-name="${escapeHtml(item.name.toLowerCase())}">
-                <!-- Верхняя часть карточки, которая видна всегда -->
-                <summary class="editor-card-summary">
-                    <div class="card-top">
-                        <div class="card-heading">
-                            <span class="card-id">ID ${item.id}</span>
-                            <h3 class="cartridge-name">${escapeHtml(item.name)}</h3>
-                        </div>
-                        <span class="card-status">${item.quantity} шт</span>
-                    </div>
-
-                    <div class="card-metrics compact-metrics">
-                        <div class="metric">
-                            <span class="metric-label">Количество</span>
-                            <span class="metric-value">${item.quantity} шт</span>
-                        </div>
-                        <div class="metric">
-                            <span class="metric-label">Изменено</span>
-                            <span class="metric-value">${escapeHtml(item.last_update || '—')}</span>
-                        </div>
-                    </div>
+    list.innerHTML = data.map(renderEditorCard).join('');
+}
 
-                    <div class="editor-hint">Нажми на меня</div>
-                </summary>
-
-                <!-- Нижняя скрытая часть карточки: поля редактирования -->
-                <div class="editor-card-body">
-                    <div class="editor-form-grid">
-                        <label class="editor-field editor-field-full">
-                            <span>Название картриджа</span>
-                            <input type="text" class="name-input" value="${escapeHtml(item.name)}" />
-                        </label>
-
-                        <label class="editor-field">
-                            <span>Текущее количество</span>
-                            <div class="qty-controls">
-                                <button type="button" class="qty-btn" onclick="adjustNumber(this, -1)">-</button>
-                                <input type="number" min="0" class="qty-input current-qty" value="${item.quantity}" />
-                                <button type="button" class="qty-btn" onclick="adjustNumber(this, 1)">+</button>
-                            </div>
-                        </label>
-
-                        <label class="editor-field">
-                            <span>Минимальный остаток</span>
-                            <div class="qty-controls">
-                                <button type="button" class="qty-btn" onclick="adjustNumber(this, -1)">-</button>
-                                <input type="number" min="0" class="qty-input min-qty" value="${item.min_qty}" />
-                                <button type="button" class="qty-btn" onclick="adjustNumber(this, 1)">+</button>
-                            </div>
-                        </label>
-
-                        <div class="editor-field editor-field-full">
-                            <span>Штрих-коды</span>
-                            <div class="barcodes-cell" data-cartridge-id="${item.id}">
-                                <div class="barcodes-list">
-                                    ${renderBarcodes(item)}
-                                </div>
-                                <div class="add-barcode">
-                                    <input type="text" class="new-barcode-input" placeholder="Новый штрих-код">
-                                    <button type="button" class="add-btn" onclick="addBarcode(this)">+</button>
-                                </div>
-                            </div>
-                        </div>
-                    </div>
+/**
+ * Собирает HTML одной карточки для вкладки "Удаление позиций".
+ *
+ * @param {Object} item - объект картриджа из API
+ * @returns {string} HTML-строка карточки
+ */
+function renderDeleteCard(item) {
+    const stockState = getStockState(item);
+
+    return `
+        <div class="cartridge-card delete-card ${stockState.className}" data-cartridge-id="${item.id}" data-cartridge-name="${escapeHtml(item.name)}" data-search-name="${escapeHtml(item.name.toLowerCase())}">
+            <div class="card-top">
+                <div class="card-heading">
+                    <span class="card-id">ID ${item.id}</span>
+                    <h3 class="cartridge-name">${escapeHtml(item.name)}</h3>
+                </div>
+                <span class="card-status">${item.quantity} шт</span>
+            </div>
 
-                    <div class="editor-actions">
-                        <span class="timedate-note">Последнее изменение: <span class="timedate_value">${escapeHtml(item.last_update || '—')}</span></span>
-                        <button type="button" class="save-btn" onclick="saveRow(this)">Сохранить</button>
-                    </div>
+            <div class="card-metrics">
+                <div class="metric">
+                    <span class="metric-label">Количество</span>
+                    <span class="metric-value">${item.quantity} шт</span>
+                </div>
+                <div class="metric">
+                    <span class="metric-label">Минимум</span>
+                    <span class="metric-value">${item.min_qty} шт</span>
                 </div>
-            </details>
-        `;
-    }).join('');
+                <div class="metric">
+                    <span class="metric-label">Штрих-коды</span>
+                    <span class="metric-value">${item.barcodes && item.barcodes.length > 0 ? item.barcodes.length : 0}</span>
+                </div>
+            </div>
+
+            <div class="delete-actions">
+                <button type="button" class="delete-btn" onclick="deleteCartridge(this)">Удалить картридж</button>
+            </div>
+        </div>
+    `;
 }
 
 /**
@@ -330,38 +389,102 @@ function renderDeleteList(data) {
         return;
     }
 
-    list.innerHTML = data.map(item => {
-        const stockState = getStockState(item);
+    list.innerHTML = data.map(renderDeleteCard).join('');
+}
 
-        return `
-            <div class="cartridge-card delete-card ${stockState.className}" data-cartridge-id="${item.id}" data-cartridge-name="${escapeHtml(item.name)}" data-search-name="${escapeHtml(item.name.toLowerCase())}">
-                <div class="card-top">
-                    <div class="card-heading">
-                        <span class="card-id">ID ${item.id}</span>
-                        <h3 class="cartridge-name">${escapeHtml(item.name)}</h3>
-                    </div>
-                    <span class="card-status">${item.quantity} шт</span>
-                </div>
+/**
+ * Собирает DOM-элемент карточки из HTML-строки.
+ *
+ * @param {Object} item - объект картриджа из API
+ * @param {Function} renderCard - функция, собирающая HTML карточки
+ * @returns {Element}
+ */
+function buildCardElement(item, renderCard) {
+    const template = document.createElement('template');
+    template.innerHTML = renderCard(item).trim();
+    return template.content.firstElementChild;
+}
 
-                <div class="card-metrics">
-                    <div class="metric">
-                        <span class="metric-label">Количество</span>
-                        <span class="metric-value">${item.quantity} шт</span>
-                    </div>
-                    <div class="metric">
-                        <span class="metric-label">Минимум</span>
-                        <span class="metric-value">${item.min_qty} шт</span>
-                    </div>
-                    <div class="metric">
-                        <span class="metric-label">Штрих-коды</span>
-                        <span class="metric-value">${item.barcodes && item.barcodes.length > 0 ? item.barcodes.length : 0}</span>
-                    </div>
-                </div>
+/**
+ * Дописывает карточки следующей страницы каталога в конец списка.
+ *
+ * @param {string} listId - id контейнера списка
+ * @param {Array} data - массив картриджей из API
+ * @param {Function} renderCard - функция, собирающая HTML карточки
+ * @returns {Array<Element>} добавленные карточки
+ */
+function appendCards(listId, data, renderCard) {
+    const list = document.getElementById(listId);
+    if (!list || !Array.isArray(data)) return [];
+
+    return data.map(item => {
+        // Карточка могла сдвинуться между страницами после изменения - не дублируем ее
+        const existing = list.querySelector(`:scope > [data-cartridge-id="${item.id}"]`);
+        if (existing) existing.remove();
+        const card = buildCardElement(item, renderCard);
+        list.appendChild(card);
+        return card;
+    });
+}
 
-                <div class="delete-actions">
-                    <button type="button" class="delete-btn" onclick="deleteCartridge(this)">Удалить картридж</button>
-                </div>
-            </div>
-        `;
-    }).join('');
+/**
+ * Заменяет уже показанную карточку картриджа в одном списке.
+ *
+ * @param {string} listId - id контейнера списка
+ * @param {Object} item - объект картриджа из API
+ * @param {Function} renderCard - функция, собирающая HTML карточки
+ * @returns {Element|null} новая карточка или null, если такой карточки в списке нет
+ */
+function replaceCard(listId, item, renderCard) {
+    const list = document.getElementById(listId);
+    if (!list) return null;
+
+    // Ищем только среди прямых потомков: внутри карточки редактора тоже есть data-cartridge-id
+    const oldCard = list.querySelector(`:scope > [data-cartridge-id="${item.id}"]`);
+    if (!oldCard) return null;
+
+    const newCard = buildCardElement(item, renderCard);
+    oldCard.replaceWith(newCard);
+    return newCard;
+}
+
+/**
+ * Точечно перерисовывает карточки одного картриджа во всех вкладках.
+ * Открытую карточку редактора целиком не трогаем, чтобы не стереть то, что пользователь
+ * сейчас вводит: обновляются только заголовок, цвет статуса и список штрих-кодов.
+ *
+ * @param {Object} item - объект картриджа из API
+ */
+function renderCartridgeUpdate(item) {
+    replaceCard('inv-list', item, renderSimpleCard);
+    replaceCard('delete-list', item, renderDeleteCard);
+
+    const editorList = document.getElementById('editor-list');
+    const openedCard = editorList ? editorList.querySelector(`:scope > details[open][data-cartridge-id="${item.id}"]`) : null;
+
+    if (openedCard) {
+        const freshCard = buildCardElement(item, renderEditorCard);
+
+        openedCard.className = freshCard.className;
+        openedCard.dataset.searchName = freshCard.dataset.searchName;
+        openedCard.querySelector('summary').innerHTML = freshCard.querySelector('summary').innerHTML;
+        openedCard.querySelector('.barcodes-list').innerHTML = freshCard.querySelector('.barcodes-list').innerHTML;
+    } else {
+        const newCard = replaceCard('editor-list', item, renderEditorCard);
+        if (newCard) initializeEditorCard(newCard);
+    }
+}
+
+/**
+ * Убирает карточки удаленного картриджа из всех вкладок.
+ *
+ * @param {number|string} cartridgeId - ID картриджа
+ */
+function removeCartridgeCards(cartridgeId) {
+    ['inv-list', 'editor-list', 'delete-list'].forEach(listId => {
+        const list = document.getElementById(listId);
+        if (!list) return;
+        const card = list.querySelector(`:scope > [data-cartridge-id="${cartridgeId}"]`);
+        if (card) card.remove();
+    });
 }
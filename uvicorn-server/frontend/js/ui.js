@@ -47,45 +47,39 @@ function adjustNumber(btn, delta) {
     input.value = next < 0 ? 0 : next;
 }
 
-function filterCards(inputId, selector) {
-    // Получаем значение из поля ввода и все карточки по селектору
-    const input = document.getElementById(inputId);
-    // На всякий случай проверяем, что элемент найден
-    if (!input) return;
-    // Обрезаем пробелы и приводим к нижнему регистру для нечувствительного поиска
-    const searchValue = input.value.trim().toLowerCase();
-    // Получаем все карточки, которые нужно фильтровать по переданному селектору
-    const cards = document.querySelectorAll(selector);
-    // Для каждой карточки проверяем.. 
-    cards.forEach(card => {
-        // Содержит ли она в своем data-атрибуте search-name искомое значение.
-        // Если нет то загоняем пустоту в строку с именем
-        const nameText = (card.dataset.searchName || '').toLowerCase();
-        // Если содержит, то делаем сброс её inline стиля, передавая ''
-        // Если нет - скрываем через display none
-        card.style.display = nameText.includes(searchValue) ? '' : 'none';
-    });
+// Таймеры отложенной перезагрузки вкладок: запрос уходит, когда пользователь перестал печатать
+const catalogReloadTimers = {};
+
+/**
+ * Откладывает перезагрузку вкладки каталога с сервера с учетом поиска и фильтров.
+ * Фильтрация и сортировка выполняются на сервере, браузер получает только первую страницу.
+ *
+ * @param {string} viewName - вкладка каталога: list, editor или delete
+ */
+function scheduleCatalogReload(viewName) {
+    clearTimeout(catalogReloadTimers[viewName]);
+    catalogReloadTimers[viewName] = setTimeout(() => reloadCatalogView(viewName), 300);
 }
 
 /**
  * Фильтрует карточки во вкладке "Список расходников"
  */
 function filterTable_list() {
-    filterCards('searchInput-1', '#inv-list .cartridge-card');
+    scheduleCatalogReload('list');
 }
 
 /**
  * Фильтрует карточки во вкладке "Редактор позиций"
  */
 function filterTable_edit() {
-    filterCards('searchInput-2', '#editor-list .cartridge-card');
+    scheduleCatalogReload('editor');
 }
 
 /**
  * Фильтрует карточки во вкладке "Удаление позиций"
  */
 function filterTable_delete() {
-    filterCards('searchInput-3', '#delete-list .cartridge-card');
+    scheduleCatalogReload('delete');
 }
 
 /**
@@ -94,15 +88,23 @@ function filterTable_delete() {
 function initializeEditorCards() {
     const editorCards = document.querySelectorAll('#editor-list details.editor-card');
 
-    editorCards.forEach(card => {
-        card.addEventListener('toggle', () => {
-            if (!card.open) return;
+    editorCards.forEach(initializeEditorCard);
+}
+
+/**
+ * Вешает на одну карточку редактора закрытие остальных карточек при ее раскрытии.
+ * Вызывается и для карточек, которые появились точечно по событию с сервера.
+ *
+ * @param {HTMLElement} card - карточка details.editor-card
+ */
+function initializeEditorCard(card) {
+    card.addEventListener('toggle', () => {
+        if (!card.open) return;
 
-            editorCards.forEach(otherCard => {
-                if (otherCard !== card) {
-                    otherCard.removeAttribute('open');
-                }
-            });
+        document.querySelectorAll('#editor-list details.editor-card').forEach(otherCard => {
+            if (otherCard !== card) {
+                otherCard.removeAttribute('open');
+            }
         });
     });
 }